@@ -0,0 +1,94 @@
+"""
+Compare the size and encode time of the JSON and msgpack responses for the holdings endpoints, using
+synthetic markets with the same shape as the real ones. No redis needed.
+
+    python benchmarks/msgpack_payloads.py --markets 1 20 100
+
+For each payload this reports the size raw and gzipped, the time to encode it, and the time for a
+python client to decode it. 'json' is the JSON the server sends, encoded with orjson. 'msgpack' is plain
+msgpack of the same object, and 'msgpack arrays' is what the server sends (to_msgpack), with numeric
+arrays packed as extension types.
+"""
+
+import os
+import sys
+import gzip
+import time
+import struct
+import argparse
+import msgpack
+import orjson
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.redis_utils.encodings import to_msgpack, FLOAT64_ARRAY_EXT, INT64_ARRAY_EXT
+
+
+def team_current(n: int=20) -> dict:
+    return {'x': (np.random.rand(n) * 100).tolist(), 'b': 4000.0}
+
+
+def team_hist(n: int=20) -> dict:
+    return {'x': {th: (np.random.rand(60, n) * 100).tolist() for th in 'hdwmM'},
+            'b': {th: [4000.0] * 60 for th in 'hdwmM'}}
+
+
+def time_log() -> dict:
+    return {th: list(range(1620000000, 1620000000 + 60 * 120, 120)) for th in 'hdwmM'}
+
+
+def ext_hook(code: int, data: bytes):
+    """
+    How a client unpacks the array extension types
+    """
+
+    ndim = data[0]
+    shape = struct.unpack_from(f'<{ndim}I', data, 1)
+    dtype = '<f8' if code == FLOAT64_ARRAY_EXT else '<i8'
+
+    return np.frombuffer(data, dtype=dtype, offset=1 + 4 * ndim).reshape(shape)
+
+
+ENCODERS = {'json': (orjson.dumps, orjson.loads),
+            'msgpack': (lambda obj: msgpack.packb(obj, use_bin_type=True), msgpack.unpackb),
+            'msgpack arrays': (to_msgpack, lambda body: msgpack.unpackb(body, ext_hook=ext_hook))}
+
+
+def timeit(f, arg, repeats: int) -> float:
+
+    t0 = time.perf_counter()
+
+    for i in range(repeats):
+        f(arg)
+
+    return (time.perf_counter() - t0) / repeats * 1000
+
+
+def main(market_counts: list, repeats: int):
+
+    print(f'{"payload":<28}{"format":<16}{"bytes":>10}{"gzipped":>10}{"encode ms":>12}{"decode ms":>12}')
+
+    for n_markets in market_counts:
+
+        markets = [f'{i}:8:18378T' for i in range(n_markets)]
+        payloads = {f'current x{n_markets}': {market: team_current() for market in markets},
+                    f'history x{n_markets}': {'data': {market: team_hist() for market in markets}, 'time': time_log()}}
+
+        for name, payload in payloads.items():
+            for fmt, (encode, decode) in ENCODERS.items():
+
+                body = encode(payload)
+
+                print(f'{name:<28}{fmt:<16}{len(body):>10}{len(gzip.compress(body)):>10}'
+                      f'{timeit(encode, payload, repeats):>12.3f}{timeit(decode, body, repeats):>12.3f}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--markets', type=int, nargs='+', default=[1, 20, 100])
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    main(args.markets, args.repeats)
@@ -0,0 +1,92 @@
+"""
+Measure how quickly PriceFeed fans price updates out to subscribers in one process, without redis.
+
+Messages are handed straight to PriceFeed.dispatch, as the pubsub thread would, while a thread per
+subscriber drains its queue like the /price_stream generator does. Reports dispatch throughput and
+the latency between dispatch and a subscriber receiving the message.
+
+    python benchmarks/price_feed_fanout.py --subscribers 1000 --markets 200 --messages 20000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.redis_utils.price_feed import PriceFeed
+from src.redis_utils.versions import price_update
+
+
+def main(n_subscribers: int, n_markets: int, markets_per_subscriber: int, n_messages: int):
+
+    markets = [f'{i}:8:18378T' for i in range(n_markets)]
+    feed = PriceFeed(maxsize=1024)
+
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def consume(subscription):
+
+        local = []
+
+        while not done.is_set() and not subscription.closed:
+
+            message = subscription.get(timeout=0.1)
+
+            if message is not None:
+                local.append(time.perf_counter() - float(message.rsplit(b'"t":', 1)[1][:-1]))
+
+        with lock:
+            latencies.extend(local)
+
+    # subscribe without starting the pubsub thread
+    feed.thread = threading.current_thread()
+    subscriptions = [feed.subscribe(random.sample(markets, markets_per_subscriber)) for i in range(n_subscribers)]
+    consumers = [threading.Thread(target=consume, args=(subscription,), daemon=True) for subscription in subscriptions]
+
+    for consumer in consumers:
+        consumer.start()
+
+    current = {'x': [0.0] * 20, 'b': 4000.0}
+    templates = [price_update(market, current, 1.0)[:-1] for market in markets]
+
+    t0 = time.perf_counter()
+
+    for i in range(n_messages):
+        feed.dispatch(templates[i % n_markets] + b',"t":' + repr(time.perf_counter()).encode() + b'}')
+
+    elapsed = time.perf_counter() - t0
+
+    time.sleep(1)
+    done.set()
+
+    for consumer in consumers:
+        consumer.join()
+
+    stats = feed.stats()
+    latencies = np.array(latencies) * 1000
+
+    print(f'{n_subscribers} subscribers, {n_markets} markets, {markets_per_subscriber} markets per subscriber')
+    print(f'dispatched {n_messages} messages in {elapsed:.2f}s ({n_messages / elapsed:.0f} messages/s)')
+    print(f'delivered {stats["delivered"]} ({stats["delivered"] / elapsed:.0f}/s), dropped {stats["dropped"]} subscribers')
+
+    if len(latencies) > 0:
+        print(f'latency ms: p50 {np.percentile(latencies, 50):.2f}, p99 {np.percentile(latencies, 99):.2f}, max {latencies.max():.2f}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--markets', type=int, default=200)
+    parser.add_argument('--per-subscriber', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    main(args.subscribers, args.markets, args.per_subscriber, args.messages)
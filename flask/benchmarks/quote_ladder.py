@@ -0,0 +1,62 @@
+"""
+Measure the CPU time to price a ladder of trade sizes in one market, as /quote_ladder does, compared with
+calling price_trade once per size. No redis needed.
+
+    python benchmarks/quote_ladder.py --sizes 50 --repeats 1000
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.lmsr.classic import LMSRMarketMaker
+from src.lmsr.long_short import LongShortMarketMaker
+from src.lmsr.contracts import price_ladder, team_long_quantity, PLAYER_LONG_QUANTITY
+
+
+def timeit(f, repeats: int) -> float:
+
+    t0 = time.process_time()
+
+    for i in range(repeats):
+        f()
+
+    return (time.process_time() - t0) / repeats * 1000
+
+
+def main(n_sizes: int, repeats: int):
+
+    sizes = np.linspace(-20, 20, n_sizes).tolist()
+
+    cases = {'team': ('1:8:18378T', {'x': (np.random.rand(20) * 100).tolist(), 'b': 4000.0}, team_long_quantity(20), LMSRMarketMaker),
+             'player': ('1:8:18378P', {'N': 35.0, 'b': 400.0}, PLAYER_LONG_QUANTITY, LongShortMarketMaker)}
+
+    print(f'{n_sizes} sizes, CPU ms per ladder')
+
+    for name, (market, current, q, Maker) in cases.items():
+
+        def loop():
+            maker = Maker(market, *current.values())
+            return [maker.price_trade(size * q) for size in sizes]
+
+        def ladder():
+            return price_ladder(Maker(market, *current.values()), q, sizes)
+
+        assert np.allclose(ladder()['costs'], loop())
+
+        print(f'{name:<8} vectorized {timeit(ladder, repeats):.3f}  '
+              f'per size {timeit(loop, repeats):.3f}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, default=50)
+    parser.add_argument('--repeats', type=int, default=1000)
+    args = parser.parse_args()
+
+    main(args.sizes, args.repeats)
@@ -0,0 +1,83 @@
+"""
+Side-by-side load test of the sync workers (flask_main, port 8000) and the gevent workers (flask_async,
+port 8001) on the read endpoints. flask_async is not started by default, so first run
+
+    gunicorn --config gunicorn_async.py "src.main:app" &
+
+then, from inside the flask container,
+
+    python benchmarks/serving_modes.py --token <firebase id token> --concurrency 50 200 1000
+
+For each serving mode and level of concurrency, a fixed number of requests is sent with that many in
+flight at once, and the throughput, latency percentiles and error count are reported.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import time
+import argparse
+import requests
+import numpy as np
+from gevent.pool import Pool
+
+MODES = {'sync': 'http://localhost:8000', 'async': 'http://localhost:8001'}
+ENDPOINTS = ['/current_holdings', '/historical_holdings']
+
+
+def run(base_url: str, endpoint: str, markets: str, token: str, concurrency: int, n_requests: int) -> dict:
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    latencies = []
+    errors = 0
+
+    def request(i):
+
+        nonlocal errors
+        t0 = time.perf_counter()
+
+        try:
+            response = session.get(f'{base_url}{endpoint}', params={'markets': markets}, headers={'Authorization': token}, timeout=60)
+            if response.status_code != 200:
+                errors += 1
+        except requests.RequestException:
+            errors += 1
+
+        latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    Pool(concurrency).map(request, range(n_requests))
+    elapsed = time.perf_counter() - t0
+
+    latencies = np.array(latencies) * 1000
+
+    return {'rps': n_requests / elapsed,
+            'p50': np.percentile(latencies, 50),
+            'p99': np.percentile(latencies, 99),
+            'errors': errors}
+
+
+def main(token: str, markets: str, concurrency: list, n_requests: int):
+
+    print(f'{"endpoint":<22}{"mode":<8}{"in flight":>10}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}')
+
+    for endpoint in ENDPOINTS:
+        for c in concurrency:
+            for mode, base_url in MODES.items():
+                r = run(base_url, endpoint, markets, token, c, n_requests)
+                print(f'{endpoint:<22}{mode:<8}{c:>10}{r["rps"]:>10.0f}{r["p50"]:>10.1f}{r["p99"]:>10.1f}{r["errors"]:>8}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--markets', default='1:8:18378T,1182:8:18378P')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    main(args.token, args.markets, args.concurrency, args.requests)
@@ -0,0 +1,26 @@
+# Gunicorn settings for the async serving mode (see flask_async in services.conf)
+#
+# Each worker runs every request in its own greenlet. gevent monkey-patches sockets and time.sleep,
+# so redis-py, firebase token verification and the WATCH retry loop in make_purchase all yield to other
+# requests while they wait, instead of blocking the worker. One worker can then hold up to
+# worker_connections requests in flight, rather than one.
+
+bind = '0.0.0.0:8001'
+workers = 4
+worker_class = 'gevent'
+worker_connections = 1000
+timeout = 30
+
+
+def post_fork(server, worker):
+    """
+    Firestore talks to google over grpc, which has its own threads and event loop. These must
+    be made gevent-aware before the app is imported and firestore.client() opens its channel.
+    The app is loaded after this hook runs, so patching here comes first.
+    """
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
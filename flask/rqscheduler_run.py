@@ -0,0 +1,15 @@
+# Runs rq-scheduler (see rqscheduler in services.conf) on the app's primary redis connection, so that it
+# follows REDIS_HOST and REDIS_PORT like the app and the workers (see rqworker_settings.py), instead of
+# the host and port given to the rqscheduler command
+from rq_scheduler import Scheduler
+from rq_scheduler.utils import setup_loghandlers
+from src.redis_utils.connection import primary
+
+# seconds between checks for jobs that are due
+INTERVAL = 10.0
+
+
+if __name__ == '__main__':
+
+    setup_loghandlers('INFO')
+    Scheduler(connection=primary(), interval=INTERVAL).run()
@@ -1,10 +1,14 @@
+# The connection settings are taken from the app's (see src/redis_utils/connection.py), so workers follow 
+# REDIS_HOST and REDIS_PORT too. redis-py parses replies with hiredis whenever it is installed
+from src.redis_utils.connection import PRIMARY_HOST, PRIMARY_PORT
+
 # REDIS_URL = 'redis://localhost:6379/1'
 
 # You can also specify the Redis DB to use
-REDIS_HOST = 'redis'
-REDIS_PORT = 6379
+REDIS_HOST = PRIMARY_HOST
+REDIS_PORT = PRIMARY_PORT
 REDIS_DB = 0
 # REDIS_PASSWORD = 'very secret'
 
 # Queues to listen on
-QUEUES = ['high', 'default', 'low']
\ No newline at end of file
+QUEUES = ['high', 'default', 'low']
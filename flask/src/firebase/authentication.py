@@ -1,13 +1,94 @@
 import os
+import time
+import threading
 from firebase_admin import auth
+from cachetools import LRUCache
 import hashlib
 
 
+class TokenCache:
+    """
+    Bounded cache of the claims of verified user id tokens, so that a client polling with the
+    same token is only verified once. Entries are keyed by the sha256 of the token, so tokens
+    themselves are not kept in memory, and expire at the token's 'exp' claim. 
+
+    Tokens are verified without check_revoked, so a revoked token is accepted until it expires 
+    whether or not it is cached. Only successful verifications are cached.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int=10000):
+
+        self.cache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.verifications = 0
+        self.verify_time = 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str):
+        """
+        Get the cached claims for a token, or None if there are none or the token has expired
+        """
+
+        key = self.key(token)
+
+        with self.lock:
+
+            claims = self.cache.get(key)
+
+            if claims is not None and claims['exp'] <= time.time():
+                del self.cache[key]
+                claims = None
+
+            if claims is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return claims
+
+    def set(self, token: str, claims: dict, verify_time: float) -> None:
+        """
+        Store the claims for a token that took verify_time seconds to verify
+        """
+
+        with self.lock:
+            self.cache[self.key(token)] = claims
+            self.verifications += 1
+            self.verify_time += verify_time
+
+    def stats(self) -> dict:
+
+        with self.lock:
+
+            total = self.hits + self.misses
+            mean_verify_time = self.verify_time / self.verifications if self.verifications > 0 else None
+
+            return {'size': len(self.cache),
+                    'maxsize': self.cache.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total > 0 else None,
+                    'mean_verify_ms': mean_verify_time * 1000 if mean_verify_time is not None else None,
+                    'saved_verify_s': self.hits * mean_verify_time if mean_verify_time is not None else 0}
+
+
+token_cache = TokenCache()
+
+
 def verify_user_token(token: str):
     """
     Attempt to verify a firebase user id token. If successful, return
     True and the user info. If fails, return False along with an error
-    message and a response code.
+    message and a response code. Verified tokens are cached until they
+    expire (see TokenCache).
 
     Params:
         token:      str - Firebase user id token
@@ -20,11 +101,20 @@ def verify_user_token(token: str):
         info            dict - user info relating to query
     """
 
+    response = token_cache.get(token)
+
+    if response is not None:
+        return True, response
+
     try:
+        t0 = time.perf_counter()
         response = auth.verify_id_token(token)
+        verify_time = time.perf_counter() - t0
 
         if not response['email_verified']:
-            return False ('Not email verified', 401)
+            return False, ('Not email verified', 401)
+
+        token_cache.set(token, response, verify_time)
 
         return True, response
 
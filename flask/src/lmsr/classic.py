@@ -27,6 +27,17 @@ class LMSRMarketMaker:
         """
         return float(self.C(self.x + np.asarray(q)) - self.C(self.x))
 
+    def price_trades(self, qs: Union[list, np.ndarray]) -> np.ndarray:
+        """
+        The price of each of a set of trades, given as the rows of qs, evaluated in one pass. 
+        Equivalent to calling price_trade on each row
+        """
+
+        xs = self.x + np.asarray(qs, dtype=np.float64).reshape(-1, len(self.x))
+        xmax = xs.max(1, keepdims=True)
+
+        return xmax[:, 0] + self.b * np.log(np.exp((xs - xmax) / self.b).sum(1)) - self.C(self.x)
+
     def spot_value(self, q: Union[list, np.ndarray]) -> float:
         """
         Get the spot value for a quantity vector q
@@ -62,6 +73,18 @@ class LMSRMultiMarketMaker:
         else:
             return ((q * np.exp((self.xs - self.xmax) / self.bs)).sum(1) / np.exp((self.xs - self.xmax) / self.bs).sum(1)).reshape(-1)
 
+    def probabilities(self, aslist: bool=True) -> list:
+        """
+        The instantaneous price of each outcome at each time, as a T x N array
+        """
+
+        e = np.exp((self.xs - self.xmax) / self.bs)
+        p = e / e.sum(1, keepdims=True)
+
+        if aslist:
+            return p.tolist()
+        else:
+            return p
 
     def __repr__(self):
         return f'LMSRMultiMarketMaker({self.market})'
\ No newline at end of file
@@ -0,0 +1,115 @@
+import numpy as np
+from functools import lru_cache
+from typing import Union
+from .classic import LMSRMarketMaker, LMSRMultiMarketMaker
+from .long_short import LongShortMarketMaker, LongShortMultiMarketMaker
+
+
+PLAYER_LONG_QUANTITY = np.array([1.0, 0.0])
+PLAYER_SHORT_QUANTITY = np.array([0.0, 1.0])
+
+
+@lru_cache(maxsize=None)
+def team_long_quantity(n: int) -> np.ndarray:
+    """
+    The quantity vector representing the long contract for a team market with n outcomes. The
+    result is cached per n and returned read-only, so callers must not modify it in place
+    """
+
+    q = np.exp(-np.linspace(0, n - 1, n) / 6)[::-1]
+    q.setflags(write=False)
+    return q
+
+
+def long_price(market: str, current: dict) -> float:
+    """
+    The instantaneous price of the long contract for a market, given the current holdings
+    dict from redis, i.e. {'x': [...], 'b': b} for teams or {'N': N, 'b': b} for players
+    """
+
+    if 'x' in current:
+        return LMSRMarketMaker(market, current['x'], current['b']).spot_value(team_long_quantity(len(current['x'])))
+    else:
+        return LongShortMarketMaker(market, current['N'], current['b']).spot_value(PLAYER_LONG_QUANTITY)
+
+
+def long_price_series(market: str, qs: Union[list, np.ndarray], bs: Union[list, np.ndarray], team: bool) -> list:
+    """
+    The price of the long contract at a series of times. qs is a list of x vectors for teams,
+    or a list of Ns for players, and bs is the matching list of liquidity parameters
+    """
+
+    if len(qs) == 0:
+        return []
+
+    if team:
+        xs = np.asarray(qs)
+        return LMSRMultiMarketMaker(market, xs, bs).spot_value(team_long_quantity(xs.shape[1]))
+    else:
+        return LongShortMultiMarketMaker(market, qs, bs).spot_value(PLAYER_LONG_QUANTITY)
+
+
+def price_histories(all_hist: list, outcomes: bool=False) -> list:
+    """
+    Price series for the historical holdings of many markets at once. all_hist is a list of historical 
+    holdings dicts ({'x': {th: [...]}, 'b': {th: [...]}}, or 'N' in place of 'x', for any subset of 
+    timeframes), with None for missing markets. Return a matching list of {th: series}.
+
+    Each series is the long price at each time or, if outcomes is True, the price of each outcome at each 
+    time (the long and short contracts for players). Rather than pricing each market and timeframe 
+    separately, every team market with the same number of outcomes is priced in one LMSRMultiMarketMaker, 
+    and every player market in one LongShortMultiMarketMaker.
+    """
+
+    # (number of outcomes, or 0 for players) -> list of (market index, timeframe, qs, bs)
+    groups = {}
+
+    for i, hist in enumerate(all_hist):
+
+        if hist is None:
+            continue
+
+        k = 'x' if 'x' in hist else 'N'
+
+        for th, bs in hist['b'].items():
+            if len(bs) > 0:
+                n = len(hist['x'][th][0]) if k == 'x' else 0
+                groups.setdefault(n, []).append((i, th, hist[k][th], bs))
+
+    out = [{th: [] for th in hist['b']} if hist is not None else None for hist in all_hist]
+
+    for n, rows in groups.items():
+
+        qs = [q for i, th, qs, bs in rows for q in qs]
+        bs = [b for i, th, qs, bs in rows for b in bs]
+
+        if n > 0:
+            maker = LMSRMultiMarketMaker('batch', qs, bs)
+            prices = maker.probabilities(aslist=False) if outcomes else maker.spot_value(team_long_quantity(n), aslist=False)
+        else:
+            maker = LongShortMultiMarketMaker('batch', qs, bs)
+            long = maker.spot_value(PLAYER_LONG_QUANTITY, aslist=False)
+            prices = np.stack([long, 1 - long], axis=1) if outcomes else long
+
+        start = 0
+
+        for i, th, qs, bs in rows:
+            out[i][th] = prices[start:start + len(bs)].tolist()
+            start += len(bs)
+
+    return out
+
+
+def price_ladder(maker: Union[LMSRMarketMaker, LongShortMarketMaker], direction: Union[list, np.ndarray], sizes: Union[list, np.ndarray]) -> dict:
+    """
+    The cost of buying each of a list of sizes of the contract with quantity vector direction, from a 
+    market maker holding a market's current state. Negative sizes are sales. All sizes are priced in one 
+    vectorized call, and the market maker is not changed. Return 
+
+        {'sizes': [...], 'costs': [...], 'spot': spot price of direction}
+    """
+
+    sizes = np.asarray(sizes, dtype=np.float64)
+    qs = sizes.reshape(-1, 1) * np.asarray(direction, dtype=np.float64).reshape(1, -1)
+
+    return {'sizes': sizes.tolist(), 'costs': maker.price_trades(qs).tolist(), 'spot': maker.spot_value(direction)}
@@ -16,7 +16,7 @@ class LongShortMarketMaker:
         
         if k == 0:
             self.long_price = 0.5
-        if k > 0:
+        elif k > 0:
             self.long_price = ((k - 1) + np.exp(-k)) / (k * (1 - np.exp(-k)))
         else:
             self.long_price = (np.exp(k) * (k - 1) + 1) / (k * (np.exp(k) - 1))
@@ -28,39 +28,51 @@ class LongShortMarketMaker:
         """
         Price a trade for vector quantity q, where q[0] is the number of longs and q[1] is the number of shorts
         """
+        return float(self.price_trades([q])[0])
+
+    def price_trades(self, qs: Union[list, np.ndarray]) -> np.ndarray:
+        """
+        Price each of a set of trades, given as the rows of qs, in one pass. Each row is a vector quantity 
+        as in price_trade
+        """
+
+        qs = np.asarray(qs, dtype=np.float64).reshape(-1, 2)
+
+        return self._long_cost(qs[:, 0]) + qs[:, 1] + self._long_cost(-qs[:, 1])
+
+    def _long_cost(self, n: np.ndarray) -> np.ndarray:
+        """
+        price of going long with each of an array of n units on player
+        """
 
         N = self.N
         b = self.b
-        
-        def f(n):
-            """
-            price of going long with n units on player
-            """
-
-            if n == 0:
-                return 0
-
-            elif N == 0:
-                if n < 0:
-                    return b * np.log(b * (np.exp(n / b) - 1) / n) 
-                else:
-                    return b * np.log(b * (1 - np.exp(-n / b)) / (n * np.exp(-n / b)))
-
-            elif N < 0:
-                if N == -n:
-                    return b * np.log(N / (b *  (np.exp(N / b) - 1)))
-                else:
-                    return b * np.log(N / (N + n) * (np.exp((N + n) / b) - 1) / (np.exp(N / b) - 1))
-
-            elif N > 0:
-                if N == -n:
-                    return b * np.log(N * np.exp(-N / b) / (b *  (1 - np.exp(-N / b))))
-                else:
-                    return b * np.log(N / (N + n) * (np.exp(n / b) - np.exp(-N / b)) / (1 - np.exp(-N / b)))
-            else:
-                raise ValueError(f'N ({N}, type {type(N)}) not an acceptable value')
-                
-        return float(f(q[0]) + q[1] + f(-q[1]))
+
+        out = np.zeros_like(n)
+        nz = n != 0
+
+        if N == 0:
+            neg = nz & (n < 0)
+            pos = nz & (n > 0)
+            out[neg] = b * np.log(b * (np.exp(n[neg] / b) - 1) / n[neg])
+            out[pos] = b * np.log(b * (1 - np.exp(-n[pos] / b)) / (n[pos] * np.exp(-n[pos] / b)))
+
+        elif N < 0:
+            edge = nz & (N == -n)
+            rest = nz & ~edge
+            out[edge] = b * np.log(N / (b *  (np.exp(N / b) - 1)))
+            out[rest] = b * np.log(N / (N + n[rest]) * (np.exp((N + n[rest]) / b) - 1) / (np.exp(N / b) - 1))
+
+        elif N > 0:
+            edge = nz & (N == -n)
+            rest = nz & ~edge
+            out[edge] = b * np.log(N * np.exp(-N / b) / (b *  (1 - np.exp(-N / b))))
+            out[rest] = b * np.log(N / (N + n[rest]) * (np.exp(n[rest] / b) - np.exp(-N / b)) / (1 - np.exp(-N / b)))
+
+        else:
+            raise ValueError(f'N ({N}, type {type(N)}) not an acceptable value')
+
+        return out
 
     def spot_value(self, q: Union[list, np.ndarray]) -> float:
         """
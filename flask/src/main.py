@@ -3,20 +3,31 @@ import os
 import logging
 import time
 
-from src.firebase.data import add_new_portfolio
-from flask import Flask, request, jsonify
+from src.firebase.data import add_new_portfolio, get_portfolio
+from flask import Flask, Response, request, jsonify
 import orjson
 import shutil
 
 # LOAD THIS FIRST TO ACCESS FIREBASE STUFF
-from src.firebase.authentication import verify_user_token, verify_admin
+from src.firebase.authentication import verify_user_token, verify_admin, token_cache
 
 from src.redis_utils.init_redis_db import init_redis_f
 from src.redis_utils.update import  update_b_redis
 import src.redis_utils.read_data as read_data
 from src.redis_utils.exceptions import ResourceNotFoundError
+from src.redis_utils.registry import MarketRegistry
+from src.redis_utils.connection import replicas, shards, pool_stats
+from src.redis_utils.epoch_cache import EpochCache
+from src.redis_utils.versions import get_changes_since, holdings_etag, history_etag
+from src.redis_utils.price_feed import PriceFeed
+from src.redis_utils.ohlc import get_candles
+from src.redis_utils.encodings import choose_encoding, compress, wants_msgpack, to_msgpack, MSGPACK_MIMETYPE
 from src.transactions.purchase_form import ConfirmationForm, ConfirmationFormError, PurchaseForm, PurchaseFormError, TransactionError
 from src.transactions.make_purchase import make_purchase
+from src.lmsr.classic import LMSRMarketMaker
+from src.lmsr.contracts import price_histories, price_ladder, team_long_quantity, PLAYER_LONG_QUANTITY, PLAYER_SHORT_QUANTITY
+from src.markets.portfolio import value_portfolio
+from src.markets.markets import _MarketCollection
 
 BASE_DIR='/var/www'
 
@@ -26,6 +37,71 @@ logging.basicConfig(format='%(asctime)s %(threadName)s %(levelname)s %(message)s
                     level=logging.INFO)
 
 app = Flask(__name__)
+registry = MarketRegistry()
+
+# serialized /historical_holdings responses, valid until the scheduler publishes a new history epoch
+history_cache = EpochCache(maxsize=256)
+
+# serialized /portfolio_value responses, valid until the next history epoch
+portfolio_cache = EpochCache(maxsize=1024)
+
+# fans out live price updates to /price_stream clients connected to this process
+price_feed = PriceFeed()
+
+
+def json_response(body: bytes, etag: str=None):
+    """
+    Wrap an already serialized JSON body in a response. The holdings endpoints use this to send the
+    JSON stored in Redis as it is, rather than parsing it and encoding it again
+    """
+
+    response = app.response_class(body, mimetype='application/json')
+
+    if etag is not None:
+        response.set_etag(etag)
+
+    return response
+
+
+def msgpack_response(body: bytes, etag: str=None):
+    """
+    As json_response, for a body already serialized with to_msgpack
+    """
+
+    response = app.response_class(body, mimetype=MSGPACK_MIMETYPE)
+
+    if etag is not None:
+        response.set_etag(etag)
+
+    response.vary.add('Accept')
+
+    return response
+
+
+def history_response(body: bytes, etag: str, encoding: str=None, fmt: str='json'):
+    """
+    A /historical_holdings response, for a JSON body that may have been compressed with encoding or a msgpack body
+    """
+
+    response = msgpack_response(body, etag) if fmt == 'msgpack' else json_response(body, etag)
+    response.vary.add('Accept-Encoding')
+
+    if encoding is not None:
+        response.content_encoding = encoding
+
+    return response
+
+
+def not_modified(etag: str):
+    """
+    An empty 304 response for a request whose If-None-Match header matches etag
+    """
+
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+
+    return response
+
 
 @app.route('/privacy_policy', methods=['GET'])
 def privacy():
@@ -43,10 +119,14 @@ def current_holdings():
     """
     Endpoint for querying the latest quantity vector and liquidity parameter
         * Requires JWT Authorization header.
+        * Supports conditional requests. The ETag changes whenever one of the markets is traded, 
+          and a request with a matching If-None-Match header gets an empty 304 response.
         * Market should be specified in EITHER 'market' url argument, with a single market id
           e.g. https://engine.sportfolios.co.uk/spot_quantities?market=1:8:18378T
           OR a 'markets' url parameter, with multiple markets specified
           e.g.  https://engine.sportfolios.co.uk/spot_quantities?markets=1:8:18378T,1182:8:18378P
+        * Responds with msgpack rather than JSON if the Accept header asks for application/msgpack (see 
+          redis_utils.encodings.to_msgpack)
         
     Returns:
         JSON response: e.g. 
@@ -74,28 +154,59 @@ def current_holdings():
  
     elif market is None:
         
-        markets_list = list(set([m for m in markets.split(',') if m != '']))
+        markets_list = sorted(set([m for m in markets.split(',') if m != '']))
         if len(markets_list) > 100:
             return 'Request has exceeded markets limit. ', 400
 
-        result = read_data.get_multiple_latest_quantities(markets_list)
+        fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+
+        # served from the cache, which evicts what a purchase in this process writes and is otherwise kept in 
+        # step by invalidations. The etag is taken from the versions read along with the holdings
+        raws, versions = read_data.get_latest_raws(markets_list)
+        etag = holdings_etag(markets_list, versions, fmt)
+        if request.if_none_match.contains(etag):
+            logging.info(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; not modified; {markets}')
+            return not_modified(etag)
+
+        missing = [m for m, raw in zip(markets_list, raws) if raw is None]
+
+        if fmt == 'msgpack':
+            data = {m: orjson.loads(raw) if raw is not None else None for m, raw in zip(markets_list, raws)}
+        else:
+            body = read_data.splice_json(zip(markets_list, raws))
+
         logging.info(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; success; {markets}')
-        for m, quantity in result.items():
-            if quantity is None:
-                logging.warn(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; warning; {m} is missing from Redis')
-        return jsonify(result), 200
+        for m in missing:
+            logging.warn(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; warning; {m} is missing from Redis')
+
+        if fmt == 'msgpack':
+            return msgpack_response(to_msgpack(data), etag), 200
+
+        return json_response(body, etag), 200
 
     elif markets is None:
 
-        try:
-            result = read_data.get_latest_quantities(market)
-            logging.info(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; success; {market}')
-            return jsonify(result), 200
+        fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
 
-        except ResourceNotFoundError:
+        (raw, ), (version, ) = read_data.get_latest_raws([market])
+
+        if raw is None:
             logging.warn(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; fail; Unknown market specified {market}')
             return f'Market {market} does not exist', 404
 
+        etag = holdings_etag([market], [version], fmt)
+        if request.if_none_match.contains(etag):
+            logging.info(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; not modified; {market}')
+            return not_modified(etag)
+
+        if fmt == 'msgpack':
+            response = msgpack_response(to_msgpack(orjson.loads(raw)), etag)
+        else:
+            response = json_response(raw, etag)
+
+        logging.info(f'GET; current_holdings; {info["user_id"]}; {remote_ip}; success; {market}')
+        return response, 200
+
     else:
         return 'market and markets specified', 400
 
@@ -106,6 +217,16 @@ def historical_holdings():
     """
     Endpoint for querying the historical quantity vector and liquidity parameter
         * Requires JWT Authorization header.
+        * Responses are cached in memory until the scheduler publishes the next history epoch.
+        * Supports conditional requests. The ETag changes with the history epoch, and a request with 
+          a matching If-None-Match header gets an empty 304 response.
+        * Responses are compressed with brotli or gzip when the Accept-Encoding header allows. Single market
+          responses are compressed by the scheduler once per tick. 
+        * Responds with msgpack rather than JSON if the Accept header asks for application/msgpack (see 
+          redis_utils.encodings.to_msgpack). msgpack responses are not compressed.
+        * Optionally, the response can be limited to some horizons with a 'horizons' url argument, and to 
+          entries between two unix timestamps (inclusive) with 'from' and 'to' url arguments
+          e.g. https://engine.sportfolios.co.uk/historical_holdings?market=1:8:18378T&horizons=d,w&from=1620000000
         * Market should be specified in 'market' url argument, with a single market id
         e.g. https://engine.sportfolios.co.uk/historical_quantities?market=T1:8:17420
 
@@ -137,33 +258,657 @@ def historical_holdings():
         logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; fail; No market specified')
         return 'No market specified', 400
 
+    elif market is not None and markets is not None:
+        return 'market and markets specified', 400
+
+    elif any(arg in request.args for arg in ['horizons', 'from', 'to']):
+        return projected_historical_holdings(info, remote_ip, market, markets)
+
     elif market is None:
 
-        markets_list = list(set([m for m in markets.split(',') if m != '']))
+        markets_list = sorted(set([m for m in markets.split(',') if m != '']))
         if len(markets_list) > 100:
             return 'Request has exceeded markets limit. ', 400
 
-        result = read_data.get_multiple_historical_quantities(markets_list)
-        logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; success; {markets}')
-        for m, quantity in result.items():
-            if quantity is None:
+        fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+        encoding = choose_encoding(request.accept_encodings) if fmt == 'json' else None
+        epoch = read_data.get_history_epoch()
+        etag = history_etag(markets_list, epoch, encoding, fmt)
+        if request.if_none_match.contains(etag):
+            logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; not modified; {markets}')
+            return not_modified(etag)
+
+        key = ('markets', tuple(markets_list), encoding, fmt)
+        body = history_cache.get(key, epoch)
+
+        if body is None:
+
+            if fmt == 'msgpack':
+                data, epoch = read_data.get_multiple_historical_quantities(markets_list)
+                missing = [m for m, hist in data['data'].items() if hist is None]
+                body = to_msgpack(data)
+            else:
+                body, epoch, missing = read_data.get_multiple_historical_quantities_raw(markets_list)
+
+            for m in missing:
                 logging.warn(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; warning; {m}:hist is missing from Redis')
-        return jsonify(result), 200
+
+            if encoding is not None:
+                body = compress(body, encoding)
+
+            history_cache.set(key, epoch, body)
+            etag = history_etag(markets_list, epoch, encoding, fmt)
+
+        logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; success; {markets}')
+        return history_response(body, etag, encoding, fmt), 200
 
     elif markets is None:
 
-        try:
-            result = read_data.get_historical_quantities(market)
-            logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; success; {market}')
-            return jsonify(result), 200
+        fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+        encoding = choose_encoding(request.accept_encodings) if fmt == 'json' else None
+        epoch = read_data.get_history_epoch()
+        etag = history_etag([market], epoch, encoding, fmt)
+        if request.if_none_match.contains(etag):
+            logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; not modified; {market}')
+            return not_modified(etag)
 
-        except ResourceNotFoundError:
-            logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; fail; Unknown market specified {market}')
-            return f'Market {market} does not exist', 404
+        key = ('market', market, encoding, fmt)
+        body = history_cache.get(key, epoch)
+
+        if body is None:
+
+            if encoding is not None:
+                body, epoch = read_data.get_historical_quantities_compressed(market, encoding)
+
+            if body is None:
+
+                try:
+                    if fmt == 'msgpack':
+                        data, epoch = read_data.get_historical_quantities(market)
+                        body = to_msgpack(data)
+                    else:
+                        body, epoch = read_data.get_historical_quantities_raw(market)
+                except ResourceNotFoundError:
+                    logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; fail; Unknown market specified {market}')
+                    return f'Market {market} does not exist', 404
+
+                # no pre-compressed response yet, e.g. for a market created since the last tick
+                if encoding is not None:
+                    body = compress(body, encoding)
+
+            history_cache.set(key, epoch, body)
+            etag = history_etag([market], epoch, encoding, fmt)
+
+        logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; success; {market}')
+        return history_response(body, etag, encoding, fmt), 200
+
+
+
+def parse_projection() -> tuple:
+    """
+    Read the optional 'horizons', 'from' and 'to' url arguments, returning the list of horizons in the 
+    order of read_data.HORIZONS, and the from and to timestamps or None. Raise a ValueError with a 
+    message for the client if they are malformed
+    """
+
+    horizons = request.args.get('horizons')
+
+    if horizons is None:
+        horizons_list = read_data.HORIZONS
 
     else:
+        horizons_list = [th for th in read_data.HORIZONS if th in horizons.split(',')]
+        if len(horizons_list) == 0 or any(th not in read_data.HORIZONS for th in horizons.split(',')):
+            raise ValueError(f'horizons must be a comma separated list from {read_data.HORIZONS}')
+
+    try:
+        t_from = int(request.args['from']) if 'from' in request.args else None
+        t_to = int(request.args['to']) if 'to' in request.args else None
+    except ValueError:
+        raise ValueError('from and to must be integer timestamps')
+
+    return horizons_list, t_from, t_to
+
+
+def projected_historical_holdings(info: dict, remote_ip: str, market: str, markets: str):
+    """
+    /historical_holdings for requests with 'horizons', 'from' or 'to' url arguments. The response has the 
+    same form as the full one, but with only the requested horizons, and only the entries of each whose 
+    timestamps are between from and to.
+    """
+
+    try:
+        horizons_list, t_from, t_to = parse_projection()
+    except ValueError as E:
+        return str(E), 400
+
+    markets_list = [market] if market is not None else sorted(set([m for m in markets.split(',') if m != '']))
+    if len(markets_list) > 100:
+        return 'Request has exceeded markets limit. ', 400
+
+    fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+    encoding = choose_encoding(request.accept_encodings) if fmt == 'json' else None
+    projection = (tuple(horizons_list), t_from, t_to)
+
+    epoch = read_data.get_history_epoch()
+    etag = history_etag(markets_list, epoch, encoding, fmt, projection)
+    if request.if_none_match.contains(etag):
+        logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; not modified; {market or markets} {projection}')
+        return not_modified(etag)
+
+    key = ('projection', tuple(markets_list), encoding, fmt, projection)
+    body = history_cache.get(key, epoch)
+
+    if body is None:
+
+        all_hist, time, epoch = read_data.get_historical_quantities_projected(markets_list, horizons_list, t_from, t_to)
+
+        if market is not None:
+            if all_hist[0] is None:
+                logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; fail; Unknown market specified {market}')
+                return f'Market {market} does not exist', 404
+            data = {'data': all_hist[0], 'time': time}
+        else:
+            data = {'data': dict(zip(markets_list, all_hist)), 'time': time}
+
+        body = to_msgpack(data) if fmt == 'msgpack' else orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+
+        if encoding is not None:
+            body = compress(body, encoding)
+
+        history_cache.set(key, epoch, body)
+        etag = history_etag(markets_list, epoch, encoding, fmt, projection)
+
+    logging.info(f'GET; historical_holdings; {info["user_id"]}; {remote_ip}; success; {market or markets} {projection}')
+    return history_response(body, etag, encoding, fmt), 200
+
+
+@app.route('/price_history', methods=['GET'])
+def price_history():
+    """
+    Endpoint for querying the price history of markets, computed from the historical holdings
+        * Requires JWT Authorization header.
+        * Markets should be specified in EITHER a 'market' url argument, with a single market id, OR a 'markets' 
+          url argument, with up to 100 comma separated market ids
+        * Optionally, 'contract=outcomes' gives the price of each outcome (long and short for players) rather 
+          than the default, 'contract=long', the long contract
+        * Accepts the same 'horizons', 'from' and 'to' url arguments as /historical_holdings
+        * Like /historical_holdings, responses are cached until the next history epoch, support conditional 
+          requests, and can be compressed or sent as msgpack
+        e.g. https://engine.sportfolios.co.uk/price_history?market=1:8:18378T&horizons=d
+
+    Returns:
+        JSON response: e.g. 
+                    for market  {'data': {'d': [3.51, 3.52, ...], ...}, 'time': {'d': [t1, t2, ...], ...}}
+                    for markets {'data': {'1:8:18378T': {'d': [3.51, 3.52, ...], ...}, ...}, 'time': {...}}
+        with a list of outcome prices in place of each price for contract=outcomes
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; price_history; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    market = request.args.get('market')
+    markets = request.args.get('markets')
+
+    if market is None and markets is None:
+        logging.info(f'GET; price_history; {info["user_id"]}; {remote_ip}; fail; No market specified')
+        return 'No market specified', 400
+
+    elif market is not None and markets is not None:
         return 'market and markets specified', 400
 
+    contract = request.args.get('contract', 'long')
+    if contract not in ['long', 'outcomes']:
+        return 'contract must be long or outcomes', 400
+
+    try:
+        horizons_list, t_from, t_to = parse_projection()
+    except ValueError as E:
+        return str(E), 400
+
+    markets_list = [market] if market is not None else sorted(set([m for m in markets.split(',') if m != '']))
+    if len(markets_list) > 100:
+        return 'Request has exceeded markets limit. ', 400
+
+    fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+    encoding = choose_encoding(request.accept_encodings) if fmt == 'json' else None
+    projection = (contract, tuple(horizons_list), t_from, t_to)
+
+    epoch = read_data.get_history_epoch()
+    etag = history_etag(markets_list, epoch, encoding, fmt, projection)
+    if request.if_none_match.contains(etag):
+        logging.info(f'GET; price_history; {info["user_id"]}; {remote_ip}; not modified; {market or markets}')
+        return not_modified(etag)
+
+    key = ('price_history', tuple(markets_list), encoding, fmt, projection)
+    body = history_cache.get(key, epoch)
+
+    if body is None:
+
+        # long prices are precomputed in the history snapshot, if it is up to date
+        snapshot_prices = read_data.get_long_prices_projected(markets_list, horizons_list, t_from, t_to) if contract == 'long' else None
+
+        if snapshot_prices is not None:
+            all_prices, time, epoch = snapshot_prices
+        else:
+            all_hist, time, epoch = read_data.get_historical_quantities_projected(markets_list, horizons_list, t_from, t_to)
+            all_prices = price_histories(all_hist, outcomes=contract == 'outcomes')
+
+        if market is not None:
+            if all_prices[0] is None:
+                logging.info(f'GET; price_history; {info["user_id"]}; {remote_ip}; fail; Unknown market specified {market}')
+                return f'Market {market} does not exist', 404
+            data = {'data': all_prices[0], 'time': time}
+        else:
+            data = {'data': dict(zip(markets_list, all_prices)), 'time': time}
+
+        body = to_msgpack(data) if fmt == 'msgpack' else orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+
+        if encoding is not None:
+            body = compress(body, encoding)
+
+        history_cache.set(key, epoch, body)
+        etag = history_etag(markets_list, epoch, encoding, fmt, projection)
+
+    logging.info(f'GET; price_history; {info["user_id"]}; {remote_ip}; success; {market or markets}')
+    return history_response(body, etag, encoding, fmt), 200
+
+
+@app.route('/candles', methods=['GET'])
+def candles():
+    """
+    Endpoint for querying the open, high, low and close long price of markets over each interval of each horizon
+        * Requires JWT Authorization header.
+        * Markets should be specified in EITHER a 'market' url argument, with a single market id, OR a 'markets' 
+          url argument, with up to 100 comma separated market ids
+        * Accepts the same 'horizons', 'from' and 'to' url arguments as /historical_holdings, where from and to 
+          select candles by the time they opened
+        * Candles are updated by every trade, so responses are not cached
+        e.g. https://engine.sportfolios.co.uk/candles?market=1:8:18378T&horizons=d
+
+    Returns:
+        JSON response: e.g. 
+                    for market  {'d': {'t': [t1, t2, ...], 'o': [...], 'h': [...], 'l': [...], 'c': [...]}, ...}
+                    for markets {'1:8:18378T': {'d': {'t': [t1, t2, ...], 'o': [...], ...}, ...}, ...}
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; candles; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    market = request.args.get('market')
+    markets = request.args.get('markets')
+
+    if market is None and markets is None:
+        logging.info(f'GET; candles; {info["user_id"]}; {remote_ip}; fail; No market specified')
+        return 'No market specified', 400
+
+    elif market is not None and markets is not None:
+        return 'market and markets specified', 400
+
+    try:
+        horizons_list, t_from, t_to = parse_projection()
+    except ValueError as E:
+        return str(E), 400
+
+    markets_list = [market] if market is not None else sorted(set([m for m in markets.split(',') if m != '']))
+    if len(markets_list) > 100:
+        return 'Request has exceeded markets limit. ', 400
+
+    all_candles = get_candles(markets_list, horizons_list, t_from, t_to)
+    data = all_candles[0] if market is not None else dict(zip(markets_list, all_candles))
+
+    logging.info(f'GET; candles; {info["user_id"]}; {remote_ip}; success; {market or markets}')
+
+    if wants_msgpack(request.accept_mimetypes):
+        return msgpack_response(to_msgpack(data)), 200
+
+    return json_response(orjson.dumps(data)), 200
+
+
+@app.route('/portfolio_value', methods=['GET'])
+def portfolio_value():
+    """
+    Endpoint for querying the value of a portfolio, now and over time
+        * Requires JWT Authorization header. The portfolio must be public or belong to the user.
+        * The portfolio should be specified in a 'portfolioId' url argument
+        * Accepts the same 'horizons', 'from' and 'to' url arguments as /historical_holdings
+        * Responses are cached until the next history epoch, or until the portfolio makes another transaction
+        e.g. https://engine.sportfolios.co.uk/portfolio_value?portfolioId=Jmd2i8pYzDK1dIFUwsLw&horizons=d
+
+    Returns:
+        JSON response: e.g. {'current_value': 512.3, 
+                             'current_values': {'1:8:18378T': 12.1, ...}, 
+                             'hist_value': {'d': [500, 501.2, ...], ...}, 
+                             'time': {'d': [t1, t2, ...], ...}}
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; portfolio_value; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    portfolioId = request.args.get('portfolioId')
+
+    if portfolioId is None:
+        logging.info(f'GET; portfolio_value; {info["user_id"]}; {remote_ip}; fail; No portfolio specified')
+        return 'No portfolio specified', 400
+
+    try:
+        horizons_list, t_from, t_to = parse_projection()
+    except ValueError as E:
+        return str(E), 400
+
+    portfolio = get_portfolio(portfolioId)
+
+    if portfolio is None or not (portfolio.get('public', False) or portfolio['user'] == info['uid']):
+        logging.info(f'GET; portfolio_value; {info["user_id"]}; {remote_ip}; fail; Unknown portfolio specified {portfolioId}')
+        return f'Portfolio {portfolioId} does not exist', 404
+
+    fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+    epoch = read_data.get_history_epoch()
+
+    # a transaction changes the portfolio's holdings, so the number of transactions versions the portfolio
+    key = (portfolioId, len(portfolio['transactions']), fmt, tuple(horizons_list), t_from, t_to)
+    body = portfolio_cache.get(key, epoch)
+
+    if body is None:
+
+        markets_list = sorted(set([transaction['market'] for transaction in portfolio['transactions']] + list(portfolio['holdings'].keys())))
+
+        currents = read_data.get_multiple_latest_quantities(markets_list)
+        all_hist, time, epoch = read_data.get_historical_quantities_projected(markets_list, horizons_list, t_from, t_to)
+        all_hist = dict(zip(markets_list, all_hist))
+
+        missing = [m for m in markets_list if currents[m] is None or all_hist[m] is None]
+        if len(missing) > 0:
+            logging.error(f'GET; portfolio_value; {info["user_id"]}; {remote_ip}; fail; {missing} missing from Redis')
+            return f'Markets {missing} are missing', 500
+
+        data = value_portfolio(portfolio, currents, all_hist, time)
+        body = to_msgpack(data) if fmt == 'msgpack' else orjson.dumps(data)
+
+        portfolio_cache.set(key, epoch, body)
+
+    logging.info(f'GET; portfolio_value; {info["user_id"]}; {remote_ip}; success; {portfolioId}')
+
+    if fmt == 'msgpack':
+        return msgpack_response(body), 200
+
+    return json_response(body), 200
+
+
+@app.route('/league_prices', methods=['GET'])
+def league_prices():
+    """
+    Endpoint for querying the back price of every market in a league
+        * Requires JWT Authorization header.
+        * The league id should be specified in a 'league' url argument
+        * Prices are computed once per history epoch, and cached until the next one, so current prices 
+          may be up to one tick old
+        e.g. https://engine.sportfolios.co.uk/league_prices?league=8
+
+    Returns:
+        JSON response: e.g. {'current': {'1:8:18378T': 3.52, ...},
+                             'daily': {'1:8:18378T': [3.41, 3.45, ...], ...},
+                             'time': [t1, t2, ...]}
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; league_prices; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    league = request.args.get('league')
+
+    if league is None:
+        logging.info(f'GET; league_prices; {info["user_id"]}; {remote_ip}; fail; No league specified')
+        return 'No league specified', 400
+
+    markets_list = registry.teams(league) + registry.players(league)
+
+    if len(markets_list) == 0:
+        logging.info(f'GET; league_prices; {info["user_id"]}; {remote_ip}; fail; Unknown league specified {league}')
+        return f'League {league} does not exist', 404
+
+    fmt = 'msgpack' if wants_msgpack(request.accept_mimetypes) else 'json'
+    epoch = read_data.get_history_epoch()
+
+    key = ('league_prices', league, fmt)
+    body = history_cache.get(key, epoch)
+
+    if body is None:
+
+        collection = _MarketCollection(markets_list)
+        daily, time = collection.daily_back_prices()
+        data = {'current': collection.current_back_prices(), 'daily': daily, 'time': time}
+
+        body = to_msgpack(data) if fmt == 'msgpack' else orjson.dumps(data)
+        history_cache.set(key, epoch, body)
+
+    logging.info(f'GET; league_prices; {info["user_id"]}; {remote_ip}; success; {league}')
+
+    if fmt == 'msgpack':
+        return msgpack_response(body), 200
+
+    return json_response(body), 200
+
+
+@app.route('/quote_ladder', methods=['GET'])
+def quote_ladder():
+    """
+    Endpoint for querying the cost of a range of trade sizes in one market, against its current holdings
+        * Requires JWT Authorization header.
+        * The market should be specified in a 'market' url argument
+        * The contract should be specified in a 'direction' url argument. This is 'long' (the default), 
+          'short' (player markets only), or a comma separated quantity vector, in the form used by /purchase
+        * Up to 100 comma separated sizes should be specified in a 'sizes' url argument. Each trade is 
+          the direction multiplied by the size, so negative sizes quote selling
+        * Nothing is written to Redis, and quotes are not reserved. Use /purchase to trade
+        e.g. https://engine.sportfolios.co.uk/quote_ladder?market=1:8:18378T&sizes=1,2,5,10,20
+
+    Returns:
+        JSON response: e.g. {'sizes': [1, 2, 5, ...], 'costs': [3.52, 7.05, 17.7, ...], 'spot': 3.52}
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; quote_ladder; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    market = request.args.get('market')
+    direction = request.args.get('direction', 'long')
+    sizes = request.args.get('sizes')
+
+    if market is None:
+        logging.info(f'GET; quote_ladder; {info["user_id"]}; {remote_ip}; fail; No market specified')
+        return 'No market specified', 400
+
+    if sizes is None:
+        return 'No sizes specified', 400
+
+    try:
+        sizes_list = [float(size) for size in sizes.split(',') if size != '']
+    except ValueError:
+        return 'sizes should be comma separated numbers', 400
+
+    if len(sizes_list) > 100:
+        return 'Request has exceeded sizes limit. ', 400
+
+    try:
+        maker = read_data.get_market_maker(market)
+    except ResourceNotFoundError:
+        logging.info(f'GET; quote_ladder; {info["user_id"]}; {remote_ip}; fail; Unknown market specified {market}')
+        return f'Market {market} does not exist', 404
+
+    team = isinstance(maker, LMSRMarketMaker)
+    n = len(maker.x) if team else 2
+
+    if direction == 'long':
+        q = team_long_quantity(n) if team else PLAYER_LONG_QUANTITY
+    elif direction == 'short' and not team:
+        q = PLAYER_SHORT_QUANTITY
+    else:
+        try:
+            q = [float(qi) for qi in direction.split(',')]
+        except ValueError:
+            return 'direction should be long, short, or a comma separated quantity vector', 400
+
+        if len(q) != n:
+            return f'direction should have length {n} for market {market}', 400
+
+    data = price_ladder(maker, q, sizes_list)
+
+    logging.info(f'GET; quote_ladder; {info["user_id"]}; {remote_ip}; success; {market}')
+
+    if wants_msgpack(request.accept_mimetypes):
+        return msgpack_response(to_msgpack(data)), 200
+
+    return json_response(orjson.dumps(data)), 200
+
+
+@app.route('/holdings_since', methods=['GET'])
+def holdings_since():
+    """
+    Endpoint for querying the latest quantities of only those markets that have changed since a given version
+        * Requires JWT Authorization header.
+        * The version should be specified in the 'version' url argument. This is the version returned by the 
+          previous call, or 0 to get every market that has ever been traded
+          e.g. https://engine.sportfolios.co.uk/holdings_since?version=10345
+        * Optionally, a 'league' url argument restricts the response to markets from that league
+
+    Returns:
+        JSON response: e.g. {'version': 10391, 
+                             'data': {'1:8:18378T': {'b': 4000, 'x': [1, 2, 3]}, '1182:8:18378P': {'b': 2000, 'N': 400}}}
+
+        At most 500 changed markets are returned, oldest change first. If more have changed, the returned version 
+        is that of the last market included, so calling again with it picks up the rest. 
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; holdings_since; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    try:
+        version = int(request.args.get('version'))
+    except (TypeError, ValueError):
+        logging.info(f'GET; holdings_since; {info["user_id"]}; {remote_ip}; fail; Malformed version')
+        return 'A valid version must be specified', 400
+
+    league = request.args.get('league')
+
+    markets_list, versions, new_version = get_changes_since(version, limit=500)
+
+    if league is not None:
+        versions = [v for m, v in zip(markets_list, versions) if m.split(':')[1] == league]
+        markets_list = [m for m in markets_list if m.split(':')[1] == league]
+
+    data, missing = read_data.get_multiple_latest_quantities_raw(markets_list, versions)
+    logging.info(f'GET; holdings_since; {info["user_id"]}; {remote_ip}; success; {version} -> {new_version}, {len(markets_list)} markets')
+
+    return json_response(read_data.splice_json([('version', str(new_version).encode()), ('data', data)])), 200
+
+
+@app.route('/price_stream', methods=['GET'])
+def price_stream():
+    """
+    Server-sent event stream of live price updates
+        * Requires JWT Authorization header.
+        * Markets should be specified in a 'markets' url parameter, e.g.
+          https://engine.sportfolios.co.uk/price_stream?markets=1:8:18378T,1182:8:18378P
+        * This is served by the flask_stream program (see services.conf), so that open streams do not 
+          tie up the workers serving the other endpoints
+
+    Each event is a JSON price update, sent whenever one of the markets is traded. e.g. 
+        data: {"v": 10392, "m": "1:8:18378T", "p": 3.52, "x": [1, 2, 3], "b": 4000}
+
+    where v is the market's new version (see /holdings_since) and p is the long price. A comment is sent every
+    15s to keep the connection open. If the client stops reading, the stream is closed and it should reconnect 
+    and fetch /current_holdings to catch up. 
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    authorised, info = verify_user_token(request.headers.get('Authorization'))
+    remote_ip = request.environ.get('HTTP_X_REAL_IP', request.remote_addr)
+
+    if not authorised:
+        message, code = info
+        logging.info(f'GET; price_stream; unknown; {remote_ip}; fail; {info}')
+        return message, code
+
+    markets = request.args.get('markets')
+
+    if markets is None:
+        logging.info(f'GET; price_stream; {info["user_id"]}; {remote_ip}; fail; No market specified')
+        return 'No market specified', 400
+
+    markets_list = list(set([m for m in markets.split(',') if m != '']))
+    if len(markets_list) > 100:
+        return 'Request has exceeded markets limit. ', 400
+
+    subscription = price_feed.subscribe(markets_list)
+    logging.info(f'GET; price_stream; {info["user_id"]}; {remote_ip}; success; {markets}')
+
+    def stream():
+
+        try:
+            yield b'retry: 5000\n\n'
+
+            while not subscription.closed:
+
+                message = subscription.get(timeout=15)
+
+                if message is None:
+                    yield b': keepalive\n\n'
+                else:
+                    yield b'data: ' + message + b'\n\n'
+
+        finally:
+            price_feed.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/purchase', methods=['POST'])
@@ -186,6 +931,8 @@ def purchase():
     Returns:
         if price is agreed,     JSON: {'success': True,  'price': sealed_price, 'cancelId': None}
         if price is not agreed, JSON: {'success': False, 'price': sealed_price, 'cancelId': id}
+
+        or the same in msgpack, if the Accept header asks for application/msgpack
     """
 
     if request.headers.get('Authorization') is None:
@@ -206,11 +953,16 @@ def purchase():
         return f'Invalid purchase form: {E}', 400
 
     try:
-        return purchase_form.attempt_purchase(), 200
+        result = purchase_form.attempt_purchase()
     except TransactionError as E:
         logging.warning(f'Transaction failed: {E}')
         return f'Transaction failed: {E}', 400
 
+    if isinstance(result, dict) and wants_msgpack(request.accept_mimetypes):
+        return msgpack_response(to_msgpack(result)), 200
+
+    return result, 200
+
 
 @app.route('/confirm_order', methods=['POST'])
 def confirm_order():
@@ -392,6 +1144,92 @@ def update_ms():
     return 'Success', 200
 
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    Hit and miss counts for the in-memory caches of this worker
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    success, message = verify_admin(request.headers.get('Authorization'))
+
+    if not success:
+        return message
+
+    return jsonify({'pid': os.getpid(),
+                    'tokens': token_cache.stats(),
+                    'current_holdings': read_data.holdings_cache.stats(),
+                    'history_snapshot': read_data.history_snapshot.stats(),
+                    'redis_replicas': replicas.stats(),
+                    'redis_shards': shards.stats(),
+                    'redis_pools': pool_stats(),
+                    'historical_holdings': history_cache.stats(),
+                    'portfolio_value': portfolio_cache.stats(),
+                    'price_feed': price_feed.stats()}), 200
+
+
+@app.route('/register_markets', methods=['POST'])
+def register_markets():
+    """
+    Add markets to the market registry. The form should map each market id to its number of 
+    outcomes, e.g. {'1:8:18378T': 20, '1182:8:18378P': 2}. Each market's current and historical 
+    holdings must already be in Redis, so that the scheduler can update it from the next tick
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    success, message = verify_admin(request.headers.get('Authorization'))
+
+    if not success:
+        return message
+
+    try:
+        outcomes = {market: int(n) for market, n in request.form.items()}
+    except ValueError:
+        return 'Malformed number of outcomes', 400
+
+    if any(market[-1] not in ['T', 'P'] or len(market.split(':')) != 3 for market in outcomes):
+        return 'Malformed market', 400
+
+    missing = read_data.get_missing_markets(list(outcomes.keys()))
+
+    if len(missing) > 0:
+        return f'No holdings in Redis for {", ".join(missing)}', 400
+
+    registry.add_markets(outcomes)
+
+    return f'Registered {len(outcomes)} markets', 200
+
+
+@app.route('/deregister_markets', methods=['POST'])
+def deregister_markets():
+    """
+    Remove markets from the market registry. The form should contain 'markets', a comma
+    separated list of market ids
+    """
+
+    if request.headers.get('Authorization') is None:
+        return f'Authorization ID needed', 407
+
+    success, message = verify_admin(request.headers.get('Authorization'))
+
+    if not success:
+        return message
+
+    markets = request.form.get('markets')
+
+    if markets is None:
+        return 'Malformed form', 400
+
+    markets_list = [m for m in markets.split(',') if m != '']
+    registry.remove_markets(markets_list)
+
+    return f'Deregistered {len(markets_list)} markets', 200
+
+
 @app.route('/admin_trade', methods=['POST'])
 def admin_trade():
 
@@ -1,12 +1,31 @@
-import redis
 import json
 import os
 import logging
+from functools import lru_cache
 from src.lmsr.classic import LMSRMarketMaker, LMSRMultiMarketMaker
+from src.lmsr.long_short import LongShortMultiMarketMaker
 from src.redis_utils.exceptions import ResourceNotFoundError
+import src.redis_utils.read_data as read_data
+from src.redis_utils.connection import primary, shards
 import numpy as np
 
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+redis_db = primary()
+
+
+@lru_cache(maxsize=None)
+def back_quantity(N: int, back_divisor: float) -> np.ndarray:
+    """
+    The quantity vector for backing a market with N outcomes, 10 * exp(-[N-1, ..., 1, 0] / back_divisor). 
+    The result is cached per (N, back_divisor) and returned read-only, so callers must not modify it in place
+    """
+
+    q = 10 * np.exp(- np.linspace(0, N - 1, N)[::-1] / back_divisor)
+    q.setflags(write=False)
+    return q
+
+
+# the back quantity for player (long/short) markets
+PLAYER_BACK_QUANTITY = np.array([10.0, 0.0])
 
 
 class Market: 
@@ -42,7 +61,7 @@ class Market:
         self.MM = LMSRMarketMaker(self.name, self.x, self.b)
 
     def get_xb(self):
-        self.set_xb(**json.loads(redis_db.get(self.name)))
+        self.set_xb(**json.loads(shards.client(self.name, read_only=True).get(self.name)))
 
     def set_daily_xb(self, daily_x: dict, daily_b: dict):
 
@@ -89,12 +108,7 @@ class MarketCollection:
 
         prices = {}
 
-        with redis_db.pipeline() as pipe:
-
-            for market in self.markets:
-                pipe.get(market.name)
-
-            results = pipe.execute()
+        results = [result for result, in shards.execute([market.name for market in self.markets], lambda pipe, market: pipe.get(market), read_only=True)]
 
         for current_xb, market in zip(results, self.markets):
 
@@ -166,7 +180,7 @@ class _Market:
         self.MM = LMSRMarketMaker(self.name, self.x, self.b)
 
     def get_xb(self):
-        self.set_xb(**json.loads(redis_db.get(self.name)))
+        self.set_xb(**json.loads(shards.client(self.name, read_only=True).get(self.name)))
 
     def set_daily_xb(self, daily_x: list, daily_b: list):
 
@@ -182,11 +196,11 @@ class _Market:
         self.daily_MM = LMSRMultiMarketMaker(self.name, self.daily_x, self.daily_b)
         
     def current_back_price(self):
-        return self.MM.spot_value(q=10 * np.exp(- np.linspace(0, self.N - 1, self.N)[::-1] / self.back_divisor))
+        return self.MM.spot_value(q=back_quantity(self.N, self.back_divisor))
 
 
     def daily_back_price(self):
-        return self.daily_MM.spot_value(q=10 * np.exp(- np.linspace(0, self.N - 1, self.N)[::-1] / self.back_divisor))
+        return self.daily_MM.spot_value(q=back_quantity(self.N, self.back_divisor))
 
 
     def current_holding(self, pipe=None):
@@ -197,61 +211,98 @@ class _Market:
 
     
 class _MarketCollection:
+    """
+    A set of markets, e.g. a whole league, priced together. Holdings for every market are read in one 
+    pipeline, and markets with the same shape are priced in one vectorized pass: team markets with the 
+    same number of outcomes and back divisor share one LMSRMultiMarketMaker, with a row per market, and 
+    all player markets share one LongShortMultiMarketMaker.
+    """
 
     def __init__(self, names: list):
         self.markets = [_Market(name) for name in names]
 
-    def current_back_prices(self):
+    @staticmethod
+    def _back_prices(rows: list) -> list:
+        """
+        Given a list of (market, q, b, team, back_divisor), where q is an x vector for teams or N for players,
+        return the back price for each row
+        """
 
-        prices = {}
+        groups = {}
 
-        with redis_db.pipeline() as pipe:
+        for i, (market, q, b, team, back_divisor) in enumerate(rows):
+            groups.setdefault((len(q), back_divisor) if team else None, []).append(i)
 
-            for market in self.markets:
-                pipe.get(market.name)
+        prices = [None] * len(rows)
 
-            results = pipe.execute()
+        for key, members in groups.items():
 
-        for current_xb, market in zip(results, self.markets):
+            qs = [rows[i][1] for i in members]
+            bs = [rows[i][2] for i in members]
 
-            if current_xb is None:
-                prices[market.name] = None
-                logging.info(f'_MarketCollection.current_back_prices failed for {market.name}')
+            if key is not None:
+                values = LMSRMultiMarketMaker('collection', qs, bs).spot_value(back_quantity(*key), aslist=False)
             else:
-                market.set_xb(**json.loads(current_xb))
-                prices[market.name] = market.current_back_price()
+                values = LongShortMultiMarketMaker('collection', qs, bs).spot_value(PLAYER_BACK_QUANTITY, aslist=False)
+
+            for i, value in zip(members, values.tolist()):
+                prices[i] = value
 
         return prices
 
-    def daily_back_prices(self):
+    def current_back_prices(self):
+        """
+        The current back price of each market, or None if it is missing from redis
+        """
 
-        prices = {}
+        names = [market.name for market in self.markets]
+        currents = read_data.get_multiple_latest_quantities(names)
 
-        with redis_db.pipeline() as pipe:
+        rows = []
 
-            for market in self.markets:
-                pipe.get(market.name + ':hist')
-                
-            results = pipe.execute()
+        for market in self.markets:
 
-        for hist, market in zip(results, self.markets):
+            current = currents[market.name]
 
-            if hist is None:
-                prices[market.name] = None
-                logging.info(f'_MarketCollection.daily_back_prices failed for {market.name}')
+            if current is None:
+                logging.info(f'_MarketCollection.current_back_prices failed for {market.name}')
+            elif 'x' in current:
+                rows.append((market.name, current['x'], current['b'], True, market.back_divisor))
             else:
-                hist = json.loads(hist)
-                xhist = hist['x']['d']
-                bhist = hist['b']['d']
+                rows.append((market.name, current['N'], current['b'], False, market.back_divisor))
 
-                market.set_daily_xb(xhist, bhist)
-                prices[market.name] = market.daily_back_price()
+        prices = {name: None for name in names}
+        prices.update(zip([row[0] for row in rows], self._back_prices(rows)))
 
         return prices
 
+    def daily_back_prices(self):
+        """
+        The back price of each market at each point of its daily history, or None if it is missing from redis,
+        along with the matching times
+        """
+
+        names = [market.name for market in self.markets]
+        all_hist, time, epoch = read_data.get_historical_quantities_projected(names, ['d'])
 
+        rows = []
+        spans = {}
 
-        
+        for market, hist in zip(self.markets, all_hist):
+
+            if hist is None:
+                logging.info(f'_MarketCollection.daily_back_prices failed for {market.name}')
+                continue
+
+            team = 'x' in hist
+            qs = hist['x']['d'] if team else hist['N']['d']
+            spans[market.name] = (len(rows), len(rows) + len(qs))
+            rows += [(market.name, q, b, team, market.back_divisor) for q, b in zip(qs, hist['b']['d'])]
 
+        flat = self._back_prices(rows)
+        prices = {name: None for name in names}
 
+        for name, (start, stop) in spans.items():
+            prices[name] = flat[start:stop]
 
+        return prices, time['d']
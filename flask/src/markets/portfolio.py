@@ -1,43 +1,198 @@
-# from collections import defaultdict
-# from src.redis_utils.get_data import get_spot_quantity_values, get_multiple_historical_quantities
-# from src.lmsr.maker import HistoricalLMSRMarketMaker, orders_to_q
-# import logging 
+import numpy as np
+from typing import Union
+from src.lmsr.classic import LMSRMarketMaker, LMSRMultiMarketMaker
+from src.lmsr.long_short import LongShortMarketMaker, LongShortMultiMarketMaker
 
-# class Portfolio:
 
-#     def __init__(self, portfolioId: str, portfolioDoc: dict):
+class Market:
 
-#         self.markets, self.current_quantities = zip(*portfolioDoc['current'].items())
-#         self.values = get_spot_quantity_values(self.markets, self.current_quantities)
-#         self.historical_x = get_multiple_historical_quantities(self.markets)
-#         self.value = sum(self.values.values())
+    def __init__(self, name: str, current: dict, hist: dict) -> None:
+        """
+        name:     the market name
+        current:  the current holdings dict from redis
+        hist:     the holdings at a series of past times, in the form {'x': [x1, x2, ...], 'b': [b1, b2, ...]}
+                  ('N' in place of 'x' for players), e.g. the start of each d, w, m, M interval as given by
+                  MarketSnapshot.get_horizon_heads. None if only the current value is needed
+        """
 
-#         self.orders = defaultdict(list)
+        self.current = current
+        self.name = name
 
-#         for order in portfolioDoc['history']:
-#             self.orders[order['market']].append((order['time'], order['quantity']))
+    def get_current_value(self, q: Union[list, np.ndarray]) -> float:
+        """
+        Calculate the current value of the quantity vector q
+        """
+        return self.market_maker.spot_value(q)
 
-#     def build_history(self):
+    def get_hist_value(self, q: Union[list, np.ndarray]) -> np.ndarray:
+        """
+        Calculate the value of the quantity vector at each of the past times in hist
+        """
+        return self.multi_market_maker.spot_value(q, aslist=False)
 
-#         hist = None
+    def __repr__(self) -> str:
+        return f'Market({self.name})'
 
-#         for market, orders in self.orders.items():
 
-#             mm = HistoricalLMSRMarketMaker(market, xhist=self.historical_x[market]['xhist'], bhist=self.historical_x[market]['bhist'])
+class PlayerMarket(Market):
 
-#             if hist is None:
-#                 hist = mm.spot_value(self.orders[market])
+    def __init__(self, name: str, current: dict, hist: dict) -> None:
+        super().__init__(name, current, hist)
 
-#             else:
-#                 h = mm.spot_value(self.orders[market])
-#                 logging.info(str(h))
-#                 logging.info(str(hist))
-#                 for th in self.historical_x[market]['xhist'].keys():
-#                     for t in hist[th].keys():
-#                         hist[th][t] += h[th][t] 
+        self.multi_market_maker = LongShortMultiMarketMaker(self.name, hist['N'], hist['b']) if hist is not None else None
+        self.market_maker = LongShortMarketMaker(self.name, self.current['N'], self.current['b'])
 
+    def __repr__(self) -> str:
+        return f'PlayerMarket({self.name})'
 
-#         return hist
 
+class TeamMarket(Market):
 
+    def __init__(self, name: str, current: dict, hist: dict) -> None:
+        super().__init__(name, current, hist)
 
+        self.multi_market_maker = LMSRMultiMarketMaker(self.name, hist['x'], hist['b']) if hist is not None else None
+        self.market_maker = LMSRMarketMaker(self.name, self.current['x'], self.current['b'])
+
+    def __repr__(self) -> str:
+        return f'TeamMarket({self.name})'
+
+
+def make_market(name: str, current: dict, hist: dict) -> Market:
+    """
+    A TeamMarket or PlayerMarket, depending on the type of market
+    """
+
+    if name[-1] == 'T':
+        return TeamMarket(name, current, hist)
+    else:
+        return PlayerMarket(name, current, hist)
+
+
+class Transaction:
+
+    def __init__(self,
+                 market: Market,
+                 transaction_time: float,
+                 quantity: Union[list, np.ndarray],
+                 price: float,
+                 hist_times: np.ndarray):
+        """
+        A representation of a transaction that has occurred in the past. The transaction data takes
+        the form in which it is stored inside a portfolio. It must have the following properties:
+        'hist_times' is a numpy array holding the timestamps of the market's past holdings
+        """
+
+        self.market = market
+        self.quantity = quantity
+        self.price = price
+        self.mask = hist_times > transaction_time
+
+    def get_current_value(self) -> float:
+        return self.market.get_current_value(self.quantity) - self.price
+
+    def get_hist_value(self) -> np.ndarray:
+        value = self.market.get_hist_value(self.quantity) - self.price
+        value[~self.mask] = 0
+        return value
+
+
+class Holding:
+
+    def __init__(self, market: Market, quantity: Union[list, np.ndarray]) -> None:
+        self.market = market
+        self.quantity = quantity
+        self.value = 0
+
+    def get_value(self):
+        self.value = self.market.get_current_value(self.quantity)
+        return self.value
+
+
+class Portfolio:
+
+    def __init__(self, portfolio_dict: dict, market_pool: dict, hist_times: np.ndarray, c0: float=500) -> None:
+
+        self.c0 = c0
+        self.cash = portfolio_dict['cash']
+        self.hist_times = hist_times
+        self.transactions = [Transaction(market=market_pool[transaction['market']],
+                                         transaction_time=transaction['time'],
+                                         quantity=transaction['quantity'],
+                                         price=transaction['price'],
+                                         hist_times=hist_times) for transaction in portfolio_dict['transactions']]
+
+        self.holdings = [Holding(market=market_pool[market_name], quantity=quantity) for market_name, quantity in portfolio_dict['holdings'].items()]
+
+
+    def get_current_value(self) -> float:
+        return sum(holding.get_value() for holding in self.holdings) + self.cash
+
+    def get_hist_value(self) -> np.ndarray:
+        # sum over no transactions gives a scalar, so broadcast back to one value per time
+        return np.broadcast_to(sum(transaction.get_hist_value() for transaction in self.transactions) + self.c0, self.hist_times.shape)
+
+    def get_current_values(self):
+        return {holding.market.name: holding.value for holding in self.holdings}
+
+    def get_document_update(self):
+
+        current_value = self.get_current_value()
+        current_values = self.get_current_values()
+        hist_value = self.get_hist_value()
+        hist_returns = (current_value / hist_value  - 1).reshape(-1).tolist()
+
+        doc = {'current_value': current_value, 'current_values': current_values}
+
+        for th, ret in zip(['d', 'w', 'm', 'M'], hist_returns):
+            doc[f'returns_{th}'] = ret
+
+        return doc
+
+
+def value_portfolio(portfolio_dict: dict, currents: dict, all_hist: dict, hist_times: dict, c0: float=500) -> dict:
+    """
+    Value a portfolio now and at every time in the time log. currents maps each market in the portfolio to 
+    its current holdings, and all_hist to its historical holdings for some horizons, in the form returned by 
+    read_data.get_historical_quantities_projected, with hist_times the matching part of the time log. 
+
+    The horizons of each market are joined into one series, so that each market is valued at every time
+    in a single multi market maker. Return 
+
+        {'current_value': 512.3, 'current_values': {market: value, ...}, 'hist_value': {th: [...]}, 'time': {th: [...]}}
+    """
+
+    horizons = list(hist_times.keys())
+
+    # the historical holdings and the time log line up from the end, so keep the last n of each
+    lengths = {th: min([len(hist_times[th])] + [len(hist['b'][th]) for hist in all_hist.values()]) for th in horizons}
+    times = np.array([t for th in horizons for t in hist_times[th][len(hist_times[th]) - lengths[th]:]], dtype=np.float64)
+
+    market_pool = {}
+
+    for market, current in currents.items():
+
+        hist = all_hist[market]
+        k = 'x' if 'x' in hist else 'N'
+
+        if len(times) > 0:
+            joined = {k:   [q for th in horizons for q in hist[k][th][len(hist[k][th]) - lengths[th]:]],
+                      'b': [b for th in horizons for b in hist['b'][th][len(hist['b'][th]) - lengths[th]:]]}
+        else:
+            joined = None
+
+        market_pool[market] = make_market(market, current, joined)
+
+    portfolio = Portfolio(portfolio_dict, market_pool, times, c0)
+    current_value = portfolio.get_current_value()
+    hist_value = portfolio.get_hist_value() if len(times) > 0 else np.array([])
+
+    out = {'current_value': current_value, 'current_values': portfolio.get_current_values(), 'hist_value': {}, 'time': {}}
+    start = 0
+
+    for th in horizons:
+        out['hist_value'][th] = hist_value[start:start + lengths[th]].tolist()
+        out['time'][th] = times[start:start + lengths[th]].astype(np.int64).tolist()
+        start += lengths[th]
+
+    return out
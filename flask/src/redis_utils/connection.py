@@ -0,0 +1,464 @@
+import os
+import time
+import redis
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# The primary takes every write, and every read whose result is used to decide a write. Read-only traffic
+# can go to replicas instead, listed as comma separated host:port pairs in REDIS_REPLICAS. With none
+# listed, everything goes to the primary.
+#
+# A replica is only used while its link to the primary is up, it is not resyncing, and it has applied
+# everything the primary had written REDIS_REPLICA_MAX_LAG seconds ago. That is measured by replication
+# offset: each check samples the primary's master_repl_offset, and a replica is healthy once its own
+# slave_repl_offset has reached the newest sample at least that old. An idle primary only pings its
+# replicas every repl-ping-replica-period (10s by default), so time since the last byte from the primary
+# says nothing about staleness. Replicas are checked at most once every
+# REDIS_REPLICA_CHECK_INTERVAL seconds. REDIS_READ_POLICY is 'replica' to prefer a healthy replica,
+# falling back to the primary, or 'primary' to send everything to the primary regardless.
+PRIMARY_HOST = os.environ.get('REDIS_HOST', 'redis')
+PRIMARY_PORT = int(os.environ.get('REDIS_PORT', 6379))
+REPLICAS = [replica for replica in os.environ.get('REDIS_REPLICAS', '').split(',') if replica != '']
+READ_POLICY = os.environ.get('REDIS_READ_POLICY', 'replica')
+MAX_LAG = float(os.environ.get('REDIS_REPLICA_MAX_LAG', 2))
+CHECK_INTERVAL = float(os.environ.get('REDIS_REPLICA_CHECK_INTERVAL', 1))
+
+# Market state can be split across several redis instances (shards) by league. Shard 0 is always the primary 
+# above, and REDIS_SHARDS lists the rest as comma separated host:port pairs. Every key that belongs to a market 
+# ('1:8:18378T', '1:8:18378T:hist', '1:8:18378T:ohlc:d', ...) lives on the shard its league is assigned to. Everything 
+# else (the time log and history epoch, the change log, the market registry, cancel ids, rq queues and pub/sub) lives 
+# on shard 0, which also keeps every league that has not been assigned elsewhere. Assignments are changed with 
+# redis_utils/rebalance.py. The publish step of each tick also copies the time log and history epoch to every 
+# shard, so that each shard can be read consistently on its own (see read_data._read_history).
+SHARDS = [shard for shard in os.environ.get('REDIS_SHARDS', '').split(',') if shard != '']
+SHARD_CHECK_INTERVAL = float(os.environ.get('REDIS_SHARD_CHECK_INTERVAL', 1))
+
+# league -> shard index, a version counter bumped on every change, and the leagues being moved between shards
+SHARD_MAP_KEY = 'shards:leagues'
+SHARD_VERSION_KEY = 'shards:version'
+SHARD_FROZEN_KEY = 'shards:frozen'
+
+# Every redis client in a process is built here, on one shared pool per server and kind of connection, so that
+# a gunicorn worker holds a bounded number of connections however many modules use redis. A pool holds up to
+# REDIS_MAX_CONNECTIONS connections, and a caller finding it exhausted waits up to REDIS_POOL_TIMEOUT seconds
+# for one to be released rather than failing straight away. Connections use TCP keepalive, time out after
+# REDIS_SOCKET_TIMEOUT seconds, are checked with a PING when idle for HEALTH_CHECK_INTERVAL seconds, and parse
+# replies with hiredis when it is installed. Subscribers block on reads indefinitely, so they get their own
+# pools with no socket timeout.
+MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 10))
+CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2))
+HEALTH_CHECK_INTERVAL = 30
+
+PARSER = redis.connection.HiredisParser if redis.connection.HIREDIS_AVAILABLE else redis.connection.PythonParser
+
+
+class _Pool(redis.BlockingConnectionPool):
+    """
+    A BlockingConnectionPool that counts how often it is used, and how often callers have to wait for it
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.peak = 0
+
+    def get_connection(self, command_name, *args, **kwargs):
+
+        self.checkouts += 1
+
+        if self.pool.empty():
+            self.waits += 1
+
+        connection = super().get_connection(command_name, *args, **kwargs)
+        self.peak = max(self.peak, self.in_use())
+
+        return connection
+
+    def in_use(self) -> int:
+        return len(self._connections) - sum(1 for connection in list(self.pool.queue) if connection is not None)
+
+    def stats(self) -> dict:
+        return {'max': self.max_connections,
+                'open': len(self._connections),
+                'in_use': self.in_use(),
+                'peak': self.peak,
+                'checkouts': self.checkouts,
+                'waits': self.waits}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool(name: str, host: str, port: int, max_connections: int=MAX_CONNECTIONS, **kwargs) -> redis.ConnectionPool:
+    """
+    The shared pool called name, creating it for host:port on first use. kwargs override the default connection
+    settings above, e.g. a connection_class, or a shorter socket_timeout. Later calls with the same name get the
+    same pool, whatever they pass
+    """
+
+    with _pools_lock:
+
+        if name not in _pools:
+
+            settings = {'socket_keepalive': True,
+                        'socket_timeout': SOCKET_TIMEOUT,
+                        'socket_connect_timeout': CONNECT_TIMEOUT,
+                        'health_check_interval': HEALTH_CHECK_INTERVAL,
+                        'parser_class': PARSER,
+                        **kwargs}
+
+            _pools[name] = _Pool(host=host, port=int(port), db=0, max_connections=max_connections, timeout=POOL_TIMEOUT, **settings)
+
+        return _pools[name]
+
+
+def client(name: str, host: str, port: int, **kwargs) -> redis.Redis:
+    """
+    A client on the shared pool called name (see pool)
+    """
+    return redis.Redis(connection_pool=pool(name, host, port, **kwargs))
+
+
+def subscriber(host: str, port: int) -> redis.Redis:
+    """
+    A client for pub/sub and other connections that wait on the server indefinitely, with no socket timeout
+    """
+    return client(f'subscriber:{host}:{port}', host, port, max_connections=8, socket_timeout=None, health_check_interval=0)
+
+
+def pool_stats() -> dict:
+
+    with _pools_lock:
+        pools = dict(_pools)
+
+    return {'parser': PARSER.__name__, 'pools': {name: pool.stats() for name, pool in pools.items()}}
+
+
+_primary = client('primary', PRIMARY_HOST, PRIMARY_PORT)
+
+
+def primary() -> redis.Redis:
+    """
+    The client for the primary. Use this for writes, WATCH transactions, Lua scripts, pub/sub, and any
+    read that a write depends on
+    """
+    return _primary
+
+
+class ReplicaSet:
+    """
+    Round-robins read-only commands across the replicas that currently meet the staleness policy. The
+    health of each replica is rechecked with INFO replication when its last check is more than
+    check_interval seconds old, by whichever caller notices first.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, replicas: list=REPLICAS, policy: str=READ_POLICY, max_lag: float=MAX_LAG, check_interval: float=CHECK_INTERVAL):
+
+        if policy not in ['replica', 'primary']:
+            raise ValueError(f'Unknown read policy {policy}')
+
+        self.clients = [client(f'replica:{replica}', *replica.split(':'), socket_timeout=1, socket_connect_timeout=1) for replica in replicas]
+        self.names = replicas
+        self.policy = policy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        self.lock = threading.Lock()
+        self.healthy = [False] * len(self.clients)
+        self.checked = [0.0] * len(self.clients)
+        self.next = 0
+
+        # (time, master_repl_offset) samples of the primary, oldest first
+        self.samples = deque()
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def client(self) -> redis.Redis:
+        """
+        A client for a replica that meets the staleness policy, or for the primary if there is none
+        """
+
+        if self.policy == 'primary' or len(self.clients) == 0:
+            self.primary_reads += 1
+            return _primary
+
+        now = time.time()
+        due = [i for i in range(len(self.clients)) if now - self.checked[i] > self.check_interval]
+
+        if len(due) > 0:
+
+            floor = self._floor(now)
+
+            for i in due:
+                self._check(i, now, floor)
+
+        with self.lock:
+
+            for j in range(len(self.clients)):
+
+                i = (self.next + j) % len(self.clients)
+
+                if self.healthy[i]:
+                    self.next = i + 1
+                    self.replica_reads += 1
+                    return self.clients[i]
+
+        self.primary_reads += 1
+        return _primary
+
+    def _floor(self, now: float):
+        """
+        The primary's replication offset as of max_lag seconds ago, which a replica must have reached to be
+        used. Until the samples go back that far, the primary's current offset. None if the primary can't be read
+        """
+
+        try:
+            offset = _primary.info('replication')['master_repl_offset']
+
+        except (redis.RedisError, KeyError) as E:
+            logging.warning(f'ReplicaSet could not read the primary replication offset: {E}')
+            return None
+
+        with self.lock:
+
+            # a restarted primary starts its offsets again
+            if len(self.samples) > 0 and offset < self.samples[-1][1]:
+                self.samples.clear()
+
+            self.samples.append((now, offset))
+
+            while len(self.samples) > 1 and self.samples[1][0] <= now - self.max_lag:
+                self.samples.popleft()
+
+            sampled, floor = self.samples[0]
+            return floor if sampled <= now - self.max_lag else offset
+
+    def _check(self, i: int, now: float, floor) -> None:
+
+        self.checked[i] = now
+
+        try:
+            info = self.clients[i].info('replication')
+            healthy = (floor is not None and
+                       info.get('role') == 'slave' and
+                       info.get('master_link_status') == 'up' and
+                       not info.get('master_sync_in_progress', 0) and
+                       info.get('slave_repl_offset', -1) >= floor)
+
+        except redis.RedisError as E:
+            logging.warning(f'ReplicaSet could not check {self.names[i]}: {E}')
+            healthy = False
+
+        if healthy != self.healthy[i]:
+            logging.info(f'ReplicaSet: {self.names[i]} is now {"in" if healthy else "out of"} rotation')
+
+        self.healthy[i] = healthy
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            return {'policy': self.policy,
+                    'replicas': dict(zip(self.names, self.healthy)),
+                    'replica_reads': self.replica_reads,
+                    'primary_reads': self.primary_reads}
+
+
+replicas = ReplicaSet()
+
+
+def replica() -> redis.Redis:
+    """
+    The client to send a read-only command to, following the staleness policy. Results may be behind the
+    primary by up to REDIS_REPLICA_MAX_LAG seconds, so never use them to decide a write
+    """
+    return replicas.client()
+
+
+class ShardMovingError(redis.RedisError):
+    """
+    Raised when a market's league is being moved between shards, and so cannot be read or written
+    """
+    pass
+
+
+class ShardRouter:
+    """
+    Maps markets to shards by league, and runs pipelines of per-market commands across the shards. The league 
+    assignments are kept in memory and reloaded when SHARD_VERSION_KEY changes, which is checked at most once 
+    every check_interval seconds, in the same way as MarketRegistry.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, shards: list=SHARDS, check_interval: float=SHARD_CHECK_INTERVAL):
+
+        self.names = [f'{PRIMARY_HOST}:{PRIMARY_PORT}'] + shards
+        self.clients = [_primary] + [client(f'shard:{shard}', *shard.split(':')) for shard in shards]
+        self.check_interval = check_interval
+
+        self.version = None
+        self.last_checked = 0
+
+        # (league -> shard, set of frozen leagues), replaced as a whole on reload
+        self.state = ({}, set())
+
+        self.executor = ThreadPoolExecutor(max_workers=len(self.clients), thread_name_prefix='ShardRouter') if len(self.clients) > 1 else None
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def refresh(self, force: bool=False) -> None:
+
+        if len(self.clients) == 1:
+            return
+
+        now = time.time()
+
+        if not force and now - self.last_checked < self.check_interval:
+            return
+
+        self.last_checked = now
+        version = _primary.get(SHARD_VERSION_KEY)
+
+        if version is not None and version == self.version:
+            return
+
+        with _primary.pipeline() as pipe:
+            pipe.get(SHARD_VERSION_KEY)
+            pipe.hgetall(SHARD_MAP_KEY)
+            pipe.smembers(SHARD_FROZEN_KEY)
+            version, assignments, frozen = pipe.execute()
+
+        self.version = version
+        self.state = ({league.decode(): int(shard) for league, shard in assignments.items()}, {league.decode() for league in frozen})
+
+    def shard(self, market: str, read_only: bool=False) -> int:
+        """
+        The index of the shard holding a market's keys. Raise a ShardMovingError if its league is being moved, 
+        unless read_only, as the keys are kept on the shard they are moving from until the move is complete. 
+        Anything that is not a market id has no keys, and goes to shard 0, where reading it finds nothing
+        """
+
+        if len(self.clients) == 1:
+            return 0
+
+        fields = market.split(':')
+
+        if len(fields) != 3:
+            return 0
+
+        self.refresh()
+
+        assignments, frozen = self.state
+        league = fields[1]
+
+        if league in frozen and not read_only:
+            raise ShardMovingError(f'League {league} is being moved between shards')
+
+        return assignments.get(league, 0)
+
+    def client(self, market: str, read_only: bool=False) -> redis.Redis:
+        """
+        The client for the shard holding a market's keys
+        """
+        return self.clients[self.shard(market, read_only)]
+
+    def group(self, markets: list, read_only: bool=False) -> dict:
+        """
+        Group the positions of a list of markets by shard, as {shard: [i, ...]}
+        """
+
+        groups = {}
+
+        for i, market in enumerate(markets):
+            groups.setdefault(self.shard(market, read_only), []).append(i)
+
+        return groups
+
+    def read_clients(self) -> list:
+        """
+        The clients to use for read-only commands on each shard: a replica for shard 0, following the staleness 
+        policy, and the shards themselves for the rest
+        """
+        return [replica()] + self.clients[1:]
+
+    def execute(self, markets: list, queue, transaction: bool=False, clients: list=None, read_only: bool=False) -> list:
+        """
+        Run commands for each of a list of markets on the shards holding them. queue(pipe, market) adds a market's 
+        commands to a pipeline. Each shard gets one pipeline, and the pipelines of different shards are executed 
+        in parallel. Return a list holding the list of results of each market's commands, in the order of markets. 
+        clients optionally replaces the client used for each shard, e.g. with a replica for shard 0.
+        """
+
+        clients = clients or self.clients
+        groups = self.group(markets, read_only)
+        out = [None] * len(markets)
+
+        def run(shard: int, members: list) -> None:
+
+            with clients[shard].pipeline(transaction=transaction) as pipe:
+
+                counts = []
+
+                for i in members:
+                    n = len(pipe)
+                    queue(pipe, markets[i])
+                    counts.append(len(pipe) - n)
+
+                results = pipe.execute()
+
+            start = 0
+
+            for i, n in zip(members, counts):
+                out[i] = results[start:start + n]
+                start += n
+
+        self.run(groups, run)
+
+        return out
+
+    def run(self, groups: dict, f) -> None:
+        """
+        Call f(shard, members) for each group made by group(), in parallel if there is more than one
+        """
+
+        if len(groups) <= 1:
+            for shard, members in groups.items():
+                f(shard, members)
+        else:
+            for future in [self.executor.submit(f, shard, members) for shard, members in groups.items()]:
+                future.result()
+
+    def each(self, f) -> list:
+        """
+        Call f(shard) for every shard index, in parallel, but with shard 0 only once the rest have returned, and 
+        return the results in shard order. Use this to write keys that every shard keeps a copy of, so that shard 0 
+        always has the newest
+        """
+
+        if len(self.clients) == 1:
+            return [f(0)]
+
+        results = [future.result() for future in [self.executor.submit(f, shard) for shard in range(1, len(self.clients))]]
+
+        return [f(0)] + results
+
+    def stats(self) -> dict:
+        assignments, frozen = self.state
+
+        return {'shards': self.names, 
+                'version': int(self.version) if self.version is not None else None, 
+                'assignments': assignments, 
+                'frozen': sorted(frozen)}
+
+
+shards = ShardRouter()
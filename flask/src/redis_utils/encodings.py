@@ -0,0 +1,100 @@
+import gzip
+import struct
+import brotli
+import msgpack
+import numpy as np
+
+# content-coding -> compressor, in order of preference. The scheduler stores each market's
+# /historical_holdings response pre-compressed with each of these under 'market:hist:<coding>'.
+# Every tick appends to every market's history, so every market is recompressed every tick. The
+# levels are kept moderate for that reason: above them, the time grows much faster than the ratio.
+COMPRESSORS = {'br': lambda body: brotli.compress(body, quality=5),
+               'gzip': lambda body: gzip.compress(body, compresslevel=6)}
+
+ENCODINGS = list(COMPRESSORS.keys())
+
+
+def compress_all(body: bytes) -> dict:
+    """
+    Compress a response body with every encoding in ENCODINGS. Return a dict mapping
+    encoding to compressed bytes
+    """
+    return {encoding: compress(body) for encoding, compress in COMPRESSORS.items()}
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return COMPRESSORS[encoding](body)
+
+
+def choose_encoding(accept_encodings) -> str:
+    """
+    Given a request's parsed Accept-Encoding header, pick the encoding to respond with, or None
+    to send the body uncompressed
+    """
+    return accept_encodings.best_match(ENCODINGS)
+
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+# msgpack extension types used for numeric arrays. The payload is a header, giving the number of dimensions
+# as a uint8 followed by each dimension as a uint32, then the values in C order. All little-endian.
+FLOAT64_ARRAY_EXT = 1
+INT64_ARRAY_EXT = 2
+
+
+def wants_msgpack(accept_mimetypes) -> bool:
+    """
+    Whether a request's parsed Accept header prefers msgpack to JSON. JSON wins ties, so clients 
+    only get msgpack when they ask for it
+    """
+    return accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+
+def _pack_array(array: np.ndarray) -> msgpack.ExtType:
+
+    if array.dtype.kind == 'f':
+        code, array = FLOAT64_ARRAY_EXT, array.astype('<f8', copy=False)
+    else:
+        code, array = INT64_ARRAY_EXT, array.astype('<i8', copy=False)
+
+    header = struct.pack(f'<B{array.ndim}I', array.ndim, *array.shape)
+
+    return msgpack.ExtType(code, header + array.tobytes())
+
+
+def _pack_arrays(obj):
+    """
+    Replace every numpy array, list of numbers (or rectangular list of lists of numbers) in a JSON-like 
+    object with a packed array extension type
+    """
+
+    if isinstance(obj, dict):
+        return {key: _pack_arrays(value) for key, value in obj.items()}
+
+    if isinstance(obj, np.ndarray):
+        return _pack_array(obj) if obj.size > 0 else obj.tolist()
+
+    if isinstance(obj, list):
+
+        if len(obj) > 0:
+
+            # newer numpy refuses ragged lists rather than making an object array of them
+            try:
+                array = np.asarray(obj)
+            except ValueError:
+                array = None
+
+            if array is not None and array.dtype.kind in 'if' and array.ndim > 0:
+                return _pack_array(array)
+
+        return [_pack_arrays(value) for value in obj]
+
+    return obj
+
+
+def to_msgpack(obj) -> bytes:
+    """
+    Serialize a JSON-like object to msgpack, with numeric arrays packed as FLOAT64_ARRAY_EXT or 
+    INT64_ARRAY_EXT rather than as a msgpack array of individually tagged numbers
+    """
+    return msgpack.packb(_pack_arrays(obj), use_bin_type=True)
@@ -0,0 +1,71 @@
+import threading
+from cachetools import LRUCache
+
+
+class EpochCache:
+    """
+    Per-process LRU cache for responses that only change when the scheduler publishes a new
+    history epoch (see RedisJobs). Entries are stored against the epoch they were built from,
+    and the whole cache is dropped the first time a newer epoch is seen, so a value is never
+    served for an epoch other than its own. The scheduler never reuses an epoch, so an older one
+    is only ever seen from a lagging replica, and is neither served from nor stored in the cache.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int=256):
+
+        self.cache = LRUCache(maxsize=maxsize)
+        self.epoch = None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, epoch: int):
+        """
+        Get the cached value for key at a particular epoch, or None if there isn't one
+        """
+
+        with self.lock:
+
+            self._advance(epoch)
+
+            value = self.cache.get(key) if epoch == self.epoch else None
+
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            return value
+
+    def set(self, key, epoch: int, value) -> None:
+        """
+        Store a value built from a particular epoch. Values from an epoch older than the newest
+        one seen are discarded.
+        """
+
+        with self.lock:
+
+            self._advance(epoch)
+
+            if epoch == self.epoch:
+                self.cache[key] = value
+
+    def _advance(self, epoch: int) -> None:
+
+        if self.epoch is None or epoch > self.epoch:
+            self.cache.clear()
+            self.epoch = epoch
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            total = self.hits + self.misses
+            return {'epoch': self.epoch,
+                    'size': len(self.cache),
+                    'maxsize': self.cache.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total > 0 else None}
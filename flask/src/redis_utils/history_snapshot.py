@@ -0,0 +1,183 @@
+import os
+import mmap
+import struct
+import orjson
+import numpy as np
+
+# The scheduler writes every market's historical holdings and long price series here once per tick, for
+# the gunicorn workers in the same container to map into memory rather than each reading and parsing them
+# from redis. The file is:
+#
+#     MAGIC | header length (uint64, little-endian) | JSON header | padding to 8 bytes | arrays
+#
+# The header is {'epoch': e, 'time': {th: [t1, t2, ...]}, 'markets': {market: {th: {'x': entry, 'b': entry, 'p': entry}}}},
+# with 'N' in place of 'x' for players, where each entry is [offset, shape, dtype] locating a C-ordered
+# array in the array section. 'p' is the long price at each entry. A new file is written alongside and
+# renamed over the old one, so readers always see a complete file.
+SNAPSHOT_PATH = '/var/www/snapshot/history.snap'
+
+MAGIC = b'SPFHIST1'
+
+
+def write_history_snapshot(epoch: int, hist_times: dict, all_hist: dict, all_prices: dict, path: str=SNAPSHOT_PATH) -> int:
+    """
+    Write a snapshot of the historical holdings published at a history epoch. all_hist maps each market to its
+    full historical holdings dict, and all_prices maps it to {th: long price series}. Return the file size.
+    """
+
+    chunks = []
+    size = 0
+
+    def add(values, dtype: str) -> list:
+
+        nonlocal size
+
+        array = np.ascontiguousarray(values, dtype=dtype)
+        entry = [size, list(array.shape), dtype]
+
+        chunks.append(array.tobytes())
+        size += array.nbytes
+
+        return entry
+
+    markets = {}
+
+    for market, hist in all_hist.items():
+        k = 'x' if 'x' in hist else 'N'
+        markets[market] = {th: {k: add(hist[k][th], '<f8'), 'b': add(hist['b'][th], '<f8'), 'p': add(all_prices[market][th], '<f8')} for th in hist['b']}
+
+    header = orjson.dumps({'epoch': epoch, 'time': hist_times, 'markets': markets})
+    padding = b'\0' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+
+    with open(tmp_path, 'wb') as f:
+
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header + padding)
+
+        for chunk in chunks:
+            f.write(chunk)
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+    return len(MAGIC) + 8 + len(header) + len(padding) + size
+
+
+class _Mapping:
+    """
+    One snapshot file, mapped read-only. Arrays handed out are views of the mapping, which stays open
+    for as long as any of them is alive, even after a newer file has been renamed over this one
+    """
+
+    def __init__(self, path: str):
+
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a history snapshot')
+
+        n, = struct.unpack_from('<Q', buffer, len(MAGIC))
+        start = len(MAGIC) + 8
+
+        header = orjson.loads(buffer[start:start + n])
+
+        self.epoch = header['epoch']
+        self.time = header['time']
+        self.markets = header['markets']
+        self.data = memoryview(buffer)[start + n + (-(start + n) % 8):]
+
+    def array(self, entry: list) -> np.ndarray:
+
+        offset, shape, dtype = entry
+        count = int(np.prod(shape))
+
+        if count == 0:
+            return np.empty(shape, dtype=dtype)
+
+        return np.frombuffer(self.data, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def __contains__(self, market: str) -> bool:
+        return market in self.markets
+
+    def horizons(self, market: str, horizons: list) -> list:
+        """
+        The historical holdings of a market for each of a list of horizons, as [{'x': array, 'b': array}, ...]
+        """
+        return [{k: self.array(entry) for k, entry in self.markets[market][th].items() if k != 'p'} for th in horizons]
+
+    def prices(self, market: str, horizons: list) -> list:
+        """
+        The long price series of a market for each of a list of horizons
+        """
+        return [self.array(self.markets[market][th]['p']) for th in horizons]
+
+
+class HistorySnapshot:
+    """
+    A worker's view of the latest history snapshot written by the scheduler. The file is checked each time
+    the snapshot is asked for, and mapped again if it has been replaced. Callers ask for the snapshot of a
+    particular epoch, read from redis, and get None if the file is missing or from a different epoch, in
+    which case they should read from redis instead.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: str=SNAPSHOT_PATH):
+
+        self.path = path
+        self.mapping = None
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def get(self, epoch: int):
+
+        mapping = self._load()
+
+        if mapping is None or mapping.epoch != epoch:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return mapping
+
+    def _load(self):
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        mapping = self.mapping
+
+        if mapping is None or (stat.st_ino, stat.st_mtime_ns) != (mapping.stat.st_ino, mapping.stat.st_mtime_ns):
+
+            try:
+                mapping = _Mapping(self.path)
+            except (OSError, ValueError):
+                return self.mapping
+
+            self.mapping = mapping
+            self.loads += 1
+
+        return mapping
+
+    def stats(self) -> dict:
+
+        mapping = self.mapping
+
+        return {'epoch': mapping.epoch if mapping is not None else None,
+                'markets': len(mapping.markets) if mapping is not None else 0,
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads}
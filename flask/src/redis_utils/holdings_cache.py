@@ -0,0 +1,328 @@
+import time
+import redis
+import orjson
+import logging
+import threading
+from cachetools import LRUCache
+from src.lmsr.classic import LMSRMarketMaker
+from src.lmsr.long_short import LongShortMarketMaker
+from src.redis_utils.versions import version_key
+from src.redis_utils.connection import shards, client, subscriber
+
+# redis publishes the keys whose tracked values have changed here, to the connection named in CLIENT TRACKING REDIRECT
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+
+class TrackingConnection(redis.Connection):
+    """
+    A redis connection that turns on server-assisted client side caching as soon as it connects. Redis
+    then remembers every key read through it, and sends an invalidation message for the key to the
+    tracker's invalidation connection the next time the key is written.
+    """
+
+    def __init__(self, tracker=None, **kwargs):
+        super().__init__(**kwargs)
+        self.tracker = tracker
+
+    def on_connect(self) -> None:
+
+        super().on_connect()
+
+        client_id = self.tracker.client_id
+
+        if client_id is None:
+            raise redis.ConnectionError('HoldingsCache has no invalidation connection')
+
+        self.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id)
+
+        if self.read_response() not in (b'OK', 'OK'):
+            raise redis.ConnectionError('CLIENT TRACKING failed')
+
+
+class _Tracker:
+    """
+    The connections HoldingsCache holds to one shard: a pool of tracked connections for reading markets, and
+    the invalidation connection their invalidation messages are redirected to, read by a background thread
+    """
+
+    def __init__(self, shard: int):
+
+        host, port = shards.names[shard].split(':')
+
+        self.name = shards.names[shard]
+        self.redis_db = shards.clients[shard]
+        self.subscriber_db = subscriber(host, port)
+        self.tracked_db = client(f'tracked:{self.name}', host, port, connection_class=TrackingConnection, tracker=self)
+
+        self.client_id = None
+        self.ready = False
+        self.thread = None
+
+
+class HoldingsCache:
+    """
+    Per-process cache of the current holdings of each market, as the raw JSON stored in redis, along with
+    its version (see versions.py) and, once asked for, the market maker built from it.
+
+    Markets are read into the cache through connections with CLIENT TRACKING on, and a background thread
+    for each shard holds one connection subscribed to the invalidation messages for them. Every write to a 
+    cached market evicts it, so a market that has not traded is served from memory until it does. A fill 
+    that overlaps an invalidation of the same market is not stored, and if an invalidation connection drops 
+    the whole cache is cleared, and its shard bypassed until it is back.
+
+    Each market's version (see versions.py) is read in the same transaction as its holdings, so every entry 
+    carries the version of exactly what it holds. Invalidations arrive asynchronously, so on their own they 
+    only bound staleness by their delivery time. A caller that already knows a newer version of a market can 
+    pass it in, and an entry older than that is treated as a miss. Writers in this process hand over the 
+    versions they have written with written(), so that reads here see them straight away.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int=4096):
+
+        self.trackers = [_Tracker(shard) for shard in range(len(shards))]
+
+        self.cache = LRUCache(maxsize=maxsize)
+        self.filling = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.flushes = 0
+
+    def get_raw(self, markets: list, versions: list=None) -> list:
+        """
+        The raw JSON current holdings of each of a list of markets, with None for markets not in redis. If
+        versions are given, any cached entry older than the matching version is refetched.
+        """
+        return self.get(markets, versions)[0]
+
+    def get(self, markets: list, versions: list=None) -> tuple:
+        """
+        As get_raw, but return the list of raw JSON current holdings along with the version of each, which is 0 
+        for markets not in redis
+        """
+
+        self._start()
+
+        out = [None] * len(markets)
+        out_versions = [0] * len(markets)
+        missed = []
+
+        with self.lock:
+
+            for i, market in enumerate(markets):
+
+                entry = self.cache.get(market)
+
+                if entry is not None and (versions is None or entry['version'] >= versions[i]):
+                    out[i] = entry['raw']
+                    out_versions[i] = entry['version']
+                    self.hits += 1
+                else:
+                    missed.append(i)
+                    self.misses += 1
+
+            tokens = {i: self.filling.setdefault(markets[i], object()) for i in missed}
+
+        if len(missed) == 0:
+            return out, out_versions
+
+        missed_markets = [markets[i] for i in missed]
+
+        # shards whose invalidation connection is down are read, but nothing read from them is kept
+        tracked = [tracker.ready for tracker in self.trackers]
+
+        try:
+
+            try:
+                results, fetched_versions = self._fetch(missed_markets, [tracker.tracked_db if tracker.ready else tracker.redis_db for tracker in self.trackers])
+            except redis.ConnectionError:
+                results, fetched_versions = self._fetch(missed_markets, [tracker.redis_db for tracker in self.trackers])
+                tracked = [False] * len(self.trackers)
+
+            with self.lock:
+
+                for i, raw, version in zip(missed, results, fetched_versions):
+
+                    out[i] = raw
+                    out_versions[i] = version
+
+                    if raw is not None and tracked[shards.shard(markets[i], read_only=True)] and self.filling.get(markets[i]) is tokens[i]:
+                        self.cache[markets[i]] = {'raw': raw, 'version': version, 'maker': None}
+
+        finally:
+            # tokens go whether or not anything was stored, as market ids come from clients and missing 
+            # markets would otherwise pile up here
+            with self.lock:
+                for i in missed:
+                    if self.filling.get(markets[i]) is tokens[i]:
+                        del self.filling[markets[i]]
+
+        return out, out_versions
+
+    def written(self, markets: list, versions: list) -> None:
+        """
+        Called by a writer in this process once it has written new versions of a list of markets, to evict any
+        older entries for them, and any fills in progress, without waiting for their invalidations
+        """
+
+        with self.lock:
+
+            for market, version in zip(markets, versions):
+
+                self.filling.pop(market, None)
+
+                entry = self.cache.get(market)
+
+                if entry is not None and entry['version'] < version:
+                    del self.cache[market]
+
+    def get_market_maker(self, market: str, raw: bytes=None):
+        """
+        The LMSRMarketMaker or LongShortMarketMaker for the current holdings of a market, or None if it is
+        not in redis. Built once per cached version of the market
+        """
+
+        raw = raw if raw is not None else self.get_raw([market])[0]
+
+        if raw is None:
+            return None
+
+        with self.lock:
+            entry = self.cache.get(market)
+            if entry is not None and entry['raw'] is raw and entry['maker'] is not None:
+                return entry['maker']
+
+        current = orjson.loads(raw)
+
+        if 'x' in current:
+            maker = LMSRMarketMaker(market, current['x'], current['b'])
+        else:
+            maker = LongShortMarketMaker(market, current['N'], current['b'])
+
+        with self.lock:
+            entry = self.cache.get(market)
+            if entry is not None and entry['raw'] is raw:
+                entry['maker'] = maker
+
+        return maker
+
+    @staticmethod
+    def _fetch(markets: list, clients: list) -> tuple:
+        """
+        Read the raw current holdings and version of each market, from the given client for each shard, in one
+        transaction per shard
+        """
+
+        def queue(pipe, market):
+            pipe.get(market)
+            pipe.get(version_key(market))
+
+        results = shards.execute(markets, queue, transaction=True, clients=clients, read_only=True)
+
+        return [raw for raw, version in results], [int(version) if version is not None else 0 for raw, version in results]
+
+    def invalidate(self, keys: list) -> None:
+        """
+        Evict the markets named in an invalidation message. None means redis has flushed its tracking
+        table, so everything goes
+        """
+
+        with self.lock:
+
+            if keys is None:
+                self._clear()
+                return
+
+            for key in keys:
+
+                market = key.decode() if isinstance(key, bytes) else key
+
+                self.filling.pop(market, None)
+
+                if self.cache.pop(market, None) is not None:
+                    self.invalidations += 1
+
+    def _clear(self) -> None:
+        self.cache.clear()
+        self.filling.clear()
+        self.flushes += 1
+
+    def _start(self) -> None:
+
+        if all(tracker.thread is not None for tracker in self.trackers):
+            return
+
+        with self.lock:
+            for tracker in self.trackers:
+                if tracker.thread is None:
+                    tracker.thread = threading.Thread(target=self._run, args=(tracker, ), name=f'HoldingsCache-{tracker.name}', daemon=True)
+                    tracker.thread.start()
+
+    def _run(self, tracker: _Tracker) -> None:
+
+        while True:
+
+            connection = None
+
+            try:
+                connection = tracker.subscriber_db.connection_pool.get_connection('SUBSCRIBE')
+
+                connection.send_command('CLIENT', 'ID')
+                client_id = connection.read_response()
+
+                connection.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+                connection.read_response()
+
+                # tracked connections redirecting to the previous invalidation connection would go unheard
+                with self.lock:
+                    tracker.client_id = client_id
+                    self._clear()
+
+                tracker.tracked_db.connection_pool.disconnect()
+                tracker.ready = True
+
+                while True:
+
+                    kind, channel, data = connection.read_response()
+
+                    if kind == b'message':
+                        self.invalidate(data)
+
+            except redis.ConnectionError as E:
+                logging.warning(f'HoldingsCache lost its invalidation connection to {tracker.name}: {E}. Reconnecting')
+                time.sleep(1)
+
+            # anything else would end the thread, and with it caching for the shard, so log it and start over
+            except Exception as E:
+                logging.exception(f'HoldingsCache invalidation thread for {tracker.name} failed: {E}. Restarting')
+                time.sleep(1)
+
+            finally:
+                # invalidations may have been missed, so nothing cached can be trusted. While the shard stays
+                # down, nothing from it has been cached since, so failed reconnects leave the other shards alone
+                with self.lock:
+                    if tracker.ready:
+                        tracker.ready = False
+                        self._clear()
+
+                if connection is not None:
+                    connection.disconnect()
+                    tracker.subscriber_db.connection_pool.release(connection)
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            total = self.hits + self.misses
+            return {'ready': {tracker.name: tracker.ready for tracker in self.trackers},
+                    'size': len(self.cache),
+                    'filling': len(self.filling),
+                    'maxsize': self.cache.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total > 0 else None,
+                    'invalidations': self.invalidations,
+                    'flushes': self.flushes}
@@ -1,5 +1,5 @@
 import time
-import redis
+from src.redis_utils.connection import shards
 import os
 import json
 
@@ -7,8 +7,6 @@ import json
 def init_redis_f():
     ## IS EVERYTHING 100% DOUBLES????????? (except time.....!!!!!!)
 
-    redis_db = redis.Redis(host='redis', port=6379, db=0)
-
     BASE_DIR = '/var/www'
 
     with open(os.path.join(BASE_DIR, 'data', 'player_N0s.json'), 'r') as f:
@@ -17,22 +15,27 @@ def init_redis_f():
     with open(os.path.join(BASE_DIR, 'data', 'team_x0s.json'), 'r') as f:
         teams = json.loads(f.read())
 
-    with redis_db.pipeline() as pipe:
+    player_ids = list(players.keys())
+
+    # each market's keys are on its league's shard (see connection.py), so check and write them there
+    exists = shards.execute(player_ids, lambda pipe, player_id: pipe.exists(player_id + ':hist'))
+    missing = [player_id for player_id, (found, ) in zip(player_ids, exists) if not found]
+
+    def queue(pipe, player_id):
 
-        for player_id, player_Nb in players.items():
+        player_Nb = players[player_id]
 
-            if not redis_db.exists(player_id + ':hist'):
-                # pipe.set(player_id, json.dumps({'N': player_Nb['N'], 'b': player_Nb['b']}))
-                pipe.set(player_id + ':hist',
-                         json.dumps({'N': {'h': [player_Nb['N']] * 60, 'd': [player_Nb['N']] * 60, 'w': [player_Nb['N']] * 60, 'm': [player_Nb['N']] * 36, 'M': [player_Nb['N']] * 36},
-                                     'b': {'h': [player_Nb['b']] * 60, 'd': [player_Nb['b']] * 60, 'w': [player_Nb['b']] * 60, 'm': [player_Nb['b']] * 36, 'M': [player_Nb['b']] * 36}}))
+        # pipe.set(player_id, json.dumps({'N': player_Nb['N'], 'b': player_Nb['b']}))
+        pipe.set(player_id + ':hist',
+                 json.dumps({'N': {'h': [player_Nb['N']] * 60, 'd': [player_Nb['N']] * 60, 'w': [player_Nb['N']] * 60, 'm': [player_Nb['N']] * 36, 'M': [player_Nb['N']] * 36},
+                             'b': {'h': [player_Nb['b']] * 60, 'd': [player_Nb['b']] * 60, 'w': [player_Nb['b']] * 60, 'm': [player_Nb['b']] * 36, 'M': [player_Nb['b']] * 36}}))
 
-        # for team_id, team_xb in teams.items():
-        #     pipe.set(team_id, json.dumps({'x': team_xb['x'], 'b': team_xb['b']}))
-            # pipe.set(team_id + ':hist', json.dumps({'x': {'h': [team_xb['x']], 'd': [team_xb['x']], 'w': [team_xb['x']], 'm': [team_xb['x']], 'M': [team_xb['x']]},
-            #                                         'b': {'h': [team_xb['b']], 'd': [team_xb['b']], 'w': [team_xb['b']], 'm': [team_xb['b']], 'M': [team_xb['b']]}}))
+    shards.execute(missing, queue)
 
-        # t = int(time.time())
-        # pipe.set('time', json.dumps({'h': [t], 'd': [t], 'w': [t], 'm': [t], 'M': [t]}))
+    # for team_id, team_xb in teams.items():
+    #     pipe.set(team_id, json.dumps({'x': team_xb['x'], 'b': team_xb['b']}))
+        # pipe.set(team_id + ':hist', json.dumps({'x': {'h': [team_xb['x']], 'd': [team_xb['x']], 'w': [team_xb['x']], 'm': [team_xb['x']], 'M': [team_xb['x']]},
+        #                                         'b': {'h': [team_xb['b']], 'd': [team_xb['b']], 'w': [team_xb['b']], 'm': [team_xb['b']], 'M': [team_xb['b']]}}))
 
-        pipe.execute()
+    # t = int(time.time())
+    # pipe.set('time', json.dumps({'h': [t], 'd': [t], 'w': [t], 'm': [t], 'M': [t]}))
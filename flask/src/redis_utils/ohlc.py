@@ -0,0 +1,170 @@
+import redis
+import numpy as np
+from src.redis_utils.connection import primary, shards
+
+redis_db = primary()
+
+# Open, high, low and close long prices are kept for each market and horizon in 'market:ohlc:<horizon>'.
+# Each is a string of fixed-width records, one per bucket, oldest first. A record is five little-endian
+# float64s: the time the bucket opened, then the open, high, low and close prices. A new bucket is opened
+# at each tick where the horizon's historical holdings take a new sample, so buckets line up with the
+# time log. Every trade updates the high, low and close of the latest bucket of each horizon.
+CANDLE_HORIZONS = ['h', 'd', 'w', 'm', 'M']
+
+# buckets kept for each horizon. Like the historical holdings, M is thinned rather than trimmed, by
+# merging neighbouring buckets in pairs once it goes over this length
+MAX_CANDLES = {'h': 60, 'd': 60, 'w': 60, 'm': 60, 'M': 120}
+
+# KEYS are candle keys, ARGV[i] the new price for KEYS[i]. Keys with no buckets yet are left alone
+_record = redis_db.register_script("""
+for i, key in ipairs(KEYS) do
+    local n = redis.call('STRLEN', key)
+    if n >= 40 then
+        local p = tonumber(ARGV[i])
+        local t, o, h, l = struct.unpack('<dddd', redis.call('GETRANGE', key, n - 40, n - 9))
+        redis.call('SETRANGE', key, n - 40, struct.pack('<ddddd', t, o, math.max(h, p), math.min(l, p), p))
+    end
+end
+""")
+
+# KEYS are candle keys, and ARGV holds the time the new buckets open, then for each key the opening
+# price, the maximum number of buckets and 1 to thin rather than trim
+_roll = redis_db.register_script("""
+local t = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local p = tonumber(ARGV[3 * i - 1])
+    local max = tonumber(ARGV[3 * i])
+    local n = redis.call('APPEND', key, struct.pack('<ddddd', t, p, p, p, p)) / 40
+    if n > max then
+        if ARGV[3 * i + 1] == '1' then
+            local data = redis.call('GET', key)
+            local merged = {}
+            for j = 0, n - 1, 2 do
+                local t1, o1, h1, l1, c1 = struct.unpack('<ddddd', data, j * 40 + 1)
+                if j + 1 < n then
+                    local t2, o2, h2, l2, c2 = struct.unpack('<ddddd', data, j * 40 + 41)
+                    merged[#merged + 1] = struct.pack('<ddddd', t1, o1, math.max(h1, h2), math.min(l1, l2), c2)
+                else
+                    merged[#merged + 1] = struct.pack('<ddddd', t1, o1, h1, l1, c1)
+                end
+            end
+            redis.call('SET', key, table.concat(merged))
+        else
+            redis.call('SET', key, redis.call('GETRANGE', key, (n - max) * 40, -1))
+        end
+    end
+end
+""")
+
+
+def candle_key(market: str, horizon: str) -> str:
+    return f'{market}:ohlc:{horizon}'
+
+
+def _finite(markets: list, prices: list) -> tuple:
+    """
+    The markets and prices, leaving out any market whose price is nan or infinite. The scripts would 
+    otherwise fail to parse it, failing the whole transaction they are queued in
+    """
+
+    prices = np.asarray(prices, dtype=np.float64)
+    keep = np.isfinite(prices)
+
+    return [market for market, k in zip(markets, keep) if k], prices[keep].tolist()
+
+
+def record_prices(pipe: redis.client.Pipeline, markets: list, prices: list) -> None:
+    """
+    Add commands to a pipeline to fold the new long price of each market into the latest bucket
+    of each of its horizons. The markets must all be on the pipeline's shard. Markets with a non-finite 
+    price are left out
+    """
+
+    markets, prices = _finite(markets, prices)
+
+    if len(markets) == 0:
+        return
+
+    keys = [candle_key(market, horizon) for market in markets for horizon in CANDLE_HORIZONS]
+    args = [repr(price) for price in prices for horizon in CANDLE_HORIZONS]
+
+    _record(keys=keys, args=args, client=pipe)
+
+
+def roll_candles(pipe: redis.client.Pipeline, markets: list, prices: list, horizons: list, t: int) -> None:
+    """
+    Add commands to a pipeline to open a new bucket at time t for each of a list of horizons, for each
+    market, starting at that market's current long price. The markets must all be on the pipeline's shard. 
+    Markets with a non-finite price get no new bucket, which is harmless as each bucket keeps its own time
+    """
+
+    markets, prices = _finite(markets, prices)
+
+    if len(markets) == 0 or len(horizons) == 0:
+        return
+
+    keys = [candle_key(market, horizon) for market in markets for horizon in horizons]
+    args = [t]
+
+    for price in prices:
+        for horizon in horizons:
+            args += [repr(price), MAX_CANDLES[horizon], 1 if horizon == 'M' else 0]
+
+    _roll(keys=keys, args=args, client=pipe)
+
+
+def seed_candles(pipe: redis.client.Pipeline, market: str, horizon: str, times: list, prices: list) -> None:
+    """
+    Add a command to a pipeline to create the buckets for a horizon from point samples of the long price,
+    with open, high, low and close all equal to the sample, unless there are already buckets for it. The
+    samples and times line up from the end. Non-finite samples are dropped along with their times.
+    """
+
+    n = min(len(times), len(prices), MAX_CANDLES[horizon])
+
+    times = np.asarray(times[len(times) - n:], dtype=np.float64)
+    prices = np.asarray(prices[len(prices) - n:], dtype=np.float64)
+    keep = np.isfinite(prices)
+
+    if not keep.any():
+        return
+
+    records = np.empty((keep.sum(), 5), dtype='<f8')
+    records[:, 0] = times[keep]
+    records[:, 1:] = prices[keep].reshape(-1, 1)
+
+    pipe.set(candle_key(market, horizon), records.tobytes(), nx=True)
+
+
+def unpack_candles(data: bytes, t_from: int=None, t_to: int=None) -> dict:
+    """
+    Unpack a candle record string into {'t': [...], 'o': [...], 'h': [...], 'l': [...], 'c': [...]}, keeping
+    only the buckets that opened between t_from and t_to inclusive
+    """
+
+    records = np.frombuffer(data or b'', dtype='<f8').reshape(-1, 5)
+
+    start = np.searchsorted(records[:, 0], t_from, side='left') if t_from is not None else 0
+    stop = np.searchsorted(records[:, 0], t_to, side='right') if t_to is not None else len(records)
+    records = records[start:stop]
+
+    return {'t': records[:, 0].astype(np.int64).tolist(),
+            'o': records[:, 1].tolist(),
+            'h': records[:, 2].tolist(),
+            'l': records[:, 3].tolist(),
+            'c': records[:, 4].tolist()}
+
+
+def get_candles(markets: list, horizons: list, t_from: int=None, t_to: int=None) -> list:
+    """
+    Get the candles for each of a list of markets and horizons, optionally between two times. Return a 
+    list with {horizon: candles} for each market, in the form given by unpack_candles
+    """
+
+    def queue(pipe, market):
+        for horizon in horizons:
+            pipe.get(candle_key(market, horizon))
+
+    results = shards.execute(markets, queue, clients=shards.read_clients(), read_only=True)
+
+    return [{horizon: unpack_candles(data, t_from, t_to) for horizon, data in zip(horizons, market_results)} for market_results in results]
@@ -0,0 +1,143 @@
+import time
+import queue
+import redis
+import orjson
+import logging
+import threading
+from src.redis_utils.versions import PRICE_CHANNEL
+from src.redis_utils.connection import subscriber, PRIMARY_HOST, PRIMARY_PORT
+
+# the subscription waits on the server indefinitely, so it comes from a pool with no socket timeout
+redis_db = subscriber(PRIMARY_HOST, PRIMARY_PORT)
+
+
+class Subscription:
+    """
+    A single client's subscription to price updates for a set of markets. Messages are raw JSON
+    bytes, as published by bump_versions. If the client falls too far behind, the subscription
+    is closed rather than letting the queue grow without bound.
+    """
+
+    def __init__(self, markets: set, maxsize: int):
+        self.markets = markets
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+    def put(self, message: bytes) -> None:
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.closed = True
+
+    def get(self, timeout: float):
+        """
+        Wait up to timeout seconds for the next message, returning None if there isn't one
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class PriceFeed:
+    """
+    Fans out the price updates published on PRICE_CHANNEL to the subscribers in this process.
+    A single background thread holds one pubsub connection for the whole process, and hands
+    each message to the subscribers of that market only. The thread is started with the first
+    subscription and reconnects if the connection drops.
+    """
+
+    def __init__(self, redis_db: redis.Redis=redis_db, maxsize: int=256):
+
+        self.redis_db = redis_db
+        self.maxsize = maxsize
+
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.thread = None
+
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, markets: list) -> Subscription:
+
+        subscription = Subscription(set(markets), self.maxsize)
+
+        with self.lock:
+
+            for market in subscription.markets:
+                self.subscribers.setdefault(market, set()).add(subscription)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='PriceFeed', daemon=True)
+                self.thread.start()
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+
+        with self.lock:
+
+            for market in subscription.markets:
+
+                subscribers = self.subscribers.get(market)
+
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if len(subscribers) == 0:
+                        del self.subscribers[market]
+
+    def dispatch(self, message: bytes) -> None:
+        """
+        Hand a published message to every subscriber of its market
+        """
+
+        self.received += 1
+        market = orjson.loads(message)['m']
+
+        with self.lock:
+            subscribers = list(self.subscribers.get(market, ()))
+
+        for subscription in subscribers:
+
+            subscription.put(message)
+
+            if subscription.closed:
+                self.dropped += 1
+                self.unsubscribe(subscription)
+            else:
+                self.delivered += 1
+
+    def _run(self) -> None:
+
+        while True:
+
+            pubsub = self.redis_db.pubsub(ignore_subscribe_messages=True)
+
+            try:
+                pubsub.subscribe(PRICE_CHANNEL)
+
+                for message in pubsub.listen():
+                    try:
+                        self.dispatch(message['data'])
+                    except Exception as E:
+                        logging.error(f'PriceFeed failed to dispatch a message: {E}')
+
+            except redis.ConnectionError as E:
+                logging.warning(f'PriceFeed lost its connection to Redis: {E}. Reconnecting')
+                time.sleep(1)
+
+            finally:
+                pubsub.close()
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            subscriptions = set().union(*self.subscribers.values()) if len(self.subscribers) > 0 else set()
+
+        return {'subscribers': len(subscriptions),
+                'markets': len(self.subscribers),
+                'received': self.received,
+                'delivered': self.delivered,
+                'dropped': self.dropped}
@@ -1,106 +1,372 @@
-import redis
+from time import sleep
 import orjson
+import logging
+from bisect import bisect_left, bisect_right
+from typing import Tuple
 from src.redis_utils.exceptions import ResourceNotFoundError
+from src.redis_utils.connection import replica, shards
+from src.redis_utils.holdings_cache import HoldingsCache
+from src.redis_utils.history_snapshot import HistorySnapshot
 
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+# History is only read here, so shard 0's part of it comes from a replica when there is a healthy one (see 
+# connection.py). Each read returns the epoch it saw alongside the data, so responses are still cached and tagged 
+# consistently. Current holdings are read from the shards themselves by holdings_cache, as they are read with 
+# their versions and must never be older than what a purchase has just written.
 
+# the current holdings of recently read markets, kept in step with redis by CLIENT TRACKING invalidations
+holdings_cache = HoldingsCache()
 
-def get_latest_quantities(market: str) -> dict:
+# the historical holdings and long prices of every market, mapped from the file the scheduler writes each tick
+history_snapshot = HistorySnapshot()
+
+HORIZONS = ['h', 'd', 'w', 'm', 'M']
+
+# times a history read spanning several shards is tried before settling for whatever epochs it saw
+HISTORY_READ_ATTEMPTS = 3
+
+
+def get_latest_quantities(market: str, version: int=None) -> dict:
     """
     Get the latest quantities (x and b or N and b) for a given market. If the market is 
     not found in Redis, raise a ResourceNotFoundError. 
     """
 
-    result = redis_db.get(market)
+    return orjson.loads(get_latest_quantities_raw(market, version))
+
+
+def splice_json(items: list) -> bytes:
+    """
+    Build a JSON object from a list of (key, raw JSON bytes) pairs, without parsing the values. 
+    Values of None become null. 
+    """
+
+    return b'{' + b','.join(orjson.dumps(key) + b':' + (value if value is not None else b'null') for key, value in items) + b'}'
+
+
+def get_latest_quantities_raw(market: str, version: int=None) -> bytes:
+    """
+    As get_latest_quantities, but return the JSON bytes exactly as stored in Redis. Current holdings 
+    are served from holdings_cache. If the market's version has already been read from Redis, pass
+    it in to make sure the result is at least that new
+    """
+
+    result, = holdings_cache.get_raw([market], [version] if version is not None else None)
 
     if result is None:
         raise ResourceNotFoundError
 
-    return orjson.loads(result)
+    return result
 
 
-def get_multiple_latest_quantities(markets: list) -> dict:
+def get_multiple_latest_quantities(markets: list, versions: list=None) -> dict:
     """
     Given a list of markets, return the current quantities as above for each. If a 
     particular market is not found in Redis, its associated entry will be None. No
     error will be raised. 
     """
 
-    with redis_db.pipeline() as pipe:
+    results = holdings_cache.get_raw(markets, versions)
 
-        for market in markets:
+    return {market: orjson.loads(result) if result is not None else None for market, result in zip(markets, results)}
 
-            pipe.get(market)
 
-        results = pipe.execute()
+def get_multiple_latest_quantities_raw(markets: list, versions: list=None) -> Tuple[bytes, list]:
+    """
+    As get_multiple_latest_quantities, but return the response JSON bytes, built by splicing 
+    together the values stored in Redis, along with a list of the markets that were missing
+    """
 
-    return {market: orjson.loads(result) if result is not None else None for market, result in zip(markets, results)}
+    results = holdings_cache.get_raw(markets, versions)
+
+    missing = [market for market, result in zip(markets, results) if result is None]
+
+    return splice_json(zip(markets, results)), missing
+
+
+def get_latest_raws(markets: list, versions: list=None) -> tuple:
+    """
+    The JSON bytes stored in Redis for the current holdings of each of a list of markets, with None for
+    markets that are missing, for callers that need the raw values themselves, e.g. to derive an ETag. 
+    Return them along with the version of each, which is 0 for missing markets
+    """
+
+    return holdings_cache.get(markets, versions)
+
+
+def get_missing_markets(markets: list) -> list:
+    """
+    The markets in a list that have no current or historical holdings in Redis, and so cannot be traded
+    or scheduled yet
+    """
+
+    def queue(pipe, market):
+        pipe.exists(market)
+        pipe.exists(market + ':hist')
+
+    results = shards.execute(markets, queue, read_only=True)
+
+    return [market for market, exists in zip(markets, results) if not all(exists)]
+
+
+def get_market_maker(market: str):
+    """
+    The market maker for the latest quantities of a market, reused until the market next trades. If
+    the market is not found in Redis, raise a ResourceNotFoundError. 
+    """
+
+    maker = holdings_cache.get_market_maker(market)
+
+    if maker is None:
+        raise ResourceNotFoundError
+
+    return maker
+
+
+def get_history_epoch() -> int:
+    """
+    Get the current history epoch. The scheduler moves this on every time it publishes new historical 
+    quantities, and never reuses one, so it can be used to check whether a cached response is stale. 
+    """
+
+    epoch = replica().get('hist_epoch')
+
+    return int(epoch) if epoch is not None else 0
+
+
+def _read_history(markets: list, keys) -> Tuple[list, bytes, int]:
+    """
+    Read the keys given by keys(market) for each of a list of markets, along with the raw time log and the 
+    history epoch. The scheduler publishes each shard's historical quantities in one transaction with that 
+    shard's copy of the time log and epoch, and each shard is read here in one transaction, so its part is 
+    always consistent with itself. Shards are published one after another, so if they disagree on the epoch 
+    the read caught a publish midway, and is tried again. Return a list with the values read for each market, 
+    the time log and the epoch.
+    """
+
+    clients = shards.read_clients()
+
+    for attempt in range(HISTORY_READ_ATTEMPTS):
+
+        groups = shards.group(markets, read_only=True)
+        groups.setdefault(0, [])
+
+        out = [None] * len(markets)
+        logs = {}
+
+        def run(shard: int, members: list) -> None:
+
+            with clients[shard].pipeline(transaction=True) as pipe:
+
+                for i in members:
+                    for key in keys(markets[i]):
+                        pipe.get(key)
+
+                pipe.get('time')
+                pipe.get('hist_epoch')
+
+                results = pipe.execute()
+
+            n = (len(results) - 2) // len(members) if len(members) > 0 else 0
+
+            for j, i in enumerate(members):
+                out[i] = results[j * n:(j + 1) * n]
+
+            logs[shard] = (results[-2], int(results[-1]) if results[-1] is not None else 0)
+
+        shards.run(groups, run)
+
+        epochs = {epoch for t, epoch in logs.values()}
+
+        if len(epochs) == 1:
+            break
 
+        sleep(0.05)
 
-def get_historical_quantities(market: str) -> dict:
+    else:
+        logging.warning(f'History read saw epochs {sorted(epochs)} across shards after {HISTORY_READ_ATTEMPTS} attempts')
+
+    return out, logs[0][0], min(epochs)
+
+
+def _get_history(markets: list) -> Tuple[list, bytes, int]:
+    """
+    Read the raw historical quantities for a list of markets, the raw time log, and the history
+    epoch, all consistent with each other (see _read_history)
+    """
+
+    results, time, epoch = _read_history(markets, lambda market: [market + ':hist'])
+
+    return [data for data, in results], time, epoch
+
+
+def get_historical_quantities(market: str) -> Tuple[dict, int]:
     """
     Get the historical quantities associted with a market. This will be a dict
     with two keys, 'data' and 'time'. Data contains the time series quantities
-    for x/N and b, with hdwmM for each. If the market is not found, raise a 
-    ResourceNotFoundError. 
+    for x/N and b, with hdwmM for each. The history epoch these came from is 
+    also returned. If the market is not found, raise a ResourceNotFoundError. 
     """
 
-    with redis_db.pipeline() as pipe:
-
-        pipe.get(market + ':hist')
-        pipe.get('time')
-        
-        data, time = pipe.execute()
+    (data, ), time, epoch = _get_history([market])
 
     if data is None:
         raise ResourceNotFoundError
     
+    return {'data': orjson.loads(data), 'time': orjson.loads(time)}, epoch
+
+
+def get_multiple_historical_quantities(markets: list) -> Tuple[dict, int]:
+    """
+    As above, but now 'data' is indexed by market. 
+    """
+
+    results, time, epoch = _get_history(markets)
+
     time = orjson.loads(time)
-    data = orjson.loads(data)
+    data =  {market: orjson.loads(result) if result is not None else None for market, result in zip(markets, results)}
 
-    # ensure lengths are consistent
-    for th in ['h', 'd', 'w', 'm', 'M']:
-        nt = len(time[th])
-        if len(data['b'][th]) != nt:
-            data['b'][th] = data['b'][th][:nt]
+    return {'data': data, 'time': time}, epoch
 
-    return {'data': data, 'time': time}
+
+def get_historical_quantities_raw(market: str) -> Tuple[bytes, int]:
+    """
+    As get_historical_quantities, but return the response JSON bytes built from the values 
+    stored in Redis, without parsing them
+    """
+
+    (data, ), time, epoch = _get_history([market])
+
+    if data is None:
+        raise ResourceNotFoundError
+
+    return splice_json([('data', data), ('time', time)]), epoch
 
 
-def get_multiple_historical_quantities(markets: list) -> dict:
+def get_multiple_historical_quantities_raw(markets: list) -> Tuple[bytes, int, list]:
     """
-    As above, but now 'data' is indexed by market. 
+    As get_multiple_historical_quantities, but return the response JSON bytes built from the 
+    values stored in Redis, along with the epoch and a list of the markets that were missing
     """
 
-    with redis_db.pipeline() as pipe:
+    results, time, epoch = _get_history(markets)
+
+    missing = [market for market, result in zip(markets, results) if result is None]
+
+    return splice_json([('data', splice_json(zip(markets, results))), ('time', time)]), epoch, missing
+
 
-        for market in markets:
+def get_historical_quantities_compressed(market: str, encoding: str) -> Tuple[bytes, int]:
+    """
+    Get the historical quantities response for a market as pre-compressed by the scheduler with a 
+    particular encoding (see redis_utils.encodings), along with its history epoch. If there is no 
+    compressed response for the market, e.g. because it was created since the last tick, None is 
+    returned in its place.
+    """
 
-            pipe.get(market + ':hist')
+    ((body, ), ), time, epoch = _read_history([market], lambda market: [f'{market}:hist:{encoding}'])
 
-        pipe.get('time')
-        
-        results = pipe.execute()
+    return body, epoch
 
-    time = orjson.loads(results[-1])
-    data =  {market: orjson.loads(result) if result is not None else None for market, result in zip(markets, results[:-1])}
 
-    # ensure lengths are consistent
-    for th in ['h', 'd', 'w', 'm', 'M']:
-        nt = len(time[th])
-        for market in markets:
-            if len(data[market]['b'][th]) != nt:
-                data[market]['b'][th] = data[market]['b'][th][:nt]
+def _time_slice(times: list, t_from: int=None, t_to: int=None) -> slice:
+    """
+    The slice of a sorted list of timestamps that falls between t_from and t_to inclusive
+    """
+
+    start = bisect_left(times, t_from) if t_from is not None else 0
+    stop = bisect_right(times, t_to) if t_to is not None else len(times)
+
+    return slice(start, stop)
+
+
+def _take(values: list, n_times: int, s: slice) -> list:
+    """
+    Apply a slice of the time log to a list of historical values. The two are appended to together, so 
+    they line up from the end even if their lengths differ
+    """
+
+    offset = len(values) - n_times
+
+    return values[max(s.start + offset, 0):max(s.stop + offset, 0)]
+
+
+def get_historical_quantities_projected(markets: list, horizons: list, t_from: int=None, t_to: int=None) -> Tuple[list, dict, int]:
+    """
+    As get_multiple_historical_quantities, but for only some of the horizons, and only the entries with 
+    timestamps between t_from and t_to. Return a list with the projected historical quantities of each 
+    market (None if it is missing), the matching part of the time log and the history epoch. 
+
+    If the history snapshot for the current epoch has every market, the quantities are numpy arrays viewing
+    the snapshot. Otherwise each horizon is read from its own 'market:horizon:<th>' record, so only the 
+    requested horizons are fetched from redis. If any of these do not exist yet, the full historical 
+    quantities are read instead.
+    """
+
+    epoch = get_history_epoch() if history_snapshot.exists() else None
+    snapshot = history_snapshot.get(epoch) if epoch is not None else None
+
+    if snapshot is not None and all(market in snapshot for market in markets):
+        all_horizons = [snapshot.horizons(market, horizons) for market in markets]
+        return _project(all_horizons, snapshot.time, horizons, t_from, t_to) + (epoch, )
+
+    results, time, epoch = _read_history(markets, lambda market: [f'{market}:horizon:{th}' for th in horizons])
+
+    if all(part is not None for parts in results for part in parts):
+        all_horizons = [[orjson.loads(part) for part in parts] for parts in results]
+
+    else:
+        all_hist, time, epoch = _get_history(markets)
+        all_horizons = [[{k: hist[k][th] for k in hist} for th in horizons] if hist is not None else None for hist in all_hist]
+
+    return _project(all_horizons, orjson.loads(time), horizons, t_from, t_to) + (epoch, )
+
+
+def get_long_prices_projected(markets: list, horizons: list, t_from: int=None, t_to: int=None) -> Tuple[list, dict, int]:
+    """
+    The long price series of each market, projected like get_historical_quantities_projected, as numpy arrays
+    viewing the history snapshot. Return a list with {th: prices} for each market, the matching part of the 
+    time log and the history epoch, or None if the snapshot is not at the current epoch or is missing any of 
+    the markets. The scheduler has already priced every entry, so nothing is computed here.
+    """
+
+    if not history_snapshot.exists():
+        return None
+
+    epoch = get_history_epoch()
+    snapshot = history_snapshot.get(epoch)
+
+    if snapshot is None or not all(market in snapshot for market in markets):
+        return None
+
+    all_horizons = [[{'p': prices} for prices in snapshot.prices(market, horizons)] for market in markets]
+    all_prices, time = _project(all_horizons, snapshot.time, horizons, t_from, t_to)
+
+    return [prices['p'] for prices in all_prices], time, epoch
+
+
+def _project(all_horizons: list, time: dict, horizons: list, t_from: int=None, t_to: int=None) -> Tuple[list, dict]:
+    """
+    Given a list with, for each market, a list of the values for each horizon ({'x': [...], 'b': [...]} etc) 
+    or None, and the full time log, keep only the entries with timestamps between t_from and t_to. Return 
+    the projected values for each market as {'x': {th: [...]}, 'b': {th: [...]}}, and the projected time log
+    """
+
+    slices = {th: _time_slice(time[th], t_from, t_to) for th in horizons}
 
-    return {'data': data, 'time': time}
+    out = []
 
+    for market_horizons in all_horizons:
 
-# def ensure_historical_data_consistent(hist_data: dict):
+        if market_horizons is None:
+            out.append(None)
+            continue
 
-#     time_lens = {th: len(array) for th, array in hist_data['time'].items()}
+        hist = {}
 
-#     if 'b' in hist_data['data']:
-#         pass
-#     else:
+        for th, horizon in zip(horizons, market_horizons):
+            for k, values in horizon.items():
+                hist.setdefault(k, {})[th] = _take(values, len(time[th]), slices[th])
 
+        out.append(hist)
 
+    return out, {th: time[th][slices[th]] for th in horizons}
@@ -0,0 +1,144 @@
+import time
+import logging
+import argparse
+from src.redis_utils.registry import MarketRegistry
+from src.redis_utils.versions import repair_versions
+from src.redis_utils.connection import primary, shards, SHARD_MAP_KEY, SHARD_VERSION_KEY, SHARD_FROZEN_KEY, SHARD_CHECK_INTERVAL
+
+# Moves a league's markets from one shard to another (see connection.py). Run from the flask container, e.g.
+#
+#     python -m src.redis_utils.rebalance --status
+#     python -m src.redis_utils.rebalance --league 8 --to 1 --dry-run
+#     python -m src.redis_utils.rebalance --league 8 --to 1
+#
+# The league is frozen first, so that trades on it are turned away and the scheduler skips it, then every
+# key of its markets is copied to the new shard with MIGRATE COPY, checked, and the league reassigned before
+# the keys are removed from the old shard. Reads carry on from the old shard throughout. A scheduler tick
+# already under way when the league is frozen still finishes it, so run this between ticks, or pass a --wait
+# longer than a tick.
+
+redis_db = primary()
+
+# keys moved in one MIGRATE
+BATCH_SIZE = 200
+
+
+def league_keys(client, league: str, markets: set) -> list:
+    """
+    Every key on a shard belonging to one of a set of markets in a league: the market itself and 'market:*'
+    """
+
+    keys = []
+
+    for key in client.scan_iter(match=f'*:{league}:*', count=1000):
+        key = key.decode()
+        if ':'.join(key.split(':')[:3]) in markets:
+            keys.append(key)
+
+    return keys
+
+
+def bump() -> None:
+    redis_db.incr(SHARD_VERSION_KEY)
+
+
+def move_league(league: str, to: int, wait: float, dry_run: bool=False) -> int:
+    """
+    Move every key of a league's markets to shard to. Return the number of keys moved
+    """
+
+    if not 0 <= to < len(shards):
+        raise ValueError(f'There is no shard {to}. Shards are {shards.names}')
+
+    shards.refresh(force=True)
+    source = shards.shard(f'0:{league}:0', read_only=True)
+
+    if source == to:
+        raise ValueError(f'League {league} is already on shard {to}')
+
+    registry = MarketRegistry(redis_db)
+    markets = set(registry.teams(league) + registry.players(league))
+    keys = league_keys(shards.clients[source], league, markets)
+
+    logging.info(f'League {league}: {len(markets)} markets, {len(keys)} keys on {shards.names[source]}, to move to {shards.names[to]}')
+
+    if dry_run:
+        return len(keys)
+
+    redis_db.sadd(SHARD_FROZEN_KEY, league)
+    bump()
+
+    try:
+        # every process reloads the map within SHARD_CHECK_INTERVAL, and writes begun before then finish
+        logging.info(f'League {league} frozen. Waiting {wait:.0f}s for writes to settle')
+        time.sleep(wait)
+
+        # pending version bumps are kept per shard rather than per market, so they are not moved with the keys
+        repair_versions()
+
+        # anything written since the first scan is picked up here
+        keys = league_keys(shards.clients[source], league, markets)
+        host, port = shards.names[to].split(':')
+
+        for i in range(0, len(keys), BATCH_SIZE):
+            shards.clients[source].migrate(host, int(port), keys[i:i + BATCH_SIZE], 0, 5000, copy=True, replace=True)
+
+        missing = [key for key in keys if not shards.clients[to].exists(key)]
+
+        if len(missing) > 0:
+            raise RuntimeError(f'{len(missing)} keys did not arrive on {shards.names[to]}, e.g. {missing[:5]}')
+
+        with redis_db.pipeline(transaction=True) as pipe:
+            pipe.hset(SHARD_MAP_KEY, league, to)
+            pipe.srem(SHARD_FROZEN_KEY, league)
+            pipe.incr(SHARD_VERSION_KEY)
+            pipe.execute()
+
+    except BaseException:
+        # the old shard still has everything, so thaw the league where it was
+        redis_db.srem(SHARD_FROZEN_KEY, league)
+        bump()
+        raise
+
+    logging.info(f'League {league} now on {shards.names[to]}. Waiting {wait:.0f}s before removing it from {shards.names[source]}')
+
+    # readers with the old map keep reading from the old shard until they reload it
+    time.sleep(wait)
+
+    for i in range(0, len(keys), BATCH_SIZE):
+        shards.clients[source].unlink(*keys[i:i + BATCH_SIZE])
+
+    return len(keys)
+
+
+def status() -> None:
+
+    shards.refresh(force=True)
+    stats = shards.stats()
+
+    for i, (name, client) in enumerate(zip(shards.names, shards.clients)):
+        leagues = sorted(league for league, shard in stats['assignments'].items() if shard == i)
+        print(f'{i}  {name:<24} {client.dbsize():>10} keys   leagues: {" ".join(leagues + (["(unassigned)"] if i == 0 else []))}')
+
+    print(f'map version {stats["version"]}, frozen: {stats["frozen"] or "none"}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Move a league between redis shards')
+    parser.add_argument('--league', help='the league id to move, e.g. 8')
+    parser.add_argument('--to', type=int, help='the index of the shard to move it to, 0 being the primary')
+    parser.add_argument('--wait', type=float, default=2 * SHARD_CHECK_INTERVAL + 5, help='seconds to let every process see a map change')
+    parser.add_argument('--dry-run', action='store_true', help='only count the keys that would be moved')
+    parser.add_argument('--status', action='store_true', help='show the shards and their leagues')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+
+    if args.status:
+        status()
+    elif args.league is None or args.to is None:
+        parser.error('--league and --to are required to move a league')
+    else:
+        n = move_league(args.league, args.to, args.wait, args.dry_run)
+        logging.info(f'{"Would move" if args.dry_run else "Moved"} {n} keys')
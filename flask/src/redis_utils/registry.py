@@ -0,0 +1,184 @@
+import time
+import redis
+import orjson
+import logging
+from src.redis_utils.connection import primary
+
+redis_db = primary()
+
+BASE_DIR = '/var/www'
+
+
+def market_league(market: str) -> str:
+    """
+    The league id of a market, which is the middle field of the market id e.g. '8' for 1:8:18378T
+    """
+    return market.split(':')[1]
+
+
+def market_type(market: str) -> str:
+    """
+    'team' or 'player', from the last character of the market id
+    """
+    return 'team' if market[-1] == 'T' else 'player'
+
+
+class MarketRegistry:
+    """
+    The set of markets that exist, stored in redis under the following keys:
+
+    'markets:version'           an integer, incremented every time the registry changes
+    'markets:meta'              hash mapping market to JSON metadata, e.g. {'league': '8', 'type': 'team', 'n': 20}
+
+    Instances keep an in-memory copy of the registry, built from 'markets:meta', including the markets
+    in each league. A league is listed for as long as it has at least one market. This is reloaded only
+    when 'markets:version' has changed, which is checked at most once every check_interval seconds.
+    Long-lived processes can therefore look up leagues and markets without going to redis, and pick up
+    markets added or removed at runtime.
+    """
+
+    def __init__(self, redis_db: redis.Redis=redis_db, check_interval: float=10):
+
+        self.redis_db = redis_db
+        self.check_interval = check_interval
+
+        self.version = None
+        self.last_checked = 0
+
+        self._meta = {}
+        self._leagues = {}
+
+    def refresh(self, force: bool=False) -> bool:
+        """
+        Reload the registry if the version in redis has changed. Unless force is True, this only
+        goes to redis if check_interval seconds have passed since the last check. Return whether
+        the registry was reloaded.
+        """
+
+        now = time.time()
+
+        if not force and now - self.last_checked < self.check_interval:
+            return False
+
+        self.last_checked = now
+        version = self.redis_db.get('markets:version')
+
+        if version is not None and version == self.version:
+            return False
+
+        with self.redis_db.pipeline() as pipe:
+            pipe.get('markets:version')
+            pipe.hgetall('markets:meta')
+            version, meta = pipe.execute()
+
+        self.version = version
+        self._meta = {market.decode(): orjson.loads(info) for market, info in meta.items()}
+        self._leagues = {}
+
+        for market, info in sorted(self._meta.items()):
+            self._leagues.setdefault(info['league'], {'team': [], 'player': []})[info['type']].append(market)
+
+        return True
+
+    def __contains__(self, market: str) -> bool:
+        self.refresh()
+        return market in self._meta
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self._meta)
+
+    def leagues(self) -> list:
+        self.refresh()
+        return sorted(self._leagues.keys())
+
+    def teams(self, league: str=None) -> list:
+        """
+        All team markets, or just those in a particular league
+        """
+        return self._markets('team', league)
+
+    def players(self, league: str=None) -> list:
+        """
+        All player markets, or just those in a particular league
+        """
+        return self._markets('player', league)
+
+    def _markets(self, kind: str, league: str=None) -> list:
+
+        self.refresh()
+
+        if league is not None:
+            return list(self._leagues.get(league, {}).get(kind, []))
+
+        return [market for league in sorted(self._leagues.keys()) for market in self._leagues[league][kind]]
+
+    def meta(self, market: str) -> dict:
+        """
+        The metadata for a market, or None if it is not registered
+        """
+        self.refresh()
+        return self._meta.get(market)
+
+    def add_markets(self, outcomes: dict) -> None:
+        """
+        Register markets, given a dict mapping market to its number of outcomes
+        """
+
+        with self.redis_db.pipeline() as pipe:
+
+            for market, n in outcomes.items():
+
+                pipe.hset('markets:meta', market, orjson.dumps({'league': market_league(market), 'type': market_type(market), 'n': n}))
+
+            pipe.incr('markets:version')
+            pipe.execute()
+
+        self.refresh(force=True)
+
+    def remove_markets(self, markets: list) -> None:
+        """
+        Remove markets from the registry. Their holdings in redis are left untouched.
+        """
+
+        with self.redis_db.pipeline() as pipe:
+
+            if len(markets) > 0:
+                pipe.hdel('markets:meta', *markets)
+
+            pipe.incr('markets:version')
+            pipe.execute()
+
+        self.refresh(force=True)
+
+    def populate_from_files(self) -> None:
+        """
+        Register every market listed in data/teams.txt and data/players.txt that has current holdings in
+        redis. This is used to create the registry from the files it replaces.
+        """
+
+        with open(f'{BASE_DIR}/data/teams.txt', 'r') as f:
+            markets = f.read().splitlines()
+
+        with open(f'{BASE_DIR}/data/players.txt', 'r') as f:
+            markets += f.read().splitlines()
+
+        with self.redis_db.pipeline() as pipe:
+
+            for market in markets:
+                pipe.get(market)
+
+            results = pipe.execute()
+
+        outcomes = {}
+
+        for market, current in zip(markets, results):
+
+            if current is None:
+                logging.error(f'MarketRegistry: {market} is missing from Redis and will not be registered')
+                continue
+
+            current = orjson.loads(current)
+            outcomes[market] = len(current['x']) if 'x' in current else 2
+
+        self.add_markets(outcomes)
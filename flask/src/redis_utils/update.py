@@ -1,6 +1,11 @@
-import redis
-
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+from src.redis_utils.versions import bump_versions, record_holdings
+from src.redis_utils.connection import shards
 
 def update_b_redis(market: str, value: str):
-    redis_db.hset(market, "b",  float(value))  # set to 67
\ No newline at end of file
+
+    with shards.client(market).pipeline() as pipe:
+        pipe.hset(market, "b",  float(value))  # set to 67
+        record_holdings(pipe, [market])
+        pipe.execute()
+
+    bump_versions([market])
\ No newline at end of file
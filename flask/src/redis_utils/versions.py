@@ -0,0 +1,226 @@
+import time
+import redis
+import orjson
+import hashlib
+from src.lmsr.contracts import long_price
+from src.redis_utils.ohlc import record_prices
+from src.redis_utils.connection import primary, shards
+
+redis_db = primary()
+
+# 'holdings_seq' is a global counter, incremented once for every market whose current holdings are written. 'holdings_log'
+# is a sorted set mapping each market to the value of the counter when its holdings last changed. The
+# score of a market is therefore its version, and the set doubles as a change log for delta syncing. Both
+# live on shard 0 (see connection.py), whichever shard the markets themselves are on.
+SEQ_KEY = 'holdings_seq'
+LOG_KEY = 'holdings_log'
+
+# price updates are published here, for PriceFeed to fan out to clients
+PRICE_CHANNEL = 'price_updates'
+
+# Every write of a market's current holdings also sets 'market:version' on the market's shard, in the same 
+# transaction, to the larger of its previous value plus one and the time in ms. This is the version of the 
+# holdings themselves, as opposed to their place in the log. It changes exactly when they do, and never goes 
+# back, even across a flush or restore.
+VERSION_SUFFIX = ':version'
+
+# Trades are written on their market's shard, but logged on shard 0, so the two cannot share a transaction.
+# Instead, each shard keeps 'holdings_pending', a hash mapping each market whose holdings have been written
+# but not yet logged to '<version> <price update message>' for the write. It is set in the same transaction
+# as the holdings, and cleared by bump_versions. If a writer dies in between, repair_versions bumps whatever
+# it left behind. The scheduler runs this every tick.
+PENDING_KEY = 'holdings_pending'
+
+# 'holdings_versions' maps each market to the version of the last write logged for it, on shard 0. Bumps of
+# older writes are dropped, so the log and the price updates follow the order the writes were made in, even
+# when their writers bump in the other order.
+VERSIONS_KEY = 'holdings_versions'
+
+# KEYS holds the version key of each market, then the pending hash. ARGV holds the time in ms, then the markets, 
+# then their price update messages. Return the new version of each market
+_mark = redis_db.register_script("""
+local n = #KEYS - 1
+local versions = {}
+for i = 1, n do
+    local version = string.format('%d', math.max(tonumber(redis.call('GET', KEYS[i]) or 0) + 1, tonumber(ARGV[1])))
+    redis.call('SET', KEYS[i], version)
+    redis.call('HSET', KEYS[n + 1], ARGV[1 + i], version .. ' ' .. ARGV[1 + n + i])
+    versions[i] = tonumber(version)
+end
+return versions
+""")
+
+# ARGV holds the number of markets n, then n markets, then n pending entries. Each market gets its own 
+# sequence number, so that paging through the log by score never splits a batch. Messages are JSON objects, 
+# and the new sequence number is spliced in at the front as 'v' before publishing. Empty messages are not 
+# published. Return the number of markets bumped.
+_bump = redis_db.register_script("""
+local n = tonumber(ARGV[1])
+local bumped = 0
+for i = 1, n do
+    local market = ARGV[1 + i]
+    local version, message = string.match(ARGV[1 + n + i], '^(%d+) (.*)$')
+    if tonumber(version) > tonumber(redis.call('HGET', KEYS[3], market) or 0) then
+        local seq = redis.call('INCR', KEYS[1])
+        redis.call('ZADD', KEYS[2], seq, market)
+        redis.call('HSET', KEYS[3], market, version)
+        if message ~= '' then
+            redis.call('PUBLISH', KEYS[4], '{"v":' .. seq .. ',' .. string.sub(message, 2))
+        end
+        bumped = bumped + 1
+    end
+end
+return bumped
+""")
+
+# KEYS[1] is a pending hash, and ARGV a market and the entry that was bumped for it. The entry is only cleared
+# if it has not been replaced by a newer write since
+_clear = redis_db.register_script("""
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+""")
+
+
+def version_key(market: str) -> str:
+    return market + VERSION_SUFFIX
+
+
+def price_update(market: str, current: dict, price: float) -> bytes:
+    """
+    The compact message published when a market's current holdings change, e.g.
+    {"m": "1:8:18378T", "p": 3.52, "x": [1, 2, 3], "b": 4000}, where p is the long price
+    """
+
+    return orjson.dumps({'m': market, 'p': price, **current})
+
+
+def record_holdings(pipe: redis.client.Pipeline, markets: list, currents: list=None) -> None:
+    """
+    Add commands to a pipeline on the shard holding a list of markets, to be queued in the same transaction 
+    as the write of their new current holdings. Each market moves to a new version, and is marked as pending 
+    in PENDING_KEY along with its price update message, so that bump_versions can log and publish it even if 
+    the writer dies first. If the new holdings are given, their long prices are folded into their candles. 
+    The last command queued returns the list of new versions.
+    """
+
+    if len(markets) == 0:
+        return
+
+    if currents is None:
+        messages = [b''] * len(markets)
+
+    else:
+        prices = [long_price(market, current) for market, current in zip(markets, currents)]
+        record_prices(pipe, markets, prices)
+        messages = [price_update(market, current, price) for market, current, price in zip(markets, currents, prices)]
+
+    _mark(keys=[version_key(market) for market in markets] + [PENDING_KEY], args=[int(time.time() * 1000)] + markets + messages, client=pipe)
+
+
+def _bump_pending(markets: list, entries: list) -> int:
+    """
+    Log and publish the pending entries read for a list of markets, None where there was none. Return the 
+    number of markets bumped, leaving out those whose entry is older than the last one bumped
+    """
+
+    pending = [(market, entry) for market, entry in zip(markets, entries) if entry is not None]
+
+    if len(pending) == 0:
+        return 0
+
+    return _bump(keys=[SEQ_KEY, LOG_KEY, VERSIONS_KEY, PRICE_CHANNEL], args=[len(pending)] + [market for market, entry in pending] + [entry for market, entry in pending])
+
+
+def bump_versions(markets: list) -> None:
+    """
+    Log each of a list of markets as changed and publish its price update, from the write of it pending in
+    PENDING_KEY, then clear the mark. This must be called after every write to a market's current holdings, 
+    once the write has been executed, so that the log never gets ahead of the holdings. If the market has been 
+    written again since, the newer write is the one bumped, and a bump of a write older than one already bumped 
+    is dropped.
+    """
+
+    if len(markets) == 0:
+        return
+
+    # a league frozen since the write still has its keys, and its pending marks, on the same shard
+    entries = [entry for entry, in shards.execute(markets, lambda pipe, market: pipe.hget(PENDING_KEY, market), read_only=True)]
+    _bump_pending(markets, entries)
+
+    bumped = dict(zip(markets, entries))
+    shards.execute([market for market in markets if bumped[market] is not None], lambda pipe, market: _clear(keys=[PENDING_KEY], args=[market, bumped[market]], client=pipe), read_only=True)
+
+
+def repair_versions() -> int:
+    """
+    Bump every write left pending on any shard by a writer that died between writing its holdings and 
+    bumping its version. Return the number of markets repaired
+    """
+
+    def repair(shard: int) -> int:
+
+        client = shards.clients[shard]
+        pending = client.hgetall(PENDING_KEY)
+
+        if len(pending) == 0:
+            return 0
+
+        repaired = _bump_pending([market.decode() for market in pending.keys()], list(pending.values()))
+
+        with client.pipeline(transaction=False) as pipe:
+            for market, entry in pending.items():
+                _clear(keys=[PENDING_KEY], args=[market, entry], client=pipe)
+            pipe.execute()
+
+        return repaired
+
+    return sum(shards.each(repair))
+
+
+def get_changes_since(version: int, limit: int) -> tuple:
+    """
+    Get the markets whose holdings have changed since version, a position in the log, oldest change first, 
+    up to a limit. Return the list of markets, the version of the holdings of each as last logged (see 
+    record_holdings), and the position the caller should ask from next time: the end of the log if everything 
+    was returned, otherwise the position of the last market returned.
+    """
+
+    with redis_db.pipeline(transaction=True) as pipe:
+        pipe.zrangebyscore(LOG_KEY, f'({version}', '+inf', start=0, num=limit, withscores=True)
+        pipe.get(SEQ_KEY)
+        changes, latest = pipe.execute()
+
+    markets = [market.decode() for market, score in changes]
+
+    # these may have moved on since the log was read, which only makes them newer
+    logged = redis_db.hmget(VERSIONS_KEY, markets) if len(markets) > 0 else []
+    versions = [int(logged_version) if logged_version is not None else 0 for logged_version in logged]
+
+    if len(changes) == limit:
+        return markets, versions, int(changes[-1][1])
+
+    return markets, versions, int(latest) if latest is not None else 0
+
+
+def _etag(parts: list) -> str:
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def holdings_etag(markets: list, versions: list, fmt: str='json') -> str:
+    """
+    A strong ETag for the current holdings of a list of markets serialized as fmt, from the version of each
+    (0 if missing). A market's version is set in the same transaction as its holdings (see record_holdings), 
+    so it changes whenever they do, before any bump of the log, and the holdings need not be read to check it
+    """
+    return _etag(['current', fmt] + markets + versions)
+
+
+def history_etag(markets: list, epoch: int, encoding: str=None, fmt: str='json', projection: tuple=None) -> str:
+    """
+    A strong ETag for the historical holdings of a list of markets. Every market's history changes
+    each time the scheduler publishes, so the history epoch is the version of every market's history. Epochs
+    are never reused, even across a flush or restore of redis (see RedisExtractor.publish_historical_holdings).
+    Each format, content encoding and projection (horizons, from, to) of the same response gets its own ETag.
+    """
+    return _etag(['hist', epoch, encoding, fmt, projection] + markets)
@@ -1,13 +1,11 @@
 
 import logging
 import os
-import numpy as np
-from itertools import groupby
 from concurrent.futures import ThreadPoolExecutor
 
-from lmsr.classic import LMSRMultiMarketMaker
-from lmsr.long_short import LongShortMultiMarketMaker
+from lmsr.contracts import long_price
 from scheduler_utils import Timer, RedisExtractor, firebase
+from snapshot import MarketSnapshot
 
 
 class FirebaseMarketJobs:
@@ -19,6 +17,9 @@ class FirebaseMarketJobs:
         * Push the long returns over different time horizons from d+
         * Push a mini time-series for the long price over different time horizons from d+
 
+    The time-series are read from the long price sparklines maintained by RedisJobs, so only the 
+    current long price needs to be calculated here.
+
     To be run once an hour
     """
 
@@ -41,36 +42,18 @@ class FirebaseMarketJobs:
         return out
 
 
-    def get_long_time_series(self, market: str, q: np.ndarray, current: dict, historical: dict, timeframe: str, team: bool):
+    def get_long_time_series(self, spark: list, current_price: float):
         """
-        For a particular market, a particular quantity (in this case always the long, which could be different
-        lengths), the current market JSON, the historical market JSON and a timeframe, return a time series
-        of the quantity value for that particular timeframe
+        For a particular market, take the sparkline of the long price kept by RedisJobs for a
+        timeframe along with the current long price, and return a time series of roughly 30 values
+        ending in the current price
         """
 
-        if team:
-            # we only want roughly 30 values in the time series, and definitely the current value
-            xs = historical['x'][timeframe][::len(historical['x'][timeframe]) // 30 + 1] + [current['x']]
-            bs = historical['b'][timeframe][::len(historical['b'][timeframe]) // 30 + 1] + [current['b']]
-
-            if len(xs) != len(bs):
-                logging.error(f'Cannot perform document update for {market}: len(bs) != len(xs)')
-                return None
-
-            return LMSRMultiMarketMaker(market, xs, bs).spot_value(q)
-        else:
-            # we only want roughly 30 values in the time series, and definitely the current value
-            Ns = historical['N'][timeframe][::len(historical['N'][timeframe]) // 30 + 1] + [current['N']]
-            bs = historical['b'][timeframe][::len(historical['b'][timeframe]) // 30 + 1] + [current['b']]
-
-            if len(Ns) != len(bs):
-                logging.error(f'Cannot perform document update for {market}: len(bs) != len(Ns)')
-                return None
-
-            return LongShortMultiMarketMaker(market, Ns, bs).spot_value(q)
+        # we only want roughly 30 values in the time series, and definitely the current value
+        return spark[::len(spark) // 30 + 1] + [current_price]
         
 
-    def get_document_updates(self, markets: list, timeframes: list, team: bool) -> dict:
+    def get_document_updates(self, markets: list, timeframes: list, team: bool, snapshot: MarketSnapshot) -> dict:
         """
         For a given list of markets and timeframes, return a dictionary indexed
         by market that contains the necessary information to update the firebase
@@ -85,29 +68,28 @@ class FirebaseMarketJobs:
             logging.error('Timeframes is empty!')
             return {}
 
-        all_current, all_hist = self.redis_extractor.get_current_and_historical_holdings(markets)
-
-        # if the first market is a team, they all should be!
-        if team:
-            n_markets = len(all_current[0]['x'])
-            q = np.exp(-np.linspace(0, n_markets - 1, n_markets) / 6)[::-1]
-        else:
-            q = [1, 0]
+        all_current = snapshot.get_current_holdings(markets)
+        all_spark = self.redis_extractor.get_sparklines(markets, timeframes)
 
         documents = {}
 
-        for market, current, hist in zip(markets, all_current, all_hist):
+        for market, current, sparks in zip(markets, all_current, all_spark):
             
-            if (current is None) or (hist is None):
-                logging.error(f'Cannot update market doc {timeframes} for {market}. Redis returned None')
+            if current is None:
+                logging.error(f'Cannot update market doc {timeframes} for {market}. Market is missing from the snapshot')
+                continue
+
+            if any(len(spark) == 0 for spark in sparks.values()):
+                logging.error(f'Cannot update market doc {timeframes} for {market}. Sparkline is missing from Redis')
                 continue
 
             documents[market] = {}
+            current_price = long_price(market, current)
 
             for timeframe in timeframes:
 
-                documents[market][f'long_price_hist.{timeframe}'] = self.get_long_time_series(market, q, current, hist, timeframe, team)
-                current_price, oldest_price = documents[market][f'long_price_hist.{timeframe}'][-1], documents[market][f'long_price_hist.{timeframe}'][0]
+                documents[market][f'long_price_hist.{timeframe}'] = self.get_long_time_series(sparks[timeframe], current_price)
+                oldest_price = documents[market][f'long_price_hist.{timeframe}'][0]
                 documents[market][f'long_price_returns_{timeframe}'] = current_price / oldest_price - 1
 
             documents[market]['long_price_current'] = current_price
@@ -115,13 +97,13 @@ class FirebaseMarketJobs:
         return documents
 
 
-    def get_document_batches(self, markets: list, timeframes: list, team: bool):
+    def get_document_batches(self, markets: list, timeframes: list, team: bool, snapshot: MarketSnapshot):
         """
         For a given list of markets and timeframes, make the necessary updates 
         to the firebase documents. 
         """
 
-        documents = self.get_document_updates(markets, timeframes, team)
+        documents = self.get_document_updates(markets, timeframes, team, snapshot)
 
         # send documents over in batches
         batches = []
@@ -139,7 +121,7 @@ class FirebaseMarketJobs:
         return batches
 
 
-    def update_all_markets(self, t: int):
+    def update_all_markets(self, t: int, snapshot: MarketSnapshot):
         """
         Run through all markets and make the necessary updates to firebase
         """
@@ -152,21 +134,15 @@ class FirebaseMarketJobs:
 
             with Timer() as team_timer:
 
-                with open('/var/www/data/teams.txt', 'r') as f:
-                    all_teams = f.read().splitlines()
-
                 # split on league, so all xs have the same length
-                for leagueId, teams in groupby(all_teams, key=lambda player: player.split(':')[1]):
-                    all_batches += self.get_document_batches(list(teams), timeframes, team=True)
+                for leagueId, teams in snapshot.team_leagues.items():
+                    all_batches += self.get_document_batches(teams, timeframes, True, snapshot)
 
             with Timer() as player_timer:
 
-                with open('/var/www/data/players.txt', 'r') as f:
-                    all_players = f.read().splitlines()
-
                 # split on league, just so we maintain a reasonable number of markets at a time
-                for leagueId, players in groupby(all_players, key=lambda player: player.split(':')[1]):
-                    all_batches += self.get_document_batches(list(players), timeframes, team=False)
+                for leagueId, players in snapshot.player_leagues.items():
+                    all_batches += self.get_document_batches(players, timeframes, False, snapshot)
 
         with Timer() as firebase_timer:
 
@@ -1,15 +1,18 @@
-from itertools import groupby
 import time
 from scheduler_utils import Timer, RedisExtractor
+from snapshot import MarketSnapshot
+from lmsr.contracts import long_price, long_price_series, price_histories
+from src.redis_utils.read_data import splice_json
+from src.redis_utils.encodings import compress_all
+from src.redis_utils.history_snapshot import write_history_snapshot
+from src.redis_utils.connection import primary, ShardMovingError
+import orjson
 import logging
-import redis
 
-## TODO: Under the current implementation, because the holdings vectors are not updated at exactly
-## the same time as the time log, they may be out of sync when a client makes a request. This will
-## only cause an error if they are not the same length. They should pretty much always be the same
-## length, as long as we initialise the holdings to have length 60. This is still not great though...
+redis_db = primary()
 
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+# the timeframes for which we keep a sparkline of the long price. These are read by FirebaseMarketJobs
+SPARK_TIMEFRAMES = ['d', 'w', 'm', 'M']
 
 class RedisJobs:
     """
@@ -26,6 +29,42 @@ class RedisJobs:
     At regular intervals, the current holding vector needs to be copied into the historical holding 
     vectors. That is what this class does. 
 
+    The first entry of each timeframe is also written to 'market1:heads' whenever the historical holdings
+    change, so that consumers needing only the start of each interval do not have to read the full history:
+
+    'market1:heads' {'x': {'h': [1, 2, 3, 4, ...], 'd': [...], ...},
+                     'b': {'h': 100, 'd': 100, ...}}
+
+    The new historical holdings and heads are first written to staging keys ('market1:hist:staged' and
+    'market1:heads:staged'). Once every market has been staged, they are renamed over the live keys in a
+    single transaction which also writes the new time log and moves on the 'hist_epoch' counter. A
+    client reading the historical holdings and the time log in one transaction therefore always sees
+    vectors and times from the same epoch.
+
+    Alongside this, a sparkline of the long price is kept for each of SPARK_TIMEFRAMES as a redis list,
+    'market1:spark:d' etc, holding the long price at each entry of the matching historical holdings.
+    Only the newest point has to be priced when a timeframe ticks.
+
+    The full /historical_holdings response for each market (its historical holdings together with the new 
+    time log) is also compressed with each of the encodings in redis_utils.encodings, and staged and published 
+    with the rest as 'market1:hist:br', 'market1:hist:gzip' etc. Responses are therefore compressed once per 
+    tick here, rather than by the server on every request.
+
+    Each timeframe of the historical holdings is also kept on its own, so that clients asking for a single 
+    horizon only need to read that one. Only the timeframes that change in a tick are rewritten:
+
+    'market1:horizon:d'  {'x': [[1, 2, 3, 4, ...], [2, 3, 4, 5, ...], ...], 'b': [...]}
+
+    Finally, once the new epoch is published, a new open/high/low/close bucket of the long price is opened for 
+    each timeframe that ticked (see redis_utils.ohlc). Trades keep the latest bucket of each up to date.
+
+    Market keys live on the shard holding their league (see redis_utils.connection), and a league that is being
+    moved between shards is skipped for the tick. Every shard keeps its own copy of the time log and epoch, 
+    written with its renames, and shard 0 publishes last.
+
+    Every tick, the full historical holdings of every market are then priced and written to a file, which the 
+    gunicorn workers in the same container map into memory (see redis_utils.history_snapshot).
+
     """
 
     def __init__(self):
@@ -44,7 +83,7 @@ class RedisJobs:
 
         return out
 
-    def update_all_historical_holdings(self, t: int):
+    def update_all_historical_holdings(self, t: int, snapshot: MarketSnapshot):
         """
         Go through all team and player markets and update the relevant holding vectors
         """
@@ -54,38 +93,87 @@ class RedisJobs:
 
         with Timer() as timer:
 
-            with open('/var/www/data/teams.txt', 'r') as f:
-                teams = f.read().splitlines()
+            redis_time, python_time = 0, 0
+            staged = {}
+            staged_keys = {}
+            all_hist = {}
 
-            redis_time, python_time = self.update_historical_holdings(teams, timeframes, team=True)
-
-            with open('/var/www/data/players.txt', 'r') as f:
-                all_players = f.read().splitlines()
+            # the time log is needed up front, to build the compressed responses
+            hist_times, max_interval_increment = self.get_new_time(timeframes)
+            time_json = orjson.dumps(hist_times)
 
             # split on league, just so we maintain a reasonable number at a time
-            for group, players in groupby(all_players, key=lambda player: player.split(':')[1]):
-                rtime, ptime = self.update_historical_holdings(list(players), timeframes, team=False)
-                redis_time += rtime
-                python_time += ptime
+            for leagues, team in [(snapshot.team_leagues, True), (snapshot.player_leagues, False)]:
+                for league, markets in leagues.items():
+
+                    try:
+                        staged_prices, keys, hist_new, rtime, ptime = self.update_historical_holdings(markets, timeframes, team, snapshot, time_json)
+
+                    except ShardMovingError:
+                        logging.warning(f'REDIS HOLDINGS t = {t}. Skipping league {league}, which is being moved between shards')
+                        continue
+
+                    staged.update(staged_prices)
+                    staged_keys.update(keys)
+                    all_hist.update(hist_new)
+                    redis_time += rtime
+                    python_time += ptime
+
+            with Timer() as publish_timer:
+                epoch = self.redis_extractor.publish_historical_holdings(staged_keys, hist_times, max_interval_increment)
+
+            if len(timeframes) > 0:
+                self.redis_extractor.roll_candles(staged, timeframes, hist_times[timeframes[0]][-1])
 
-        self.update_time(timeframes)
-        logging.info(f'REDIS HOLDINGS t = {t}. Completed update for timeframes {timeframes}. time: {timer.t:.4f}s \t redis time: {redis_time:.4f}s \t python time: {python_time:.4f}s')
+            with Timer() as snapshot_timer:
+                self.write_snapshot(epoch, hist_times, all_hist)
 
+        logging.info(f'REDIS HOLDINGS t = {t}. Completed update for timeframes {timeframes}, epoch {epoch}. time: {timer.t:.4f}s \t redis time: {redis_time:.4f}s \t python time: {python_time:.4f}s \t publish time: {publish_timer.t:.4f}s \t snapshot time: {snapshot_timer.t:.4f}s')
 
+    @staticmethod
+    def write_snapshot(epoch: int, hist_times: dict, all_hist: dict):
+        """
+        Price every entry of the historical holdings just published and write them all to the history snapshot
+        file for the gunicorn workers (see redis_utils.history_snapshot). A failure here only costs the workers
+        a trip to redis, so it is logged rather than raised
+        """
+
+        try:
+            markets = list(all_hist.keys())
+            all_prices = dict(zip(markets, price_histories([all_hist[market] for market in markets])))
+            size = write_history_snapshot(epoch, hist_times, all_hist, all_prices)
+            logging.info(f'REDIS HOLDINGS. Wrote history snapshot for epoch {epoch}: {len(markets)} markets, {size / 1e6:.1f}MB')
 
-    def update_historical_holdings(self, markets: list, timeframes: list, team: bool):
+        except Exception as E:
+            logging.error(f'REDIS HOLDINGS. Failed to write history snapshot for epoch {epoch}: {E}')
+
+
+
+    def update_historical_holdings(self, markets: list, timeframes: list, team: bool, snapshot: MarketSnapshot, time_json: bytes):
         """
-        Given a list of markets, and a particular timeframe, grab the current holdings and 
-        update the relevant historical holdings. Return the time taken for redis read and 
-        write operations, and the time taken for python operations
+        Given a list of markets, and a particular timeframe, read the live current holdings and 
+        stage the updated historical holdings, along with the compressed responses 
+        built from them and the new time log, time_json. Return a dict mapping each market that was
+        staged to its current long price, a dict mapping it to the live keys it staged, a dict mapping it to its new 
+        historical holdings, the time taken for redis read 
+        and write operations, and the time taken for python operations
         """
 
+        # the snapshot was taken at the start of the tick, so trades since then would be missed
         with Timer() as redis1_timer:
             all_current, all_hist = self.redis_extractor.get_current_and_historical_holdings(markets)
 
+        # later jobs in the tick see the holdings that went into the history
+        snapshot.update_current_holdings({market: current for market, current in zip(markets, all_current) if current is not None})
+
         with Timer() as python_timer:
 
             hist_new = {}
+            heads_new = {}
+            spark_new = {}
+            compressed_new = {}
+            horizons_new = {}
+            prices_new = {}
 
             for market, current, hist in zip(markets, all_current, all_hist):
 
@@ -94,15 +182,23 @@ class RedisJobs:
 
                 else:
 
+                    n_before = {timeframe: len(hist['b'][timeframe]) for timeframe in timeframes}
+
                     for timeframe in timeframes:
                         hist = self.get_new_historical_holdings(timeframe, current, hist, team)
 
                     hist_new[market] = hist
+                    heads_new[market] = self.get_horizon_heads(hist, team)
+                    spark_new[market] = self.get_new_sparkline_points(market, timeframes, current, hist, n_before, team)
+                    compressed_new[market] = compress_all(splice_json([('data', orjson.dumps(hist)), ('time', time_json)]))
+                    horizons_new[market] = self.get_horizons(hist, timeframes)
+                    prices_new[market] = long_price(market, current)
 
         with Timer() as redis2_timer:
-            self.redis_extractor.write_historical_holdings(hist_new)
+            staged_keys = self.redis_extractor.stage_historical_holdings(hist_new, heads_new, compressed_new, horizons_new)
+            self.redis_extractor.write_sparklines(spark_new)
 
-        return redis1_timer.t + redis2_timer.t, python_timer.t
+        return prices_new, staged_keys, hist_new, redis1_timer.t + redis2_timer.t, python_timer.t
 
 
     @staticmethod
@@ -134,14 +230,111 @@ class RedisJobs:
 
         return hist
 
+    @staticmethod
+    def get_horizon_heads(hist: dict, team: bool) -> dict:
+        """
+        Given a historical holdings dictionary, return the horizon heads dictionary holding the first entry 
+        of each timeframe
+        """
+
+        k = 'x' if team else 'N'
+
+        return {k:   {timeframe: values[0] for timeframe, values in hist[k].items()},
+                'b': {timeframe: values[0] for timeframe, values in hist['b'].items()}}
+
+    @staticmethod
+    def get_new_sparkline_points(market: str, timeframes: list, current: dict, hist: dict, n_before: dict, team: bool) -> dict:
+        """
+        Given the timeframes that have just been updated, return the sparkline changes in the form expected by
+        RedisExtractor.write_sparklines. Normally this is just the long price of the current holding, but when
+        the M timeframe has been thinned out the whole sparkline is recalculated from the historical holdings
+        """
+
+        k = 'x' if team else 'N'
+        spark_new = {}
+        price = None
+
+        for timeframe in timeframes:
+
+            if timeframe not in SPARK_TIMEFRAMES:
+                continue
+
+            n_after = len(hist['b'][timeframe])
+
+            # M has been thinned out, rather than having its oldest entry dropped
+            if timeframe == 'M' and n_after <= n_before[timeframe]:
+                spark_new[timeframe] = (long_price_series(market, hist[k][timeframe], hist['b'][timeframe], team), n_after, True)
+            else:
+                if price is None:
+                    price = long_price(market, current)
+                spark_new[timeframe] = ([price], n_after, False)
+
+        return spark_new
+
+    @staticmethod
+    def get_horizons(hist: dict, timeframes: list) -> dict:
+        """
+        Split the historical holdings for the given timeframes out into their own dicts, 
+        e.g. {'d': {'x': [[...], ...], 'b': [...]}, ...}
+        """
+        return {timeframe: {k: hist[k][timeframe] for k in hist} for timeframe in timeframes}
+
+    def rebuild_all_derived(self, snapshot: MarketSnapshot):
+        """
+        Recalculate every sparkline, horizon and horizon heads record from scratch using the historical holdings. This 
+        is run when the job process starts, so that they are in line with the historical holdings even if ticks
+        were missed or they do not exist yet. Candles for markets that have none are seeded from the historical
+        holdings too.
+        """
+
+        with Timer() as timer:
+
+            hist_times = self.redis_extractor.get_time()
+
+            for leagues, team in [(snapshot.team_leagues, True), (snapshot.player_leagues, False)]:
+                for league, markets in leagues.items():
+                    self.rebuild_derived(markets, team, hist_times)
+
+        logging.info(f'REDIS HOLDINGS. Rebuilt horizons, horizon heads and sparklines for timeframes {SPARK_TIMEFRAMES}. time: {timer.t:.4f}s')
+
+    def rebuild_derived(self, markets: list, team: bool, hist_times: dict):
+        """
+        Recalculate the sparklines, horizons and horizon heads for a list of markets from their historical holdings,
+        and seed candles for those that have none from the long price at each entry of the time log, hist_times
+        """
+
+        k = 'x' if team else 'N'
+        all_hist = self.redis_extractor.get_historical_holdings(markets)
+        heads_new = {}
+        spark_new = {}
+        horizons_new = {}
+        series_new = {}
+
+        for market, hist in zip(markets, all_hist):
+
+            if hist is None:
+                logging.error(f'Cannot rebuild sparklines for {market}. Redis returned None')
+                continue
+
+            heads_new[market] = self.get_horizon_heads(hist, team)
+            horizons_new[market] = self.get_horizons(hist, list(hist['b'].keys()))
+            series_new[market] = {timeframe: long_price_series(market, hist[k][timeframe], hist['b'][timeframe], team) for timeframe in hist['b']}
+            spark_new[market] = {timeframe: (series_new[market][timeframe], len(hist['b'][timeframe]), True) for timeframe in SPARK_TIMEFRAMES}
+
+        self.redis_extractor.write_historical_holdings({}, heads_new, horizons_new)
+        self.redis_extractor.write_sparklines(spark_new)
+        self.redis_extractor.seed_candles(series_new, hist_times)
+
 
-    def update_time(self, timeframes: list):
+    def get_new_time(self, timeframes: list):
         """
-        Make relevant entries into time log JSON
+        Make relevant entries into time log JSON. Return the new time log, and the amount max_interval
+        should be increased by (zero unless M has been thinned out)
         """
 
         hist_times = self.redis_extractor.get_time()
         t = int(time.time())
+        max_interval_increment = 0
 
         for timeframe in timeframes:
 
@@ -150,10 +343,10 @@ class RedisJobs:
             if timeframe == 'M':        
                 if len(hist_times['M']) > 120:
                     del hist_times['M'][1::2]
-                    redis_db.incr('max_interval', amount=int(redis_db.get('max_interval')))
+                    max_interval_increment = int(redis_db.get('max_interval'))
 
             else:
                 if len(hist_times[timeframe]) > 60:
                     del hist_times[timeframe][0]
 
-        self.redis_extractor.set_time(hist_times)
+        return hist_times, max_interval_increment
@@ -1,6 +1,7 @@
 import json
 import sys
 sys.path.append('/var/www/src')
+sys.path.append('/var/www')
 
 import os
 import logging
@@ -11,23 +12,49 @@ from redis_holdings import RedisJobs
 from firebase_markets import FirebaseMarketJobs
 from firebase_portfolios import FirebasePortfoliosJobs
 from trading_bot import TradingBot
+from scheduler_utils import RedisExtractor
+from snapshot import MarketSnapshot
+from src.redis_utils.registry import MarketRegistry
+from src.redis_utils.connection import primary
+from src.redis_utils.versions import repair_versions
 
 import time
-import redis
 
 from typing import List
 
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+redis_db = primary()
 
 
 class JobScheduler:
 
     def __init__(self):
 
+        self.redis_extractor = RedisExtractor()
+        self.registry = MarketRegistry()
+
+        # one-off migration from the teams.txt and players.txt files
+        if len(self.registry) == 0:
+            logging.info('Market registry is empty. Populating from teams.txt and players.txt')
+            self.registry.populate_from_files()
         self.redis_jobs = RedisJobs()
         self.firebase_market_jobs = FirebaseMarketJobs()
         self.firebase_portfolio_jobs = FirebasePortfoliosJobs()
-        self.trading_bot = TradingBot(trade_noise=True)
+        self.trading_bot = TradingBot(self.registry, trade_noise=True)
+
+        # make sure the horizon heads and long price sparklines line up with the historical holdings before the first tick
+        try:
+            self.redis_jobs.rebuild_all_derived(self.get_snapshot())
+        except Exception as E:
+            logging.error(f'Could not rebuild horizon heads and sparklines: {E}')
+
+
+    def get_snapshot(self) -> MarketSnapshot:
+        """
+        Build a snapshot of the current state of all registered team and player markets
+        """
+
+        self.registry.refresh(force=True)
+        return MarketSnapshot(self.redis_extractor, self.registry)
 
 
     def get_jobs(self, t: int):
@@ -59,12 +86,27 @@ class JobScheduler:
 
         t = int(redis_db.get('t'))
 
-        for job in self.get_jobs(t):
-            # must catch errors here so time is incremented
-            try:
-                job(t)
-            except Exception as E:
-                logging.error(str(E))
+        # finish the version bumps of any trades whose writer died before making them
+        try:
+            repaired = repair_versions()
+            if repaired > 0:
+                logging.warning(f'Repaired the versions of {repaired} markets left pending')
+        except Exception as E:
+            logging.error(f'Could not repair pending versions: {E}')
+
+        try:
+            # read the market state once and share it between all jobs in this tick
+            snapshot = self.get_snapshot()
+
+            for job in self.get_jobs(t):
+                # must catch errors here so time is incremented
+                try:
+                    job(t, snapshot)
+                except Exception as E:
+                    logging.error(str(E))
+
+        except Exception as E:
+            logging.error(f'Could not build market snapshot: {E}')
 
         redis_db.incr('t', amount=2)
 
@@ -2,8 +2,12 @@ import time
 # import json
 import redis
 import orjson
+import logging
 from firebase_admin import credentials, firestore, initialize_app
 from typing import Tuple, List
+from src.redis_utils.versions import bump_versions, record_holdings
+import src.redis_utils.ohlc as ohlc
+from src.redis_utils.connection import primary, replica, shards, ShardMovingError
 
 class Timer:
     """
@@ -35,66 +39,303 @@ class Timer:
 
 class RedisExtractor:
     """
-    Small class to group methods relating to reading and writing from Redis
+    Small class to group methods relating to reading and writing from Redis. Market keys are read and written on 
+    the shard holding each market's league, and the time log and epochs on shard 0 (see redis_utils.connection). 
+    Reads of the current and historical holdings and the time log feed straight back into writes, so they go to 
+    the shards themselves. Reads only used to build Firebase documents (horizon heads, sparklines) can go to a 
+    replica. Anything touching a league that is being moved between shards raises a ShardMovingError.
     """
 
     def __init__(self):
-        self.redis_db = redis.Redis(host='redis', port=6379, db=0)
+        self.redis_db = primary()
 
     def get_current_and_historical_holdings(self, markets: list) -> Tuple[List[dict], List[dict]]:
         """
         Get the raw (string) curent and historical holdings for a list of markets
         """
 
-        with self.redis_db.pipeline() as pipe:
+        def queue(pipe, market):
+            pipe.get(market)
+            pipe.get(market + ':hist')
 
-            for market in markets:
+        results = shards.execute(markets, queue)
 
-                pipe.get(market)
-                pipe.get(market + ':hist')
+        return ([orjson.loads(current) if current is not None else None for current, hist in results],
+                [orjson.loads(hist) if hist is not None else None for current, hist in results])
 
-            results = pipe.execute()
+    def get_current_holdings(self, markets: list):
 
-        return ([orjson.loads(result) if result is not None else None for result in results[::2]],
-                [orjson.loads(result) if result is not None else None for result in results[1::2]])
+        results = shards.execute(markets, lambda pipe, market: pipe.get(market))
 
-    def get_current_holdings(self, markets: list):
+        return [orjson.loads(result) if result is not None else None for result, in results]
+
+    def get_historical_holdings(self, markets: list) -> List[dict]:
+        """
+        Get the historical holdings for a list of markets
+        """
+
+        results = shards.execute(markets, lambda pipe, market: pipe.get(market + ':hist'))
+
+        return [orjson.loads(result) if result is not None else None for result, in results]
+
+    def get_horizon_heads(self, markets: list) -> List[dict]:
+        """
+        Get the horizon heads (the first entry of each historical holdings timeframe) for a list of markets
+        """
+
+        results = shards.execute(markets, lambda pipe, market: pipe.get(market + ':heads'), clients=shards.read_clients(), read_only=True)
+
+        return [orjson.loads(result) if result is not None else None for result, in results]
+
+    def get_sparklines(self, markets: list, timeframes: list) -> List[dict]:
+        """
+        Get the long price sparkline for each timeframe for a list of markets. Each sparkline
+        set comes back as a dict mapping timeframe to a list of floats
+        """
+
+        def queue(pipe, market):
+            for timeframe in timeframes:
+                pipe.lrange(f'{market}:spark:{timeframe}', 0, -1)
+
+        results = shards.execute(markets, queue, clients=shards.read_clients(), read_only=True)
+
+        return [{timeframe: [float(value) for value in values] for timeframe, values in zip(timeframes, result)} for result in results]
+
+    def write_sparklines(self, all_spark_new: dict) -> None:
+        """
+        Given a dictionary mapping string market to {timeframe: (points, length, replace)}, push the new
+        points onto the end of each sparkline and trim it to its last length values. If replace is True
+        the existing sparkline is discarded first
+        """
+
+        def queue(pipe, market):
+
+            for timeframe, (points, length, replace) in all_spark_new[market].items():
 
-        with self.redis_db.pipeline() as pipe:
+                key = f'{market}:spark:{timeframe}'
 
-            for market in markets:
-                pipe.get(market)
+                if replace:
+                    pipe.delete(key)
 
-            results = pipe.execute()
+                if len(points) > 0:
+                    pipe.rpush(key, *points)
+                    pipe.ltrim(key, -length, -1)
 
-        return [orjson.loads(result) if result is not None else None for result in results]
+        shards.execute(list(all_spark_new.keys()), queue, transaction=True)
 
-    def write_historical_holdings(self, all_hist_new: dict):
+    def write_historical_holdings(self, all_hist_new: dict, all_heads_new: dict, all_horizons_new: dict=None):
         """
-        Given a new dictionary mapping string market to historical holdings dict, send this to redis
+        Given a new dictionary mapping string market to historical holdings dict, and another mapping
+        string market to horizon heads dict, send these to redis. Optionally, all_horizons_new maps
+        string market to {timeframe: horizon dict}, and these are written to 'market:horizon:<timeframe>'
         """
 
-        with self.redis_db.pipeline() as pipe:
+        all_horizons_new = all_horizons_new or {}
 
-            for market, hist_new in all_hist_new.items():
-                pipe.set(market + ':hist', orjson.dumps(hist_new))
+        def queue(pipe, market):
 
-            pipe.execute()
+            if market in all_hist_new:
+                pipe.set(market + ':hist', orjson.dumps(all_hist_new[market]))
+
+            if market in all_heads_new:
+                pipe.set(market + ':heads', orjson.dumps(all_heads_new[market]))
+
+            for timeframe, horizon_new in all_horizons_new.get(market, {}).items():
+                pipe.set(f'{market}:horizon:{timeframe}', orjson.dumps(horizon_new))
+
+        shards.execute(list({**all_hist_new, **all_heads_new, **all_horizons_new}.keys()), queue, transaction=True)
+
+    def stage_historical_holdings(self, all_hist_new: dict, all_heads_new: dict, all_compressed_new: dict, all_horizons_new: dict) -> dict:
+        """
+        As write_historical_holdings, but write to the staging keys 'market:hist:staged', 'market:heads:staged' and
+        'market:horizon:<timeframe>:staged'. all_compressed_new maps each market to its compressed /historical_holdings 
+        responses, by encoding, and these are staged under 'market:hist:<encoding>:staged'. None are visible to clients 
+        until publish_historical_holdings is called. Return a dict mapping each market to the live keys it staged
+        """
+
+        staged = {}
+
+        for market in {**all_hist_new, **all_heads_new, **all_compressed_new, **all_horizons_new}.keys():
+
+            keys = []
+
+            if market in all_hist_new:
+                keys.append(market + ':hist')
+
+            if market in all_heads_new:
+                keys.append(market + ':heads')
+
+            keys += [f'{market}:hist:{encoding}' for encoding in all_compressed_new.get(market, {})]
+            keys += [f'{market}:horizon:{timeframe}' for timeframe in all_horizons_new.get(market, {})]
+            staged[market] = keys
+
+        def queue(pipe, market):
+
+            if market in all_hist_new:
+                pipe.set(market + ':hist:staged', orjson.dumps(all_hist_new[market]))
+
+            if market in all_heads_new:
+                pipe.set(market + ':heads:staged', orjson.dumps(all_heads_new[market]))
+
+            for encoding, body in all_compressed_new.get(market, {}).items():
+                pipe.set(f'{market}:hist:{encoding}:staged', body)
+
+            for timeframe, horizon_new in all_horizons_new.get(market, {}).items():
+                pipe.set(f'{market}:horizon:{timeframe}:staged', orjson.dumps(horizon_new))
+
+        shards.execute(list(staged.keys()), queue)
+
+        return staged
+
+    def publish_historical_holdings(self, staged: dict, time_new: dict, max_interval_increment: int=0) -> int:
+        """
+        Given a dict mapping market to the live keys staged for it this tick (see stage_historical_holdings), on each 
+        shard, in a single transaction, move the staged keys of the markets it holds over the live keys, and write its 
+        copy of the new time log and history epoch. Only keys staged this tick are renamed, since a RENAME of a missing 
+        key fails inside EXEC without stopping the rest, which would leave the shard half published. Shard 0 goes last, 
+        so its epoch only moves on once every shard has published. Return the new epoch. The markets have already been 
+        staged, so a league frozen since then is still published, on the shard it is moving from.
+
+        Epochs version every cached and snapshotted history response, and its ETag, so one must never be reused for 
+        different data. Each is at least the publish time in milliseconds, so that they keep increasing even after 
+        redis is flushed or restored from a backup.
+        """
+
+        epoch = max(int(self.redis_db.get('hist_epoch') or 0) + 1, int(time.time() * 1000))
+        markets = list(staged.keys())
+        groups = shards.group(markets, read_only=True)
+
+        def publish(shard: int) -> None:
+
+            with shards.clients[shard].pipeline(transaction=True) as pipe:
+
+                for i in groups.get(shard, []):
+                    for key in staged[markets[i]]:
+                        pipe.rename(key + ':staged', key)
+
+                pipe.set('time', orjson.dumps(time_new))
+
+                if shard == 0 and max_interval_increment > 0:
+                    pipe.incr('max_interval', amount=max_interval_increment)
+
+                pipe.set('hist_epoch', epoch)
+                pipe.execute()
+
+        shards.each(publish)
+
+        return epoch
+
+    def roll_candles(self, prices: dict, timeframes: list, t: int) -> None:
+        """
+        Given a dictionary mapping string market to its current long price, open a new candle at time t for 
+        each of the timeframes. Like publish_historical_holdings, this finishes a tick, so it goes ahead for frozen leagues
+        """
+
+        markets = list(prices.keys())
+
+        def roll(shard: int, members: list) -> None:
+            with shards.clients[shard].pipeline() as pipe:
+                ohlc.roll_candles(pipe, [markets[i] for i in members], [prices[markets[i]] for i in members], timeframes, t)
+                pipe.execute()
+
+        shards.run(shards.group(markets, read_only=True), roll)
+
+    def seed_candles(self, all_series: dict, hist_times: dict) -> None:
+        """
+        Given a dictionary mapping string market to {timeframe: long price series}, create the candles for each
+        market and timeframe that has none, using the matching times in the time log hist_times
+        """
+
+        def queue(pipe, market):
+            for timeframe, prices in all_series[market].items():
+                ohlc.seed_candles(pipe, market, timeframe, hist_times[timeframe], prices)
+
+        shards.execute(list(all_series.keys()), queue)
 
     def write_current_holdings(self, all_current_new: dict) -> None:
         """
         Given a new dictionary mapping string market to current holdings dict, send this to redis
         """
 
-        with self.redis_db.pipeline() as pipe:
+        markets = list(all_current_new.keys())
+        currents = list(all_current_new.values())
+
+        def write(shard: int, members: list) -> None:
+
+            with shards.clients[shard].pipeline() as pipe:
+
+                for i in members:
+                    pipe.set(markets[i], orjson.dumps(currents[i]))
+
+                record_holdings(pipe, [markets[i] for i in members], [currents[i] for i in members])
+
+                pipe.execute()
+
+        shards.run(shards.group(markets), write)
+        bump_versions(markets)
+
+    def apply_trades(self, deltas: dict, attempts: int=20) -> dict:
+        """
+        Given a dictionary mapping string market to a change in its holdings, {'x': [dx1, dx2, ...]} for teams or
+        {'N': dN} for players, add each change to the market's live holdings. As in make_purchase, each market is 
+        read and written under WATCH, and retried if it is traded in between, so no trade is overwritten. Markets
+        that are missing, being moved between shards or too busy are skipped. Return a dictionary mapping each 
+        market that was written to its new current holdings
+        """
+
+        markets, out = [], {}
+
+        for market, delta in deltas.items():
+
+            try:
+                client = shards.client(market)
+            except ShardMovingError:
+                logging.warning(f'Cannot trade {market}, which is being moved between shards')
+                continue
+
+            with client.pipeline() as pipe:
 
-            for market, current_new in all_current_new.items():
-                pipe.set(market, orjson.dumps(current_new))
+                for i in range(attempts):
 
-            pipe.execute()
+                    try:
+                        pipe.watch(market)
+                        raw = pipe.get(market)
 
-    def get_time(self) -> dict:
-        return orjson.loads(self.redis_db.get('time'))
+                        if raw is None:
+                            logging.error(f'Cannot trade {market}. Redis returned None')
+                            break
+
+                        current = orjson.loads(raw)
+
+                        if 'x' in delta:
+                            current['x'] = [x + dx for x, dx in zip(current['x'], delta['x'])]
+                        else:
+                            current['N'] += delta['N']
+
+                        pipe.multi()
+                        pipe.set(market, orjson.dumps(current))
+                        record_holdings(pipe, [market], [current])
+                        pipe.execute()
+
+                        markets.append(market)
+                        out[market] = current
+                        break
+
+                    except redis.WatchError:
+                        continue
+
+                else:
+                    logging.warning(f'Cannot trade {market} after {attempts} attempts. There is too much trading activity')
+
+        bump_versions(markets)
+
+        return out
+
+    def get_time(self, stale_ok: bool=False) -> dict:
+        """
+        The time log. Pass stale_ok when it is only read, to allow it to come from a replica
+        """
+        return orjson.loads((replica() if stale_ok else self.redis_db).get('time'))
 
     def set_time(self, time_new: dict) -> None:
         self.redis_db.set('time', orjson.dumps(time_new))
@@ -0,0 +1,172 @@
+import logging
+import numpy as np
+from typing import List
+from scheduler_utils import RedisExtractor
+from src.redis_utils.registry import MarketRegistry
+
+
+HEAD_TIMEFRAMES = ['d', 'w', 'm', 'M']
+
+
+class _Block:
+    """
+    The current holdings for a group of markets from the same league with the same shape, stored
+    as numpy arrays. For teams q is a 2D array of x vectors, for players a 1D array of Ns.
+    """
+
+    def __init__(self, markets: list, currents: list, team: bool):
+
+        self.markets = markets
+        self.team = team
+        self.k = 'x' if team else 'N'
+        self.q = np.array([current[self.k] for current in currents], dtype=np.float64)
+        self.b = np.array([current['b'] for current in currents], dtype=np.float64)
+
+    def current(self, row: int) -> dict:
+        """
+        The current holdings dict for a row, in the same JSON-safe form as stored in redis
+        """
+
+        if self.team:
+            return {'x': self.q[row].tolist(), 'b': float(self.b[row])}
+        else:
+            return {'N': float(self.q[row]), 'b': float(self.b[row])}
+
+    def set_current(self, row: int, current: dict):
+        self.q[row] = current[self.k]
+        self.b[row] = current['b']
+
+
+class MarketSnapshot:
+    """
+    A view of the market state in redis that is built once per tick by JobScheduler and shared
+    between all jobs that run in that tick. The current holdings for every market are read in a
+    single pipeline when the snapshot is created and parsed into numpy arrays, grouped by league.
+    The start of each historical interval (the horizon heads) and the time log are only needed by
+    some jobs, so these are read on demand and then kept for the rest of the tick.
+
+    Jobs that write new current holdings should call update_current_holdings so that jobs later
+    in the same tick see the change. Registered markets with no current holdings in redis are left
+    out of the snapshot altogether, so that no job tries to update them.
+    """
+
+    def __init__(self, redis_extractor: RedisExtractor, registry: MarketRegistry):
+
+        self.redis_extractor = redis_extractor
+
+        # league id -> list of markets, leaving out leagues with no markets of that type
+        self.team_leagues = {league: teams for league, teams in ((league, registry.teams(league)) for league in registry.leagues()) if len(teams) > 0}
+        self.player_leagues = {league: players for league, players in ((league, registry.players(league)) for league in registry.leagues()) if len(players) > 0}
+
+        self.teams = [team for teams in self.team_leagues.values() for team in teams]
+        self.players = [player for players in self.player_leagues.values() for player in players]
+
+        self._index = {}
+        self._heads = {}
+        self._times = None
+
+        self.load_current_holdings()
+
+        self.team_leagues = {league: present for league, present in ((league, [team for team in teams if team in self._index]) for league, teams in self.team_leagues.items()) if len(present) > 0}
+        self.player_leagues = {league: present for league, present in ((league, [player for player in players if player in self._index]) for league, players in self.player_leagues.items()) if len(present) > 0}
+
+        self.teams = [team for teams in self.team_leagues.values() for team in teams]
+        self.players = [player for players in self.player_leagues.values() for player in players]
+
+    def load_current_holdings(self):
+        """
+        Read the current holdings for every market in one pipeline and index them by market
+        """
+
+        all_markets = self.teams + self.players
+        all_current = self.redis_extractor.get_current_holdings(all_markets)
+
+        groups = {}
+        missing = []
+
+        for market, current in zip(all_markets, all_current):
+
+            if current is None:
+                missing.append(market)
+                continue
+
+            team = 'x' in current
+            shape = len(current['x']) if team else 0
+            groups.setdefault((market.split(':')[1], team, shape), []).append((market, current))
+
+        for (league, team, shape), members in groups.items():
+
+            markets, currents = zip(*members)
+            block = _Block(list(markets), list(currents), team)
+
+            for row, market in enumerate(markets):
+                self._index[market] = (block, row)
+
+        if len(missing) > 0:
+            logging.warning(f'MarketSnapshot: skipping {len(missing)} registered markets with no holdings in Redis, e.g. {missing[:5]}')
+
+    def __contains__(self, market: str) -> bool:
+        return market in self._index
+
+    def get_current_holdings(self, markets: list) -> List[dict]:
+        """
+        Get the current holdings dicts for a list of markets, None if the market is not present
+        """
+
+        out = []
+
+        for market in markets:
+
+            if market in self._index:
+                block, row = self._index[market]
+                out.append(block.current(row))
+            else:
+                out.append(None)
+
+        return out
+
+    def update_current_holdings(self, all_current_new: dict):
+        """
+        Given a dictionary mapping string market to new current holdings dict, update the snapshot
+        """
+
+        for market, current_new in all_current_new.items():
+            if market in self._index:
+                block, row = self._index[market]
+                block.set_current(row, current_new)
+
+    def get_horizon_heads(self, markets: list) -> List[dict]:
+        """
+        Get the first entry of each of the HEAD_TIMEFRAMES historical holdings for a list of markets in
+        the form {'x': [x_d, x_w, x_m, x_M], 'b': [b_d, b_w, b_m, b_M]} ('N' in place of 'x' for players).
+        Markets not already in the snapshot are fetched from their 'market:heads' records in a single pipeline.
+        """
+
+        new_markets = [market for market in markets if market not in self._heads]
+
+        if len(new_markets) > 0:
+
+            all_heads = self.redis_extractor.get_horizon_heads(new_markets)
+
+            for market, heads in zip(new_markets, all_heads):
+
+                if heads is None:
+                    self._heads[market] = None
+                    continue
+
+                k = 'x' if 'x' in heads else 'N'
+                self._heads[market] = {k:   np.array([heads[k][th] for th in HEAD_TIMEFRAMES], dtype=np.float64),
+                                       'b': np.array([heads['b'][th] for th in HEAD_TIMEFRAMES], dtype=np.float64)}
+
+        return [self._heads[market] for market in markets]
+
+    def get_head_times(self) -> np.ndarray:
+        """
+        The timestamps at which each of the HEAD_TIMEFRAMES intervals start
+        """
+
+        if self._times is None:
+            times = self.redis_extractor.get_time(stale_ok=True)
+            self._times = np.array([times[th][0] for th in HEAD_TIMEFRAMES])
+
+        return self._times
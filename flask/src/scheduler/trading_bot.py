@@ -1,6 +1,8 @@
 import os
 from os import replace
 from scheduler_utils import RedisExtractor, Timer
+from snapshot import MarketSnapshot
+from src.redis_utils.registry import MarketRegistry
 import numpy as np
 import logging
 from lmsr.long_short import LongShortMarketMaker
@@ -52,18 +54,19 @@ def transform(m: np.ndarray, alpha: float=0.05):
 
 class TradingBot:
 
-    def __init__(self, trade_noise: bool=True) -> None:
+    def __init__(self, registry: MarketRegistry, trade_noise: bool=True) -> None:
         """
-        Initialise a trading bot. This object will select random markets to make trades in. trade_noise optionally
-        adds some random purturbation to the trade probability
+        Initialise a trading bot. This object will select random registered markets to make trades in. trade_noise 
+        optionally adds some random purturbation to the trade probability
         """
         
+        self.registry = registry
         self.B_factor = 0.01
         self.trade_noise = trade_noise
         self.noise_level = 0.05
         self.redis_extractor = RedisExtractor()
 
-    def select_players(self) -> zip:
+    def select_players(self, snapshot: MarketSnapshot) -> zip:
         """
         Returns a zipped object containing: the slected player market names; the current m; and the current holding
         """
@@ -71,6 +74,10 @@ class TradingBot:
         with open('/var/www/data/player_ms.json') as f:
             player_ms = orjson.loads(f.read())
 
+        # only trade in markets that are currently registered and have holdings. The snapshot is only used to choose 
+        # them, as it may be minutes old by now, so the holdings to trade against are read live
+        player_ms = {player: m for player, m in player_ms.items() if player in self.registry and player in snapshot}
+
         n_select = len(player_ms) // 6
         selected_players = np.random.choice(list(player_ms.keys()), size=n_select, replace=False).tolist()
         player_holdings = self.redis_extractor.get_current_holdings(selected_players)
@@ -85,7 +92,7 @@ class TradingBot:
 
         return zip(selected_players, ms, player_holdings)
 
-    def select_teams(self) -> zip:
+    def select_teams(self, snapshot: MarketSnapshot) -> zip:
         """
         Returns a zipped object containing: the slected team market names; the current m; and the current holding
         """
@@ -93,6 +100,8 @@ class TradingBot:
         with open('/var/www/data/team_ms.json') as f:
             team_ms = orjson.loads(f.read())
 
+        team_ms = {team: m for team, m in team_ms.items() if team in self.registry and team in snapshot}
+
         selected_teams = np.random.choice(list(team_ms.keys()), size=len(team_ms) // 6, replace=False).tolist()
         team_holdings = self.redis_extractor.get_current_holdings(selected_teams)
 
@@ -103,59 +112,68 @@ class TradingBot:
 
         return zip(selected_teams, ms, team_holdings)
 
-    def trade_teams(self) -> list:
+    def trade_teams(self, snapshot: MarketSnapshot) -> list:
         """
         Select player and make trades. Return dict with trade details
         """
 
         trades = []
-        new_holdings = {}
+        deltas = {}
         aborted_trades = []
 
-        for market, current_m, current_holdings in self.select_teams():
+        for market, current_m, current_holdings in self.select_teams(snapshot):
+
+            if current_holdings is None:
+                continue
 
             trade = self.optimal_trade_team(market, current_m, current_holdings)
 
             if trade['cost'] != 0:
                 trades.append(trade)
-                new_holdings[market] = {'x': (np.asarray(current_holdings['x']) + np.asarray(trade['quantity'])).tolist(), 'b': current_holdings['b']}
+                deltas[market] = {'x': trade['quantity']}
             else:
                 aborted_trades.append(market)
 
-        self.redis_extractor.write_current_holdings(new_holdings)
+        # trades are added to the holdings as they are when written, in case users have traded since they were read
+        new_holdings = self.redis_extractor.apply_trades(deltas)
+        snapshot.update_current_holdings(new_holdings)
 
         return trades
 
-    def trade_players(self) -> list:
+    def trade_players(self, snapshot: MarketSnapshot) -> list:
         """
         Select teams and make trades. Return dict with trade details
         """
 
         trades = []
-        new_holdings = {}
+        deltas = {}
+
+        for market, current_m, current_holdings in self.select_players(snapshot):
 
-        for market, current_m, current_holdings in self.select_players():
+            if current_holdings is None:
+                continue
 
             trade = self.optimal_trade_player(market, current_m, current_holdings)
 
             if trade['cost'] != 0:
                 trades.append(trade)
-                new_holdings[market] = {'N': current_holdings['N'] + trade['quantity'] * (-1) ** (~trade['long']), 'b': current_holdings['b']}
+                deltas[market] = {'N': trade['quantity'] * (-1) ** (~trade['long'])}
 
-        self.redis_extractor.write_current_holdings(new_holdings)
+        new_holdings = self.redis_extractor.apply_trades(deltas)
+        snapshot.update_current_holdings(new_holdings)
 
         return trades
 
-    def trade(self, t: int):
+    def trade(self, t: int, snapshot: MarketSnapshot):
         """
         If the time is right, exectute some trades
         """
 
         with Timer() as team_timer:
-            team_trades = self.trade_teams()
+            team_trades = self.trade_teams(snapshot)
 
         with Timer() as player_timer:
-            player_trades = self.trade_players()
+            player_trades = self.trade_players(snapshot)
 
         date = datetime.today().date()
         date_folder = f'/var/www/logs/trades/{date.day}_{date.month}_{date.year}'
@@ -6,14 +6,35 @@ import logging
 from src.lmsr.classic import LMSRMarketMaker
 from src.lmsr.long_short import LongShortMarketMaker
 from src.redis_utils.exceptions import ResourceNotFoundError
+from src.redis_utils.versions import bump_versions, record_holdings
+from src.redis_utils.connection import primary, shards, ShardMovingError
+from src.redis_utils.read_data import holdings_cache
 import time
 from rq_scheduler import Scheduler
 from datetime import timedelta
 
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+# cancel ids and the rq scheduler live on shard 0. Market holdings live on their league's shard
+redis_db = primary()
 scheduler = Scheduler(connection=redis_db)
 
 
+def settled_client(market: str, timeout: float=300) -> redis.Redis:
+    """
+    The client for the shard holding a market, waiting up to timeout seconds if its league is being moved
+    between shards. Used by undo_purchase, which must not be dropped while a move is in progress
+    """
+
+    t0 = time.time()
+
+    while True:
+        try:
+            return shards.client(market)
+        except ShardMovingError:
+            if time.time() - t0 > timeout:
+                raise
+            time.sleep(1)
+
+
 def make_purchase(purchase_form: dict) -> float:
     """
     Execute a trade given a valid purchase form If the trade is executed successfully, 
@@ -22,35 +43,44 @@ def make_purchase(purchase_form: dict) -> float:
     """
 
     market, quantity, team = purchase_form['market'], purchase_form['quantity'], purchase_form['team']
+    market_db = shards.client(market)
 
-    if not redis_db.exists(market):
+    if not market_db.exists(market):
         raise ResourceNotFoundError
 
     success = False
-    redis_db.watch(market)
 
-    for i in range(1, 101):
+    with market_db.pipeline() as pipe:
 
-        try:
-            current = orjson.loads(redis_db.get(market))
+        for i in range(1, 101):
+
+            try:
+                pipe.watch(market)
+                current = orjson.loads(pipe.get(market))
 
-            if team:
-                price = LMSRMarketMaker(market, current['x'], current['b']).price_trade(quantity)
-                current['x'] = (np.array(current['x']) + np.array(quantity)).tolist()
-            else:
-                price = LongShortMarketMaker(market, current['N'], current['b']).price_trade(quantity)
-                current['N'] += (quantity[0] - quantity[1])
+                if team:
+                    price = LMSRMarketMaker(market, current['x'], current['b']).price_trade(quantity)
+                    current['x'] = (np.array(current['x']) + np.array(quantity)).tolist()
+                else:
+                    price = LongShortMarketMaker(market, current['N'], current['b']).price_trade(quantity)
+                    current['N'] += (quantity[0] - quantity[1])
 
-            redis_db.set(market, orjson.dumps(current))
-            redis_db.unwatch()
-            success = True
-            break
+                pipe.multi()
+                pipe.set(market, orjson.dumps(current))
+                record_holdings(pipe, [market], [current])
+                version, = pipe.execute()[-1]
+                success = True
+                break
 
-        except redis.WatchError:
-            logging.warning(f'WATCH ERROR; make_purchase; {market}; {i}')
-            time.sleep(0.01)
+            except redis.WatchError:
+                logging.warning(f'WATCH ERROR; make_purchase; {market}; {i}')
+                # under the gevent workers (gunicorn_async.py) time.sleep is patched to yield to other requests
+                time.sleep(0.01)
 
     if success:
+        # so that reads in this process see the trade without waiting for its invalidation
+        holdings_cache.written([market], [version])
+        bump_versions([market])
         return price
 
     else:
@@ -63,33 +93,40 @@ def undo_purchase(purchase_form: dict):
     """
 
     market, quantity, team = purchase_form['market'], purchase_form['quantity'], purchase_form['team']
+    market_db = settled_client(market)
 
-    if not redis_db.exists(market):
+    if not market_db.exists(market):
         raise ResourceNotFoundError
 
     success = False
-    redis_db.watch(market)
 
-    for i in range(1, 201):
+    with market_db.pipeline() as pipe:
 
-        try:
-            current = orjson.loads(redis_db.get(market))
-
-            if team:
-                current['x'] = (np.array(current['x']) - np.array(quantity)).tolist()
-            else:
-                current['N'] -= (quantity[0] - quantity[1])
-            
-            redis_db.set(market, orjson.dumps(current))
-            redis_db.unwatch()
-            success = True
-            break
-
-        except redis.WatchError:
-            logging.warning(f'WATCH ERROR; undo_purchase; {market}; {i}')
-            time.sleep(0.01)
+        for i in range(1, 201):
+
+            try:
+                pipe.watch(market)
+                current = orjson.loads(pipe.get(market))
+
+                if team:
+                    current['x'] = (np.array(current['x']) - np.array(quantity)).tolist()
+                else:
+                    current['N'] -= (quantity[0] - quantity[1])
+                
+                pipe.multi()
+                pipe.set(market, orjson.dumps(current))
+                record_holdings(pipe, [market], [current])
+                version, = pipe.execute()[-1]
+                success = True
+                break
+
+            except redis.WatchError:
+                logging.warning(f'WATCH ERROR; undo_purchase; {market}; {i}')
+                time.sleep(0.01)
 
     if success:
+        holdings_cache.written([market], [version])
+        bump_versions([market])
         return
 
     else:
@@ -1,5 +1,6 @@
 import json
 from src.redis_utils.exceptions import ResourceNotFoundError
+from src.redis_utils.connection import primary, ShardMovingError
 from firebase_admin import firestore
 from src.transactions.make_purchase import cancel_undo_scheduled_purchase, make_purchase, schedule_undo_purchase, undo_purchase, undo_scheudlued_purchase_now
 import logging
@@ -11,7 +12,7 @@ from random import randint
 
 db = firestore.client()
 portfolios = db.collection(u'portfolios')
-redis_db = redis.Redis(host='redis', port=6379, db=0)
+redis_db = primary()
 
 
 def get_portfolio(portfolioId: str) -> dict:
@@ -209,6 +210,9 @@ class PurchaseForm:
         except redis.WatchError:
             raise TransactionError(f'There is currently too much trading activity to complete this purchase')
 
+        except ShardMovingError:
+            raise TransactionError(f'The market {self.form["market"]} is being moved and cannot be traded for a few minutes')
+
         if self.prices_consistent(price):
 
             try:
@@ -0,0 +1,43 @@
+import os
+import sys
+import socket
+import pytest
+import redislite
+
+# Run from the flask directory with `python -m pytest tests`. The app reads its redis settings from the environment
+# when its modules are imported, so two throwaway servers are started here, before any test module imports src:
+# the primary (shard 0) and one further shard. redislite ships its own redis-server, so nothing else has to run.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port() -> int:
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+PORTS = [_free_port() for _ in range(2)]
+SERVERS = [redislite.Redis(serverconfig={'port': str(port)}) for port in PORTS]
+
+os.environ['REDIS_HOST'] = '127.0.0.1'
+os.environ['REDIS_PORT'] = str(PORTS[0])
+os.environ['REDIS_SHARDS'] = f'127.0.0.1:{PORTS[1]}'
+os.environ['REDIS_REPLICAS'] = ''
+
+
+@pytest.fixture
+def servers():
+    """
+    The redis servers, shard 0 first, emptied before each test, with every league on shard 0
+    """
+
+    from src.redis_utils.connection import shards
+
+    for server in SERVERS:
+        server.flushall()
+
+    shards.refresh(force=True)
+
+    return SERVERS
@@ -0,0 +1,80 @@
+import threading
+import pytest
+from src.redis_utils.connection import shards, ShardMovingError, SHARD_MAP_KEY, SHARD_VERSION_KEY, SHARD_FROZEN_KEY
+
+
+def assign(servers, league: str, shard: int) -> None:
+    servers[0].hset(SHARD_MAP_KEY, league, shard)
+    servers[0].incr(SHARD_VERSION_KEY)
+    shards.refresh(force=True)
+
+
+def test_unassigned_leagues_are_on_shard_0(servers):
+    assert shards.group(['1:8:1T', '2:9:2T']) == {0: [0, 1]}
+
+
+def test_unparseable_ids_are_on_shard_0(servers):
+
+    assign(servers, '9', 1)
+
+    assert [shards.shard(market) for market in ['nope', '1:9', '1:9:1T:x', '1:9:1T']] == [0, 0, 0, 1]
+    assert shards.execute(['nope', '1:9:1T'], lambda pipe, market: pipe.get(market), read_only=True) == [[None], [None]]
+
+
+def test_execute_keeps_market_order(servers):
+
+    assign(servers, '9', 1)
+
+    # interleaved, and with a different number of commands for each market
+    markets = ['1:9:1T', '2:8:2T', '3:9:3T', '4:8:4T', '5:9:5T']
+
+    def queue(pipe, market):
+        for j in range(int(market[0])):
+            pipe.set(f'{market}:{j}', market)
+        pipe.get(f'{market}:0')
+
+    results = shards.execute(markets, queue, transaction=True)
+
+    assert [len(result) for result in results] == [2, 3, 4, 5, 6]
+    assert [result[-1].decode() for result in results] == markets
+    assert servers[1].get('1:9:1T:0') == b'1:9:1T' and not servers[0].exists('1:9:1T:0')
+    assert servers[0].get('2:8:2T:0') == b'2:8:2T' and not servers[1].exists('2:8:2T:0')
+
+
+def test_execute_with_no_commands_for_some_markets(servers):
+
+    assign(servers, '9', 1)
+
+    def queue(pipe, market):
+        if market.endswith('T'):
+            pipe.echo(market)
+
+    assert shards.execute(['1:9:1P', '2:8:2T', '3:9:3T'], queue) == [[], [b'2:8:2T'], [b'3:9:3T']]
+
+
+def test_frozen_league_is_read_only(servers):
+
+    assign(servers, '9', 1)
+    servers[0].sadd(SHARD_FROZEN_KEY, '9')
+    servers[0].incr(SHARD_VERSION_KEY)
+    shards.refresh(force=True)
+
+    with pytest.raises(ShardMovingError):
+        shards.shard('1:9:1T')
+
+    assert shards.shard('1:9:1T', read_only=True) == 1
+    assert shards.shard('1:8:1T') == 0
+
+
+def test_each_runs_shard_0_last(servers):
+
+    lock = threading.Lock()
+    order = []
+
+    def f(shard):
+        with lock:
+            order.append(shard)
+        return shards.clients[shard].echo(str(shard))
+
+    assert shards.each(f) == [b'0', b'1']
+    assert order[-1] == 0
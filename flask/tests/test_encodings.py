@@ -0,0 +1,70 @@
+import struct
+import msgpack
+import numpy as np
+from src.redis_utils.encodings import to_msgpack, FLOAT64_ARRAY_EXT, INT64_ARRAY_EXT
+
+
+def ext_hook(code: int, data: bytes):
+    """
+    How a client unpacks the array extension types
+    """
+
+    ndim = data[0]
+    shape = struct.unpack_from(f'<{ndim}I', data, 1)
+    dtype = '<f8' if code == FLOAT64_ARRAY_EXT else '<i8'
+
+    return np.frombuffer(data, dtype=dtype, offset=1 + 4 * ndim).reshape(shape)
+
+
+def unpack(body: bytes):
+    return msgpack.unpackb(body, ext_hook=ext_hook, raw=False)
+
+
+def test_holdings_round_trip():
+
+    data = {'1:8:18378T': {'x': [1.5, -2.25, 3.0], 'b': 4000.0}, '1182:8:18378P': {'N': 400.0, 'b': 2000.0}}
+    out = unpack(to_msgpack(data))
+
+    assert out['1:8:18378T']['x'].dtype == np.float64
+    assert out['1:8:18378T']['x'].tolist() == [1.5, -2.25, 3.0]
+    assert out['1:8:18378T']['b'] == 4000.0
+    assert out['1182:8:18378P'] == {'N': 400.0, 'b': 2000.0}
+
+
+def test_history_round_trip():
+
+    x = [[float(i + j) / 7 for j in range(20)] for i in range(60)]
+    times = list(range(1620000000, 1620000000 + 60 * 120, 120))
+    out = unpack(to_msgpack({'data': {'x': {'h': x}, 'b': {'h': [4000] * 60}}, 'time': {'h': times}}))
+
+    assert out['data']['x']['h'].shape == (60, 20)
+    assert np.array_equal(out['data']['x']['h'], np.array(x))
+    assert out['data']['b']['h'].dtype == np.int64
+    assert out['time']['h'].tolist() == times
+
+
+def test_numpy_arrays_are_packed():
+
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    out = unpack(to_msgpack({'a': array}))
+
+    assert out['a'].dtype == np.float64
+    assert np.array_equal(out['a'], array)
+
+
+def test_extension_layout():
+
+    ext = msgpack.unpackb(to_msgpack([[1, 2, 3], [4, 5, 6]]))
+
+    assert ext.code == INT64_ARRAY_EXT
+    assert ext.data == struct.pack('<BII', 2, 2, 3) + np.arange(1, 7, dtype='<i8').tobytes()
+
+
+def test_other_values_are_left_alone():
+
+    data = {'empty': [], 'strings': ['a', 'b'], 'mixed': [1, 'a'], 'null': None, 'ragged': [[1], [2, 3]], 'n': 3}
+    out = unpack(to_msgpack(data))
+
+    assert out['empty'] == [] and out['strings'] == ['a', 'b'] and out['mixed'] == [1, 'a']
+    assert out['null'] is None and out['n'] == 3
+    assert [list(row) for row in out['ragged']] == [[1], [2, 3]]
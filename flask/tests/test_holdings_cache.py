@@ -0,0 +1,180 @@
+import time
+import redis
+import pytest
+from src.redis_utils.connection import shards, SHARD_MAP_KEY, SHARD_VERSION_KEY
+from src.redis_utils.holdings_cache import HoldingsCache
+from src.redis_utils.versions import record_holdings
+
+MARKET = '1:8:18378T'
+MOVED = '3:9:1T'
+
+# one per process, as in the app, since tracked connections are pooled by shard
+holdings_cache = HoldingsCache()
+
+
+def wait_for(condition, timeout: float=5) -> bool:
+
+    end = time.time() + timeout
+
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+
+    return False
+
+
+class Counts:
+    """
+    The cache's counters since a test started
+    """
+
+    def __init__(self, cache: HoldingsCache):
+        self.cache = cache
+        self.start = cache.stats()
+
+    def __getitem__(self, name: str) -> int:
+        return self.cache.stats()[name] - self.start[name]
+
+
+@pytest.fixture
+def cache(servers):
+    """
+    The cache, with league 9 on shard 1, once it has caught up with the flush before the test. A key on each shard
+    is read into it and then written, and as each shard's invalidations arrive in order, any from the flush have
+    been handled once those two have
+    """
+
+    servers[0].hset(SHARD_MAP_KEY, '9', 1)
+    servers[0].incr(SHARD_VERSION_KEY)
+    shards.refresh(force=True)
+
+    holdings_cache._start()
+    assert wait_for(lambda: all(holdings_cache.stats()['ready'].values()))
+
+    sentinels = ['0:8:sentinelT', '0:9:sentinelT']
+
+    for server, sentinel in zip(servers, sentinels):
+        server.set(sentinel, b'0')
+
+    holdings_cache.get_raw(sentinels)
+
+    for server, sentinel in zip(servers, sentinels):
+        server.delete(sentinel)
+
+    assert wait_for(lambda: holdings_cache.stats()['size'] == 0)
+
+    return holdings_cache
+
+
+def test_write_invalidates(servers, cache):
+
+    servers[0].set(MARKET, b'{"x":[1],"b":1}')
+    counts = Counts(cache)
+
+    assert cache.get_raw([MARKET]) == [b'{"x":[1],"b":1}']
+    assert cache.get_raw([MARKET]) == [b'{"x":[1],"b":1}']
+    assert (counts['hits'], counts['misses'], cache.stats()['size']) == (1, 1, 1)
+
+    servers[0].set(MARKET, b'{"x":[2],"b":1}')
+
+    assert wait_for(lambda: counts['invalidations'] == 1)
+    assert cache.get_raw([MARKET]) == [b'{"x":[2],"b":1}']
+
+
+def test_write_invalidates_on_other_shards(servers, cache):
+
+    servers[1].set(MOVED, b'1')
+    servers[0].set(MARKET, b'2')
+    counts = Counts(cache)
+
+    assert cache.get_raw([MOVED, MARKET]) == [b'1', b'2']
+
+    servers[1].set(MOVED, b'3')
+
+    assert wait_for(lambda: counts['invalidations'] == 1)
+    assert cache.get_raw([MOVED, MARKET]) == [b'3', b'2']
+    assert (counts['hits'], counts['misses']) == (1, 3)
+
+
+def test_newer_version_is_refetched(servers, cache):
+
+    servers[0].set(MARKET, b'1')
+    counts = Counts(cache)
+    (raw, ), (version, ) = cache.get([MARKET])
+
+    assert (raw, version) == (b'1', 0)
+
+    # as if a reader has seen a version newer than the invalidation it has yet to get
+    with servers[0].pipeline() as pipe:
+        record_holdings(pipe, [MARKET])
+        version, = pipe.execute()[-1]
+
+    assert cache.get([MARKET], [version]) == ([b'1'], [version])
+    assert counts['misses'] == 2
+    assert cache.get_raw([MARKET], [version]) == [b'1']
+    assert counts['hits'] == 1
+
+
+def test_written_evicts_older_entries(servers, cache):
+
+    servers[0].set(MARKET, b'1')
+    cache.get_raw([MARKET])
+
+    cache.written([MARKET], [0])
+
+    assert cache.stats()['size'] == 1
+
+    # as if this process has just written version 1, before its invalidation arrives
+    cache.written([MARKET], [1])
+
+    assert cache.stats()['size'] == 0
+
+
+def test_missing_markets_are_not_kept(servers, cache):
+
+    assert cache.get_raw(['0:0:missingT', MARKET]) == [None, None]
+    assert (cache.stats()['size'], cache.stats()['filling']) == (0, 0)
+
+
+def test_market_maker_is_built_once(servers, cache):
+
+    servers[0].set(MARKET, b'{"x":[1.0,2.0],"b":4000.0}')
+
+    maker = cache.get_market_maker(MARKET)
+
+    assert maker.b == 4000.0
+    assert cache.get_market_maker(MARKET) is maker
+
+
+def test_flush_clears_everything(servers, cache):
+
+    servers[0].set(MARKET, b'1')
+    cache.get_raw([MARKET])
+
+    assert cache.stats()['size'] == 1
+
+    servers[0].flushall()
+
+    assert wait_for(lambda: cache.stats()['size'] == 0)
+    assert cache.get_raw([MARKET]) == [None]
+
+
+def test_failed_reconnect_is_retried(servers, cache, monkeypatch):
+
+    tracker = cache.trackers[0]
+    pool = tracker.subscriber_db.connection_pool
+    get_connection = pool.get_connection
+    failures = []
+
+    def refuse_once(*args, **kwargs):
+        if len(failures) == 0:
+            failures.append(True)
+            raise redis.ConnectionError('Connection refused')
+        return get_connection(*args, **kwargs)
+
+    monkeypatch.setattr(pool, 'get_connection', refuse_once)
+    servers[0].client_kill_filter(_type='pubsub')
+
+    assert wait_for(lambda: len(failures) == 1 and cache.stats()['ready'][tracker.name])
+    assert tracker.thread.is_alive()
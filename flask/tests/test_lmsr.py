@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from src.lmsr.classic import LMSRMarketMaker
+from src.lmsr.long_short import LongShortMarketMaker
+
+
+def scalar_price_trade(N: float, b: float, q: list) -> float:
+    """
+    LongShortMarketMaker.price_trade as it was before price_trades, one trade at a time
+    """
+
+    def f(n):
+
+        if n == 0:
+            return 0
+
+        elif N == 0:
+            if n < 0:
+                return b * np.log(b * (np.exp(n / b) - 1) / n)
+            else:
+                return b * np.log(b * (1 - np.exp(-n / b)) / (n * np.exp(-n / b)))
+
+        elif N < 0:
+            if N == -n:
+                return b * np.log(N / (b * (np.exp(N / b) - 1)))
+            else:
+                return b * np.log(N / (N + n) * (np.exp((N + n) / b) - 1) / (np.exp(N / b) - 1))
+
+        else:
+            if N == -n:
+                return b * np.log(N * np.exp(-N / b) / (b * (1 - np.exp(-N / b))))
+            else:
+                return b * np.log(N / (N + n) * (np.exp(n / b) - np.exp(-N / b)) / (1 - np.exp(-N / b)))
+
+    return float(f(q[0]) + q[1] + f(-q[1]))
+
+
+SIZES = [0, 1, 2.5, 10, 100, 400, 1000]
+TRADES = [[longs, shorts] for longs in SIZES for shorts in SIZES]
+
+
+@pytest.mark.parametrize('N', [-400.0, -10.0, 0.0, 10.0, 400.0])
+def test_long_short_price_trades_match_scalar(N):
+
+    maker = LongShortMarketMaker('1182:8:18378P', N, 2000.0)
+    prices = maker.price_trades(TRADES)
+
+    assert prices.shape == (len(TRADES), )
+    assert np.allclose(prices, [scalar_price_trade(N, 2000.0, q) for q in TRADES], rtol=1e-12, atol=1e-9)
+    assert maker.price_trade(TRADES[10]) == pytest.approx(scalar_price_trade(N, 2000.0, TRADES[10]), rel=1e-12)
+
+
+@pytest.mark.parametrize('N', [-400.0, 400.0])
+def test_long_short_price_trades_edge(N):
+
+    # selling exactly N shorts takes the N + n = 0 branch
+    maker = LongShortMarketMaker('1182:8:18378P', N, 2000.0)
+    trades = [[-N, 0], [0, N], [-N, N]]
+
+    assert np.allclose(maker.price_trades(trades), [scalar_price_trade(N, 2000.0, q) for q in trades], rtol=1e-12)
+
+
+def test_lmsr_price_trades_match_price_trade():
+
+    rng = np.random.default_rng(0)
+    maker = LMSRMarketMaker('1:8:18378T', rng.normal(0, 50, 20), 4000.0)
+    trades = np.vstack([np.zeros(20), np.eye(20) * 10, rng.normal(0, 100, (30, 20))])
+
+    assert np.allclose(maker.price_trades(trades), [maker.price_trade(q) for q in trades], rtol=1e-12, atol=1e-9)
+
+
+def test_long_short_even_market_is_half():
+    assert LongShortMarketMaker('1182:8:18378P', 0.0, 2000.0).long_price == 0.5
@@ -0,0 +1,105 @@
+from src.redis_utils.connection import shards, SHARD_MAP_KEY, SHARD_VERSION_KEY
+from src.redis_utils.ohlc import candle_key, record_prices, roll_candles, seed_candles, get_candles, MAX_CANDLES
+
+MARKET = '1:8:18378T'
+
+
+def run(server, f, *args):
+
+    with server.pipeline() as pipe:
+        f(pipe, *args)
+        pipe.execute()
+
+
+def candles(horizon: str, t_from: int=None, t_to: int=None) -> dict:
+    return get_candles([MARKET], [horizon], t_from, t_to)[0][horizon]
+
+
+def test_record_folds_into_the_latest_bucket(servers):
+
+    run(servers[0], roll_candles, [MARKET], [3.0], ['d'], 100)
+    run(servers[0], roll_candles, [MARKET], [4.0], ['d'], 200)
+
+    for price in [5.0, 2.5, 3.5]:
+        run(servers[0], record_prices, [MARKET], [price])
+
+    assert candles('d') == {'t': [100, 200], 'o': [3.0, 4.0], 'h': [3.0, 5.0], 'l': [3.0, 2.5], 'c': [3.0, 3.5]}
+
+
+def test_record_leaves_horizons_without_buckets_alone(servers):
+
+    run(servers[0], roll_candles, [MARKET], [3.0], ['d'], 100)
+    run(servers[0], record_prices, [MARKET], [5.0])
+
+    assert not servers[0].exists(candle_key(MARKET, 'h'))
+    assert candles('d')['h'] == [5.0]
+
+
+def test_roll_trims_to_the_newest_buckets(servers):
+
+    n = MAX_CANDLES['d']
+
+    for t in range(n + 5):
+        run(servers[0], roll_candles, [MARKET], [float(t)], ['d'], t)
+
+    assert candles('d')['t'] == list(range(5, n + 5))
+
+
+def test_roll_thins_monthly_buckets_in_pairs(servers):
+
+    n = MAX_CANDLES['M']
+
+    for t in range(n):
+        run(servers[0], roll_candles, [MARKET], [float(t)], ['M'], t)
+        run(servers[0], record_prices, [MARKET], [t + 0.5])
+
+    run(servers[0], roll_candles, [MARKET], [float(n)], ['M'], n)
+    data = candles('M')
+
+    # buckets 2j and 2j + 1 merge, and the last one is left on its own
+    assert data['t'] == list(range(0, n + 1, 2))
+    assert data['o'][:2] == [0.0, 2.0]
+    assert data['h'][:2] == [1.5, 3.5]
+    assert data['l'][:2] == [0.0, 2.0]
+    assert data['c'][:2] == [1.5, 3.5]
+    assert (data['o'][-1], data['c'][-1]) == (float(n), float(n))
+
+
+def test_seed_does_not_overwrite(servers):
+
+    run(servers[0], seed_candles, MARKET, 'w', [10, 20, 30], [1.0, 2.0, 3.0])
+    run(servers[0], seed_candles, MARKET, 'w', [10, 20, 30], [9.0, 9.0, 9.0])
+
+    assert candles('w') == {'t': [10, 20, 30], 'o': [1.0, 2.0, 3.0], 'h': [1.0, 2.0, 3.0], 'l': [1.0, 2.0, 3.0], 'c': [1.0, 2.0, 3.0]}
+    assert candles('w', 15, 25)['t'] == [20]
+
+
+def test_non_finite_prices_are_skipped(servers):
+
+    other = '2:8:18378T'
+
+    run(servers[0], seed_candles, MARKET, 'd', [10, 20, 30], [1.0, float('nan'), 3.0])
+    run(servers[0], roll_candles, [MARKET, other], [4.0, float('inf')], ['d'], 40)
+
+    # the whole transaction would fail if a script saw one
+    with servers[0].pipeline() as pipe:
+        record_prices(pipe, [MARKET, other], [5.0, float('nan')])
+        pipe.set('after', 1)
+        pipe.execute()
+
+    assert candles('d') == {'t': [10, 30, 40], 'o': [1.0, 3.0, 4.0], 'h': [1.0, 3.0, 5.0], 'l': [1.0, 3.0, 4.0], 'c': [1.0, 3.0, 5.0]}
+    assert not servers[0].exists(candle_key(other, 'd'))
+    assert servers[0].get('after') == b'1'
+
+
+def test_candles_are_read_from_each_market_shard(servers):
+
+    servers[0].hset(SHARD_MAP_KEY, '9', 1)
+    servers[0].incr(SHARD_VERSION_KEY)
+    shards.refresh(force=True)
+
+    moved = '3:9:1T'
+    run(servers[1], roll_candles, [moved], [2.0], ['d'], 100)
+    run(servers[0], roll_candles, [MARKET], [1.0], ['d'], 100)
+
+    assert [market['d']['o'] for market in get_candles([moved, MARKET], ['d'])] == [[2.0], [1.0]]
@@ -0,0 +1,41 @@
+import orjson
+from src.redis_utils.read_data import splice_json, get_historical_quantities_projected, get_missing_markets
+
+
+def test_splice_json_matches_dumps():
+
+    items = [('1:8:18378T', b'{"x":[1.5,2.0,-3.25],"b":4000.0}'), ('1182:8:18378P', b'{"N":400.0,"b":2000.0}')]
+    body = splice_json(items)
+
+    assert orjson.loads(body) == {key: orjson.loads(value) for key, value in items}
+
+
+def test_splice_json_keeps_values_byte_for_byte():
+
+    value = b'{"x":[1.0000000000000002,1e-300],"b":4000}'
+
+    assert splice_json([('m', value)]) == b'{"m":' + value + b'}'
+
+
+def test_splice_json_missing_values_are_null():
+
+    assert orjson.loads(splice_json([('a', None), ('b', b'1')])) == {'a': None, 'b': 1}
+
+
+def test_splice_json_escapes_keys():
+
+    assert orjson.loads(splice_json([('a"b\\c', b'[]')])) == {'a"b\\c': []}
+
+
+def test_splice_json_empty():
+
+    assert splice_json([]) == b'{}'
+
+
+def test_unparseable_market_ids_are_missing(servers):
+
+    servers[0].set('time', orjson.dumps({'d': [1620000000]}))
+    all_hist, time, epoch = get_historical_quantities_projected(['nope'], ['d'])
+
+    assert all_hist == [None]
+    assert get_missing_markets(['nope', '1:8:18378T']) == ['nope', '1:8:18378T']
@@ -0,0 +1,219 @@
+import time
+import orjson
+from src.lmsr.contracts import long_price
+from src.redis_utils.ohlc import roll_candles, get_candles
+from src.redis_utils.connection import shards, SHARD_MAP_KEY, SHARD_VERSION_KEY
+from src.redis_utils.versions import bump_versions, record_holdings, repair_versions, get_changes_since, holdings_etag, version_key, LOG_KEY, SEQ_KEY, PRICE_CHANNEL, PENDING_KEY
+
+PLAYER = {'N': 10.0, 'b': 2000.0}
+
+
+def received(pubsub, n: int, timeout: float=2) -> list:
+
+    out = []
+    end = time.time() + timeout
+
+    while len(out) < n and time.time() < end:
+        message = pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+        if message is not None:
+            out.append(orjson.loads(message['data']))
+
+    return out
+
+
+def subscribe(server):
+
+    pubsub = server.pubsub()
+    pubsub.subscribe(PRICE_CHANNEL)
+    pubsub.get_message(timeout=1)
+
+    return pubsub
+
+
+def logged(server, markets: list) -> list:
+    """
+    The sequence number each market was last bumped with, or 0
+    """
+    return [int(seq) if seq is not None else 0 for seq in server.execute_command('ZMSCORE', LOG_KEY, *markets)]
+
+
+def write(client, markets: list, currents: list=None) -> list:
+    """
+    Write current holdings the way a trade does, up to but not including bump_versions. Return the new versions
+    """
+
+    with client.pipeline() as pipe:
+
+        for i, market in enumerate(markets):
+            pipe.set(market, orjson.dumps(currents[i] if currents is not None else PLAYER))
+
+        record_holdings(pipe, markets, currents)
+
+        return pipe.execute()[-1]
+
+
+def test_versions_never_go_back(servers):
+
+    t = int(time.time() * 1000)
+    version, = write(servers[0], ['1:8:1P'])
+
+    assert version >= t
+    assert int(servers[0].get(version_key('1:8:1P'))) == version
+
+    # e.g. after a clock step back
+    servers[0].set(version_key('1:8:1P'), version + 10 ** 9)
+
+    assert write(servers[0], ['1:8:1P']) == [version + 10 ** 9 + 1]
+
+
+def test_bump_gives_each_market_its_own_sequence_number(servers):
+
+    write(servers[0], ['1:8:1T', '2:8:2P'])
+    bump_versions(['1:8:1T', '2:8:2P'])
+    write(servers[0], ['1:8:1T'])
+    bump_versions(['1:8:1T'])
+
+    assert logged(servers[0], ['1:8:1T', '2:8:2P', '3:8:3T']) == [3, 2, 0]
+    assert int(servers[0].get(SEQ_KEY)) == 3
+
+
+def test_bump_nothing(servers):
+
+    bump_versions([])
+    bump_versions(['1:8:1T'])
+
+    assert not servers[0].exists(SEQ_KEY)
+
+
+def test_bump_publishes_price_updates_with_their_sequence_number(servers):
+
+    pubsub = subscribe(servers[0])
+
+    markets = ['1:8:1T', '2:8:2P']
+    currents = [{'x': [1.0, -2.0, 3.0], 'b': 4000.0}, PLAYER]
+
+    write(servers[0], ['3:8:3P'])
+    write(servers[0], markets, currents)
+    bump_versions(['3:8:3P'] + markets)
+
+    assert received(pubsub, 3, timeout=0.5) == [{'v': i + 2, 'm': market, 'p': long_price(market, current), **current} for i, (market, current) in enumerate(zip(markets, currents))]
+
+    pubsub.close()
+
+
+def test_record_holdings_on_the_market_shard(servers):
+
+    servers[0].hset(SHARD_MAP_KEY, '9', 1)
+    servers[0].incr(SHARD_VERSION_KEY)
+    shards.refresh(force=True)
+
+    market = '2:9:2P'
+
+    with shards.client(market).pipeline() as pipe:
+        roll_candles(pipe, [market], [0.5], ['d'], 100)
+        record_holdings(pipe, [market], [PLAYER])
+        version, = pipe.execute()[-1]
+
+    assert get_candles([market], ['d'])[0]['d']['c'] == [long_price(market, PLAYER)]
+    assert int(servers[1].get(version_key(market))) == version
+    assert servers[1].hkeys(PENDING_KEY) == [market.encode()] and not servers[0].exists(PENDING_KEY)
+
+
+def test_bump_clears_pending_marks(servers):
+
+    servers[0].hset(SHARD_MAP_KEY, '9', 1)
+    servers[0].incr(SHARD_VERSION_KEY)
+    shards.refresh(force=True)
+
+    markets = ['1:8:1P', '2:9:2P']
+
+    for market in markets:
+        write(shards.client(market), [market], [PLAYER])
+
+    assert servers[0].hkeys(PENDING_KEY) == [b'1:8:1P'] and servers[1].hkeys(PENDING_KEY) == [b'2:9:2P']
+
+    bump_versions(markets)
+
+    assert not servers[0].exists(PENDING_KEY) and not servers[1].exists(PENDING_KEY)
+    assert logged(servers[0], markets) == [1, 2]
+    assert repair_versions() == 0
+
+
+def test_repair_bumps_what_a_dead_writer_left(servers):
+
+    pubsub = subscribe(servers[0])
+
+    # the writer dies after EXEC, before bump_versions
+    write(servers[0], ['1:8:1P'], [PLAYER])
+
+    assert logged(servers[0], ['1:8:1P']) == [0]
+    assert repair_versions() == 1
+    assert logged(servers[0], ['1:8:1P']) == [1]
+    assert not servers[0].exists(PENDING_KEY)
+    assert received(pubsub, 1, timeout=0.5) == [{'v': 1, 'm': '1:8:1P', 'p': long_price('1:8:1P', PLAYER), **PLAYER}]
+
+    pubsub.close()
+
+
+def test_bump_publishes_the_latest_write(servers):
+
+    pubsub = subscribe(servers[0])
+
+    write(servers[0], ['1:8:1P'], [PLAYER])
+    write(servers[0], ['1:8:1P'], [{'N': 20.0, 'b': 2000.0}])
+
+    # the first writer bumps after the second has written, so bumps the second write, and the second has nothing left
+    bump_versions(['1:8:1P'])
+    bump_versions(['1:8:1P'])
+
+    assert [message['N'] for message in received(pubsub, 2, timeout=0.5)] == [20.0]
+    assert not servers[0].exists(PENDING_KEY)
+    assert logged(servers[0], ['1:8:1P']) == [1]
+
+    pubsub.close()
+
+
+def test_bump_of_an_older_write_is_dropped(servers):
+
+    pubsub = subscribe(servers[0])
+
+    # the first writer reads its pending entry, then the second writes and bumps before the first does
+    write(servers[0], ['1:8:1P'], [PLAYER])
+    first = servers[0].hget(PENDING_KEY, '1:8:1P')
+    write(servers[0], ['1:8:1P'], [{'N': 20.0, 'b': 2000.0}])
+    bump_versions(['1:8:1P'])
+
+    servers[0].hset(PENDING_KEY, '1:8:1P', first)
+
+    assert repair_versions() == 0
+    assert [message['N'] for message in received(pubsub, 2, timeout=0.5)] == [20.0]
+    assert logged(servers[0], ['1:8:1P']) == [1]
+    assert not servers[0].exists(PENDING_KEY)
+
+    pubsub.close()
+
+
+def test_changes_since_pages_through_the_log(servers):
+
+    a, b, c = write(servers[0], ['a:8:1T', 'b:8:1T', 'c:8:1T'])
+    bump_versions(['a:8:1T', 'b:8:1T', 'c:8:1T'])
+    a, = write(servers[0], ['a:8:1T'])
+    bump_versions(['a:8:1T'])
+
+    # positions are sequence numbers, and versions are those of the holdings themselves
+    assert get_changes_since(0, 10) == (['b:8:1T', 'c:8:1T', 'a:8:1T'], [b, c, a], 4)
+    assert get_changes_since(0, 2) == (['b:8:1T', 'c:8:1T'], [b, c], 3)
+    assert get_changes_since(3, 2) == (['a:8:1T'], [a], 4)
+    assert get_changes_since(4, 2) == ([], [], 4)
+
+
+def test_holdings_etag_changes_with_every_write(servers):
+
+    missing = holdings_etag(['1:8:1P'], [0])
+    first = holdings_etag(['1:8:1P'], write(servers[0], ['1:8:1P']))
+
+    # the same holdings written again are still a new version
+    second = holdings_etag(['1:8:1P'], write(servers[0], ['1:8:1P']))
+
+    assert len({missing, first, second}) == 3
+    assert holdings_etag(['1:8:1P'], [1], 'msgpack') != holdings_etag(['1:8:1P'], [1])